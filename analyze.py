@@ -1,101 +1,201 @@
 """
 Reads txt files of all papers and computes tfidf vectors for all papers.
-Dumps results to file tfidf.p
+Dumps results to the tfidf artifact (see artifacts.py), with the vocabulary, the
+pids of the rows and the precomputed neighbours
+
+The new or changed txt files are first packed into the corpus store (see
+corpus_store.py), the texts are then read from its shards in storage order.
+
+Runs are incremental by default. The vocabulary of the last full fit, the term
+frequencies and the document frequency counts are kept in tfidf_state.p, so only
+the text files that are new or changed since the last run are vectorized, the idf
+is updated from the counts, and the new rows are appended to the stored matrix.
+The neighbours are updated for the new papers only. A full refit (new
+vocabulary, all the neighbours, and the ann index of build_ann_index.py when
+there is one) happens every refit_days or with --full.
 """
 import os
+import time
 import pickle
+import argparse
 from random import shuffle, seed
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
 
-from utils import Config, safe_pickle_dump
+from ann_index import AnnIndex
+from artifacts import artifact_exists, save_artifact, pid_table_arrays
+from corpus_store import CorpusStore, pack_txt_dir
+from knn import all_pairs_topk, update_topk
+from utils import Config, safe_pickle_dump, strip_version, fingerprint
 
 seed(1337)
 max_train = 5000 # max number of tfidf training documents (chosen randomly), for memory efficiency
 max_features = 5000
+num_neighbors = 50 # number of similar papers precomputed per paper
+knn_max_memory_mb = 2048 # bound on the scratch memory of the nearest neighbor workers
+refit_days = 7 # incremental runs reuse the vocabulary of a full fit for at most this many days
 
-# read database
-db = pickle.load(open(Config.db_path, 'rb'))
-
-# read all text files for all papers into memory
-txt_paths, pids = [], []
-n = 0
-for pid,j in db.items():
-  n += 1
-  idvv = '%sv%d' % (j['_rawid'], j['_version'])
-  txt_path = os.path.join('data', 'txt', idvv) + '.pdf.txt'
-  if os.path.isfile(txt_path): # some pdfs dont translate to txt
-    with open(txt_path, 'r') as f:
-      txt = f.read()
-    if len(txt) > 1000 and len(txt) < 500000: # 500K is VERY conservative upper bound
-      txt_paths.append(txt_path) # todo later: maybe filter or something some of them
-      pids.append(idvv)
-      print("read %d/%d (%s) with %d chars" % (n, len(db), idvv, len(txt)))
-    else:
-      print("skipped %d/%d (%s) with %d chars: suspicious!" % (n, len(db), idvv, len(txt)))
-  else:
-    print("could not find %s in txt folder." % (txt_path, ))
-print("in total read in %d text files out of %d db entries." % (len(txt_paths), len(db)))
-
-# compute tfidf vectors with scikits
-v = TfidfVectorizer(input='content', 
-        encoding='utf-8', decode_error='replace', strip_accents='unicode', 
-        lowercase=True, analyzer='word', stop_words='english', 
+# tokenization shared by the vocabulary fit and the transforms
+vectorizer_args = dict(input='content',
+        encoding='utf-8', decode_error='replace', strip_accents='unicode',
+        lowercase=True, analyzer='word', stop_words='english',
         token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
-        ngram_range=(1, 2), max_features = max_features, 
-        norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
-        max_df=1.0, min_df=1)
+        ngram_range=(1, 2), max_df=1.0, min_df=1)
+
+def list_txt_files(db, store):
+  """
+  returns idvv -> (idvv, size, mtime) of all the papers with a usable text in the corpus store, in storage order.
+  size and mtime are those of the text file it was packed from
+  """
+  files = {}
+  for pid,j in db.items():
+    idvv = '%sv%d' % (j['_rawid'], j['_version'])
+    if idvv not in store: # some pdfs dont translate to txt
+      print("could not find %s in the corpus store." % (idvv, ))
+      continue
+    size = store.raw_length(idvv)
+    if size > 1000 and size < 500000: # 500K is VERY conservative upper bound
+      files[idvv] = (idvv,) + store.fingerprint(idvv)
+    else:
+      print("skipped %s with %d bytes: suspicious!" % (idvv, size))
+  print("in total found %d text files out of %d db entries." % (len(files), len(db)))
+  return {k: files[k] for k in store.storage_order(files)} # read sequentially
 
 # create an iterator object to conserve memory
-def make_corpus(paths):
-  for p in paths:
-    with open(p, 'r') as f:
-      txt = f.read()
-    yield txt
-
-# train
-train_txt_paths = list(txt_paths) # duplicate
-shuffle(train_txt_paths) # shuffle
-train_txt_paths = train_txt_paths[:min(len(train_txt_paths), max_train)] # crop
-print("training on %d documents..." % (len(train_txt_paths), ))
-train_corpus = make_corpus(train_txt_paths)
-v.fit(train_corpus)
-
-# transform
-print("transforming %d documents..." % (len(txt_paths), ))
-corpus = make_corpus(txt_paths)
-X = v.transform(corpus)
-print(v.vocabulary_)
-print(X.shape)
-
-# write full matrix out
-out = {}
-out['X'] = X # this one is heavy!
-print("writing", Config.tfidf_path)
-safe_pickle_dump(out, Config.tfidf_path)
-
-# writing lighter metadata information into a separate (smaller) file
-out = {}
-out['vocab'] = v.vocabulary_
-out['idf'] = v._tfidf.idf_
-out['pids'] = pids # a full idvv string (id and version number)
-out['ptoi'] = { x:i for i,x in enumerate(pids) } # pid to ix in X mapping
-print("writing", Config.meta_path)
-safe_pickle_dump(out, Config.meta_path)
-
-print("precomputing nearest neighbor queries in batches...")
-X = X.todense() # originally it's a sparse matrix
-sim_dict = {}
-batch_size = 200
-for i in range(0,len(pids),batch_size):
-  i1 = min(len(pids), i+batch_size)
-  xquery = X[i:i1] # BxD
-  ds = -np.asarray(np.dot(X, xquery.T)) #NxD * DxB => NxB
-  IX = np.argsort(ds, axis=0) # NxB
-  for j in range(i1-i):
-    sim_dict[pids[i+j]] = [pids[q] for q in list(IX[:50,j])]
-  print('%d/%d...' % (i, len(pids)))
-
-print("writing", Config.sim_path)
-safe_pickle_dump(sim_dict, Config.sim_path)
+def make_corpus(store, keys):
+  for _, txt in store.iter_texts(keys):
+    yield txt # bytes, decoded by the vectorizer
+
+def term_frequencies(vocab, store, keys):
+  """ sublinear tf (1 + log(count)) of the docs over a fixed vocabulary, like TfidfVectorizer(sublinear_tf=True) """
+  v = CountVectorizer(vocabulary=vocab, **vectorizer_args)
+  tf = v.transform(make_corpus(store, keys)).astype(np.float64)
+  tf.data = 1 + np.log(tf.data)
+  return tf
+
+def document_frequency(tf):
+  return np.bincount(tf.indices, minlength=tf.shape[1])
+
+def tfidf(tf, df):
+  """ smooth idf and l2 normalized rows, like TfidfVectorizer(smooth_idf=True, norm='l2') """
+  n = tf.shape[0]
+  idf = np.log((1 + n) / (1 + df)) + 1
+  X = normalize(tf @ sp.diags(idf), norm='l2')
+  return X.tocsr(), idf
+
+def full_fit(files, store):
+  pids = list(files.keys())
+  keys = [files[p][0] for p in pids]
+
+  # train the vocabulary on a random subset
+  train_keys = list(keys) # duplicate
+  shuffle(train_keys) # shuffle
+  train_keys = store.storage_order(train_keys[:min(len(train_keys), max_train)]) # crop
+  print("training on %d documents..." % (len(train_keys), ))
+  v = CountVectorizer(max_features=max_features, **vectorizer_args)
+  v.fit(make_corpus(store, train_keys))
+
+  # transform
+  print("transforming %d documents..." % (len(keys), ))
+  tf = term_frequencies(v.vocabulary_, store, keys)
+  df = document_frequency(tf)
+  X, idf = tfidf(tf, df)
+  print(X.shape)
+
+  print("precomputing nearest neighbor queries in batches...")
+  IX, S = all_pairs_topk(X, k=num_neighbors, max_memory_mb=knn_max_memory_mb, return_scores=True)
+
+  state = {'vocab': v.vocabulary_, 'pids': pids, 'fingerprints': {p: files[p][1:] for p in pids},
+           'tf': tf, 'df': df, 'IX': IX, 'S': S, 'last_full_fit': time.time()}
+  return state, X, idf
+
+def incremental_fit(state, files, store):
+  old_pids = state['pids']
+  keep = [i for i,p in enumerate(old_pids) if p in files and files[p][1:] == state['fingerprints'][p]]
+  kept = set(old_pids[i] for i in keep)
+  removed = np.setdiff1d(np.arange(len(old_pids)), keep)
+  new_pids = [p for p in files if p not in kept]
+  print("%d unchanged, %d new or changed and %d removed documents" % (len(keep), len(new_pids), len(removed)))
+
+  # vectorize only the delta and update the document frequencies
+  print("transforming %d documents..." % (len(new_pids), ))
+  tf_new = term_frequencies(state['vocab'], store, [files[p][0] for p in new_pids])
+  tf_old = state['tf']
+  df = state['df'] - document_frequency(tf_old[removed]) + document_frequency(tf_new)
+  tf = sp.vstack([tf_old[keep], tf_new]).tocsr()
+  pids = [old_pids[i] for i in keep] + new_pids
+  X, idf = tfidf(tf, df)
+  print(X.shape)
+
+  # carry over the neighbours of the unchanged docs, pointing to their new row indices
+  remap = -np.ones(len(old_pids), dtype=np.int64)
+  remap[keep] = np.arange(len(keep))
+  # a fit of fewer than num_neighbors docs has fewer columns, the missing ones stay -1
+  k_old = min(state['IX'].shape[1], num_neighbors)
+  IX_old = state['IX'][keep, :k_old]
+  IX = np.full((len(pids), num_neighbors), -1, dtype=np.int32)
+  S = np.full((len(pids), num_neighbors), -np.inf, dtype=np.float32)
+  IX[:len(keep), :k_old] = np.where(IX_old >= 0, remap[IX_old], -1)
+  S[:len(keep), :k_old] = np.where(IX[:len(keep), :k_old] >= 0, state['S'][keep, :k_old], -np.inf)
+  print("updating nearest neighbor queries...")
+  IX, S = update_topk(X, IX, S, np.arange(len(keep), len(pids)), max_memory_mb=knn_max_memory_mb)
+
+  state = dict(state, pids=pids, fingerprints={p: files[p][1:] for p in pids}, tf=tf, df=df, IX=IX, S=S)
+  return state, X, idf
+
+def write_outputs(state, X, idf):
+  pids = state['pids']
+
+  out = {}
+  out['X'] = X.astype(np.float32) # this one is heavy! mapped by the readers
+  out['idf'] = idf
+  out['vocab'] = sorted(state['vocab'], key=state['vocab'].get) # the term of every column
+  out.update(pid_table_arrays('pids', pids)) # a full idvv string (id and version number) per row of X
+  out.update(pid_table_arrays('rawpids', [strip_version(p) for p in pids]))
+  out['neighbours'] = state['IX'] # rows of the most similar papers, -1 padded
+  print("writing", Config.tfidf_dir)
+  vocab_fp = fingerprint(out['vocab'])
+  save_artifact(Config.tfidf_dir, 'tfidf', out, vocab_fp=vocab_fp)
+
+  print("writing", Config.tfidf_state_path)
+  safe_pickle_dump(state, Config.tfidf_state_path)
+  return vocab_fp
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--full', action='store_true', help='refit the vocabulary and recompute all the neighbours')
+  parser.add_argument('--refit-days', type=float, default=refit_days, help='do a full refit if the last one is older')
+  args = parser.parse_args()
+
+  # read database, and pack the new text files into the corpus store
+  db = pickle.load(open(Config.db_path, 'rb'))
+  store = CorpusStore()
+  num_added, num_removed = pack_txt_dir(store)
+  print("packed %d new or changed text files into the corpus store, %d removed" % (num_added, num_removed))
+  files = list_txt_files(db, store)
+
+  state = None
+  if not args.full and os.path.isfile(Config.tfidf_state_path):
+    state = pickle.load(open(Config.tfidf_state_path, 'rb'))
+    if time.time() - state['last_full_fit'] > args.refit_days * 86400:
+      print("last full fit is older than %s days" % (args.refit_days, ))
+      state = None
+
+  full = state is None
+  if full:
+    print("full fit")
+    state, X, idf = full_fit(files, store)
+  else:
+    print("incremental fit")
+    state, X, idf = incremental_fit(state, files, store)
+  vocab_fp = write_outputs(state, X, idf)
+
+  # the ann index projects the columns of the vocabulary it was built on, a new vocabulary needs a new index
+  if full and artifact_exists(Config.ann_index_dir):
+    dim = AnnIndex.load(Config.ann_index_dir).projection.shape[1]
+    print("rebuilding the ann index for the new vocabulary")
+    index = AnnIndex.build(X, state['pids'], dim=dim, vocab_fp=vocab_fp)
+    index.save(Config.ann_index_dir)
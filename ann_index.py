@@ -0,0 +1,207 @@
+"""
+Approximate nearest neighbour index over the tfidf vectors, in pure NumPy.
+
+The sparse tfidf rows are reduced with a fixed random projection to `dim` dense
+dimensions, l2 normalized and quantized to int8 codes. An inverted file (IVF)
+assigns every code to its nearest of `nlist` k-means centroids. A query only
+scans the lists of its `nprobe` nearest centroids and, when the exact vectors are
+at hand, re-ranks the best `rerank` candidates with the exact cosine.
+
+recall / speed knobs: nprobe (lists scanned), rerank (exact re-rank depth), and at
+build time dim and nlist.
+
+On disk the index is an artifact (see artifacts.py): every save() writes a new
+generation directory of .npy files, loaded with mmap, and swaps it in at once, so
+readers never mix the arrays of two builds. The small "delta" segment holding the
+papers added since the last build is one delta.npz in the current generation,
+replaced atomically by save_delta(), so new papers can be added without
+rebuilding.
+
+The projection is tied to the columns of the vocabulary the index was built on,
+whose fingerprint (the vocab_fp of the tfidf artifact) is stored with it. Vectors
+of another vocabulary are refused by add(), and the index isn't used by the
+similarity service until it's rebuilt, which analyze.py does after a full fit.
+"""
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from artifacts import save_artifact, load_artifact
+from utils import open_atomic
+
+INDEX_VERSION = 1
+MAIN_FILES = ['projection', 'centroids', 'codes', 'offsets', 'pids']
+DELTA_FILES = ['delta_codes', 'delta_lists', 'delta_pids']
+DELTA_FILE = 'delta.npz'
+
+
+def _normalize(V):
+    norms = np.linalg.norm(V, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return V / norms
+
+
+def kmeans(V, nlist, iters=20, seed=1337):
+    """ spherical k-means on the rows of V (already l2 normalized), returns nlist x d centroids """
+    rng = np.random.RandomState(seed)
+    C = V[rng.choice(len(V), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(V @ C.T, axis=1)
+        members = sp.csr_matrix((np.ones(len(V), dtype=V.dtype), (assign, np.arange(len(V)))), shape=(nlist, len(V)))
+        C = np.asarray(members @ V)
+        empty = np.asarray(members.sum(axis=1)).ravel() == 0
+        C[empty] = V[rng.randint(len(V), size=empty.sum())] # reseed empty clusters
+        C = _normalize(C)
+    return C.astype(np.float32)
+
+
+class AnnIndex(object):
+
+    def __init__(self, projection, centroids, codes, offsets, pids, scale, delta=None, vocab_fp=None):
+        """ use build() or load() """
+        self.projection = projection # D x dim float32
+        self.centroids = centroids # nlist x dim float32
+        self.codes = codes # N x dim int8, ordered by list
+        self.offsets = offsets # nlist + 1 int64, list c is codes[offsets[c]:offsets[c+1]]
+        self.pids = pids # N fixed width strings, aligned with codes
+        self.scale = scale # float value of the int8 code 127
+        self.vocab_fp = vocab_fp # fingerprint of the vocabulary of the projected columns
+        if delta is None:
+            dim = projection.shape[1]
+            delta = (np.zeros((0, dim), dtype=np.int8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=pids.dtype))
+        self.delta_codes, self.delta_lists, self.delta_pids = delta
+
+    def __len__(self):
+        return len(self.pids) + len(self.delta_pids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    # -------------------------------------------------------------------------
+    # building
+
+    @classmethod
+    def build(cls, X, pids, dim=256, nlist=None, train_size=50000, seed=1337, vocab_fp=None):
+        """
+        :param X: sparse tfidf matrix (N x D)
+        :param pids: idvv strings of the rows of X
+        :param vocab_fp: fingerprint of the vocabulary of the columns of X
+        :param nlist: number of inverted lists, defaults to ~4 sqrt(N)
+        """
+        n = X.shape[0]
+        rng = np.random.RandomState(seed)
+        nlist = nlist or max(1, min(n, int(4 * np.sqrt(n))))
+        projection = (rng.standard_normal((X.shape[1], dim)) / np.sqrt(dim)).astype(np.float32)
+        V = cls._project(X, projection)
+
+        train = V[rng.choice(n, min(n, train_size), replace=False)]
+        centroids = kmeans(train, nlist, seed=seed)
+        scale = float(np.quantile(np.abs(train), 0.999)) or 1.0
+
+        assign = cls._assign(V, centroids)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        codes = cls._quantize(V[order], scale)
+        pids = np.asarray(pids)[order]
+        return cls(projection, centroids, codes, offsets, pids, scale, vocab_fp=vocab_fp)
+
+    @staticmethod
+    def _project(X, projection):
+        return _normalize(np.asarray(X @ projection, dtype=np.float32))
+
+    @staticmethod
+    def _assign(V, centroids, batch_size=10000):
+        return np.concatenate([np.argmax(V[i:i + batch_size] @ centroids.T, axis=1)
+                               for i in range(0, len(V), batch_size)]).astype(np.int32)
+
+    @staticmethod
+    def _quantize(V, scale):
+        return np.clip(np.rint(V * (127 / scale)), -127, 127).astype(np.int8)
+
+    def add(self, X, pids, vocab_fp):
+        """
+        adds new papers to the delta segment, they are merged into the lists by the next build
+        :param vocab_fp: fingerprint of the vocabulary of the columns of X, must be the one the index was built on
+        """
+        if vocab_fp != self.vocab_fp:
+            raise ValueError('the ann index was built on another vocabulary, rebuild it')
+        V = self._project(X, self.projection)
+        self.delta_codes = np.concatenate([self.delta_codes, self._quantize(V, self.scale)])
+        self.delta_lists = np.concatenate([self.delta_lists, self._assign(V, self.centroids)])
+        # no forced dtype: the concatenation widens the strings to the longest pid (e.g. a 2 digit version)
+        self.delta_pids = np.concatenate([self.delta_pids, np.asarray(pids, dtype=self.pids.dtype.kind)])
+
+    # -------------------------------------------------------------------------
+    # querying
+
+    def search(self, x, k=50, nprobe=8, rerank=500, exact=None):
+        """
+        returns the idvvs of (approximately) the k nearest papers to the sparse 1 x D row x, and their scores
+        :param nprobe: number of inverted lists scanned
+        :param rerank: number of candidates re-ranked with exact cosine, if exact is given
+        :param exact: function mapping an array of idvvs to a mask of the known ones and a sparse matrix of
+                      their tfidf rows
+        """
+        q = self._project(x, self.projection)[0]
+        lists = np.argsort(-(self.centroids @ q))[:nprobe]
+        cand_codes = [self.codes[self.offsets[c]:self.offsets[c + 1]] for c in lists]
+        cand_pids = [self.pids[self.offsets[c]:self.offsets[c + 1]] for c in lists]
+        in_delta = np.isin(self.delta_lists, lists)
+        cand_codes.append(self.delta_codes[in_delta])
+        cand_pids.append(self.delta_pids[in_delta])
+        codes = np.concatenate(cand_codes)
+        pids = np.concatenate(cand_pids)
+        if len(pids) == 0:
+            return [], np.zeros(0, dtype=np.float32)
+
+        # approximate scores from the int8 codes
+        scores = (codes @ (q * (self.scale / 127))).astype(np.float32)
+        depth = max(k, rerank) if exact is not None else k
+        top = self._topk(scores, depth)
+        pids, scores = pids[top], scores[top]
+
+        if exact is not None:
+            known, rows = exact(pids)
+            pids = pids[known]
+            if len(pids) == 0:
+                return [], np.zeros(0, dtype=np.float32)
+            scores = np.asarray((rows @ x.T).todense(), dtype=np.float32).ravel()
+            top = self._topk(scores, k)
+            pids, scores = pids[top], scores[top]
+        return [str(p) for p in pids[:k]], scores[:k]
+
+    @staticmethod
+    def _topk(scores, k):
+        k = min(k, len(scores))
+        ix = np.argpartition(-scores, k - 1)[:k]
+        return ix[np.argsort(-scores[ix], kind='stable')]
+
+    # -------------------------------------------------------------------------
+    # persistence
+
+    def save(self, path):
+        """ writes the whole index (e.g. after a build) as a new generation """
+        arrays = {name: getattr(self, name) for name in MAIN_FILES + DELTA_FILES}
+        save_artifact(path, 'ann', arrays, index_version=INDEX_VERSION, scale=self.scale, vocab_fp=self.vocab_fp)
+
+    def save_delta(self, path):
+        """ writes only the delta segment (e.g. after add) into the current generation, the large files are left alone """
+        with open_atomic(os.path.join(load_artifact(path, 'ann').gen_dir, DELTA_FILE), 'wb', fsync=True) as f:
+            np.savez(f, **{name: getattr(self, name) for name in DELTA_FILES})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        artifact = load_artifact(path, 'ann', mmap)
+        meta = artifact.meta
+        assert meta['index_version'] == INDEX_VERSION, 'ann index version %s, rebuild it' % (meta['index_version'], )
+        main = [artifact[name] for name in MAIN_FILES]
+        delta_path = os.path.join(artifact.gen_dir, DELTA_FILE)
+        if os.path.isfile(delta_path):
+            with np.load(delta_path) as d:
+                delta = [d[name] for name in DELTA_FILES]
+        else:
+            delta = [np.array(artifact[name]) for name in DELTA_FILES] # the delta saved with the build
+        return cls(*main, scale=meta['scale'], delta=delta, vocab_fp=meta['vocab_fp'])
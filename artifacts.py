@@ -0,0 +1,173 @@
+"""
+Memory-mappable format of the outputs of analyze.py and buildsvm.py.
+
+An artifact is a directory of raw .npy files plus a meta.json. Sparse matrices
+are stored as their three CSR arrays, lists of ids as fixed-width byte string
+arrays, neighbour lists as -1 padded int32 matrices. Loading reads meta.json only:
+every array is opened with np.load(mmap_mode='r') when it's first accessed, so
+loading is nearly free and all the processes that read an artifact share one
+copy of it in the page cache.
+
+Every save writes a new generation directory (gen-00001, ...) and then atomically
+replaces the CURRENT file that points to it, so readers never see a half written
+artifact. The generation before the current one is kept for readers that were
+opening it at that time, older ones are removed.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import open_atomic
+
+ARTIFACT_VERSION = 1
+
+
+def save_artifact(path, kind, arrays, **meta):
+    """
+    writes a new generation of the artifact in directory path
+    :param kind: what the artifact holds e.g. 'tfidf', checked by load_artifact
+    :param arrays: name -> numpy array, scipy sparse matrix or list of str
+    :param meta: extra json values stored in meta.json
+    """
+    if not os.path.exists(path): os.makedirs(path)
+    current = _current_generation(path)
+    gen = 'gen-%05d' % (int(current[4:]) + 1 if current else 1, )
+    gen_dir = os.path.join(path, gen)
+    if os.path.exists(gen_dir):
+        shutil.rmtree(gen_dir) # left by a save that crashed
+    os.makedirs(gen_dir)
+
+    sparse = {}
+    for name, a in arrays.items():
+        if sp.issparse(a):
+            a = a.tocsr()
+            sparse[name] = list(a.shape)
+            parts = {name + '.data': a.data, name + '.indices': a.indices, name + '.indptr': a.indptr}
+        elif isinstance(a, list):
+            parts = {name: np.array([s.encode('utf-8') for s in a], dtype='S')}
+        else:
+            parts = {name: np.asarray(a)}
+        for part_name, part in parts.items():
+            with open(os.path.join(gen_dir, part_name + '.npy'), 'wb') as f:
+                np.save(f, part)
+                f.flush()
+                os.fsync(f.fileno())
+    with open(os.path.join(gen_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, version=ARTIFACT_VERSION, kind=kind, arrays=sorted(arrays), sparse=sparse), f)
+
+    with open_atomic(os.path.join(path, 'CURRENT'), 'w', fsync=True) as f:
+        f.write(gen)
+    for old in os.listdir(path):
+        if old.startswith('gen-') and old not in (gen, current):
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+
+
+def _current_generation(path):
+    try:
+        with open(os.path.join(path, 'CURRENT'), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def artifact_exists(path):
+    return _current_generation(path) is not None
+
+
+class Artifact(object):
+    """ the arrays of an artifact, mapped on first access: artifact['X'], artifact.meta['...'] """
+
+    def __init__(self, gen_dir, meta, mmap=True):
+        self.gen_dir = gen_dir
+        self.meta = meta
+        self.mmap_mode = 'r' if mmap else None
+        self._arrays = {}
+
+    def __contains__(self, name):
+        return name in self.meta['arrays']
+
+    def _load(self, name):
+        return np.load(os.path.join(self.gen_dir, name + '.npy'), mmap_mode=self.mmap_mode)
+
+    def __getitem__(self, name):
+        a = self._arrays.get(name)
+        if a is None:
+            if name not in self:
+                raise KeyError(name)
+            if name in self.meta['sparse']:
+                parts = [self._load(name + suffix) for suffix in ('.data', '.indices', '.indptr')]
+                a = sp.csr_matrix(tuple(parts), shape=tuple(self.meta['sparse'][name]), copy=False)
+            else:
+                a = self._load(name)
+            self._arrays[name] = a
+        return a
+
+    def strings(self, name):
+        """ a byte string array as a list of str, copied to the heap """
+        return [s.decode('utf-8') for s in self[name].tolist()]
+
+
+def load_artifact(path, kind, mmap=True):
+    gen = _current_generation(path)
+    if gen is None:
+        raise FileNotFoundError('no artifact in %s' % (path, ))
+    gen_dir = os.path.join(path, gen)
+    with open(os.path.join(gen_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    assert meta['version'] == ARTIFACT_VERSION, 'artifact version %s, rerun its job' % (meta['version'], )
+    assert meta['kind'] == kind, 'expected a %s artifact in %s, found %s' % (kind, path, meta['kind'])
+    return Artifact(gen_dir, meta, mmap)
+
+
+# id tables
+# -----------------------------------------------------------------------------
+
+def pid_table_arrays(name, pids):
+    """
+    the arrays of a PidTable of the ids (str) of the rows: name (row order), name_sorted and name_rows (the row of
+    every sorted id). When an id appears more than once, the last row wins
+    """
+    keys = np.array([p.encode('utf-8') for p in pids], dtype='S')
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = sorted_keys[:-1] != sorted_keys[1:]
+    return {name: keys, name + '_sorted': sorted_keys[last], name + '_rows': order[last].astype(np.int32)}
+
+
+class PidTable(object):
+    """ row -> id and id -> row lookups on the (mapped) arrays of pid_table_arrays, without python dicts """
+
+    def __init__(self, keys, sorted_keys, rows):
+        self.keys = keys
+        self.sorted_keys = sorted_keys
+        self.rows = rows
+
+    @classmethod
+    def from_artifact(cls, artifact, name):
+        return cls(artifact[name], artifact[name + '_sorted'], artifact[name + '_rows'])
+
+    @classmethod
+    def from_list(cls, name, pids):
+        arrays = pid_table_arrays(name, pids)
+        return cls(arrays[name], arrays[name + '_sorted'], arrays[name + '_rows'])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, row):
+        return self.keys[row].decode('utf-8')
+
+    def index(self, pid):
+        """ the row of pid, or None """
+        key = pid.encode('utf-8')
+        i = np.searchsorted(self.sorted_keys, key)
+        if i < len(self.sorted_keys) and self.sorted_keys[i] == key:
+            return int(self.rows[i])
+        return None
+
+    def tolist(self):
+        return [k.decode('utf-8') for k in self.keys.tolist()]
@@ -0,0 +1,42 @@
+"""
+One-off job that adds the render-ready "card" subdocument (see paper_views.py)
+to papers that were ingested before it existed, or whose card is outdated.
+Safe to rerun, only papers without an up to date card are touched.
+"""
+import logging
+
+import pymongo
+from pymongo import UpdateOne
+
+from logger import logger_config
+from paper_views import build_card, CARD_VERSION, CARD_SOURCE_FIELDS
+from utils import catch_exceptions
+
+logger_config(info_filename='backfill_cards.log')
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+@catch_exceptions(logger=logger)
+def backfill_cards(papers):
+    q = {'card.v': {'$ne': CARD_VERSION}}
+    logger.info(f'Backfilling cards of {papers.count_documents(q)} papers')
+    ops = []
+    num_done = 0
+    for p in papers.find(q, {f: 1 for f in CARD_SOURCE_FIELDS}):
+        ops.append(UpdateOne({'_id': p['_id']}, {'$set': {'card': build_card(p)}}))
+        if len(ops) >= BATCH_SIZE:
+            papers.bulk_write(ops, ordered=False)
+            num_done += len(ops)
+            ops = []
+            logger.info(f'Backfilled {num_done} papers')
+    if ops:
+        papers.bulk_write(ops, ordered=False)
+        num_done += len(ops)
+    logger.info(f'Finished backfilling {num_done} papers')
+
+
+if __name__ == '__main__':
+    client = pymongo.MongoClient()
+    backfill_cards(client.arxiv.papers)
@@ -0,0 +1,100 @@
+"""
+recall@50 and latency of the approximate index (ann_index.py) against the exact
+neighbours of analyze.py, for a few nprobe / rerank settings.
+
+By default the corpus is synthetic: docs are drawn from a mixture of topics so
+that they have actual neighbours. With --real it uses the tfidf artifact of
+analyze.py instead (Config.tfidf_dir): its X, pids and precomputed neighbours.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from ann_index import AnnIndex
+from artifacts import load_artifact
+from knn import all_pairs_topk
+from utils import Config
+
+K = 50
+NUM_FEATURES = 5000
+
+
+def make_corpus(n, rng, num_topics=200, words_per_doc=150):
+    topics = rng.dirichlet(np.full(NUM_FEATURES, 0.02), size=num_topics)
+    rows, cols = [], []
+    for i in range(n):
+        mix = rng.dirichlet(np.full(3, 0.5))
+        doc_topics = rng.choice(num_topics, 3, replace=False)
+        p = mix @ topics[doc_topics]
+        words = rng.choice(NUM_FEATURES, words_per_doc, p=p / p.sum())
+        rows.append(np.full(len(words), i))
+        cols.append(words)
+    X = sp.csr_matrix((np.ones(n * words_per_doc), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(n, NUM_FEATURES))
+    X.sum_duplicates()
+    X.data = 1 + np.log(X.data)
+    return normalize(X)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=20000)
+    parser.add_argument('--num-queries', type=int, default=300)
+    parser.add_argument('--real', action='store_true')
+    args = parser.parse_args()
+    rng = np.random.RandomState(1337)
+
+    if args.real:
+        tfidf = load_artifact(Config.tfidf_dir, 'tfidf')
+        X, pids = tfidf['X'], tfidf.strings('pids')
+        vocab_fp = tfidf.meta.get('vocab_fp')
+        sim_dict = {pids[i]: [pids[j] for j in row if j >= 0] for i, row in enumerate(tfidf['neighbours'])}
+    else:
+        X = make_corpus(args.num_docs, rng)
+        pids = ['%dv1' % i for i in range(X.shape[0])]
+        vocab_fp = 'synthetic'
+        IX = all_pairs_topk(X, K, max_memory_mb=512, log=lambda s: None)
+        sim_dict = {pids[i]: [pids[j] for j in IX[i]] for i in range(len(pids))}
+    ptoi = {p: i for i, p in enumerate(pids)}
+
+    # build on 95% of the docs, add the rest to the delta segment
+    n_main = int(len(pids) * 0.95)
+    t0 = time.perf_counter()
+    index = AnnIndex.build(X[:n_main], pids[:n_main], vocab_fp=vocab_fp)
+    print('built an index of %d docs with %d lists in %.1f s' % (n_main, index.nlist, time.perf_counter() - t0))
+    index.add(X[n_main:], pids[n_main:], vocab_fp)
+    tmp = tempfile.mkdtemp()
+    try:
+        index.save(tmp)
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(tmp) for f in files)
+        print('index size on disk: %.1f MB (codes %.1f MB)' % (size / 2**20, index.codes.nbytes / 2**20))
+        index = AnnIndex.load(tmp)
+
+        def exact(found):
+            ixs = np.array([ptoi[str(p)] for p in found])
+            return np.ones(len(ixs), dtype=bool), X[ixs]
+
+        queries = rng.choice(len(pids), args.num_queries, replace=False)
+        for nprobe in [4, 8, 16, 32]:
+            for rerank in [0, 500]:
+                recalls = []
+                t0 = time.perf_counter()
+                for qi in queries:
+                    found, _ = index.search(X[qi], K, nprobe=nprobe, rerank=rerank, exact=exact if rerank else None)
+                    recalls.append(len(set(found) & set(sim_dict[pids[qi]][:K])) / K)
+                dt = (time.perf_counter() - t0) / len(queries)
+                print('nprobe %2d rerank %3d: recall@%d %.3f, %.2f ms per query' %
+                      (nprobe, rerank, K, np.mean(recalls), dt * 1000))
+        del index
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
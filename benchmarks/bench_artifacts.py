@@ -0,0 +1,103 @@
+"""
+Loading the outputs of analyze.py for a synthetic 200k paper corpus: the old
+pickles (tfidf.p, tfidf_meta.p, sim_dict.p) versus the mapped tfidf artifact.
+Reports the time to a SimilarityService answering its first query, and the
+private memory of each of 4 server processes that loaded the outputs and then
+touched all of X (one sparse product), from /proc/<pid>/smaps_rollup.
+"""
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from artifacts import save_artifact, pid_table_arrays
+from similarity import SimilarityService
+from utils import safe_pickle_dump, strip_version
+
+NUM_DOCS = 200000
+NUM_FEATURES = 5000
+DENSITY = 0.01 # ~50 non zero terms per paper
+K = 50
+NUM_PROCESSES = 4
+
+
+def private_mb():
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':') for line in f if ':' in line)
+    return sum(int(fields[k].split()[0]) for k in ('Private_Clean', 'Private_Dirty')) / 1024
+
+
+def load_pickles(d):
+    """ SimilarityService.load before the artifacts """
+    with open(os.path.join(d, 'tfidf_meta.p'), 'rb') as f:
+        meta = pickle.load(f)
+    with open(os.path.join(d, 'tfidf.p'), 'rb') as f:
+        X = pickle.load(f)['X']
+    with open(os.path.join(d, 'sim_dict.p'), 'rb') as f:
+        sim_dict = pickle.load(f)
+    pids = meta['pids']
+    # the neighbours as the current service takes them, the old one kept the dict
+    return SimilarityService(X, pids, None), sim_dict
+
+
+def load_artifact_service(d):
+    return SimilarityService.load(tfidf_dir=os.path.join(d, 'tfidf'), ann_dir=os.path.join(d, 'none')), None
+
+
+def worker(load, d, queue):
+    t0 = time.perf_counter()
+    service, keep = load(d)
+    service.similar('1901.00001')
+    t_load = time.perf_counter() - t0
+    service.X.dot(np.ones(NUM_FEATURES, dtype=np.float32)) # page in all of X
+    queue.put((t_load, private_mb()))
+
+
+def main():
+    rng = np.random.RandomState(1337)
+    nnz = int(NUM_FEATURES * DENSITY)
+    indices = np.sort(rng.randint(0, NUM_FEATURES, size=(NUM_DOCS, nnz)), axis=1).ravel()
+    X = sp.csr_matrix((rng.rand(NUM_DOCS * nnz), indices, np.arange(0, NUM_DOCS * nnz + 1, nnz)),
+                      shape=(NUM_DOCS, NUM_FEATURES))
+    X.sum_duplicates()
+    X = normalize(X)
+    pids = ['19%02d.%05dv1' % (1 + i // 100000, i % 100000) for i in range(NUM_DOCS)]
+    IX = rng.randint(0, NUM_DOCS, size=(NUM_DOCS, K)).astype(np.int32)
+    vocab = {'term%d' % i: i for i in range(NUM_FEATURES)}
+    idf = np.ones(NUM_FEATURES)
+
+    d = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    safe_pickle_dump({'X': X}, os.path.join(d, 'tfidf.p'))
+    safe_pickle_dump({'vocab': vocab, 'idf': idf, 'pids': pids, 'ptoi': {p: i for i, p in enumerate(pids)}},
+                     os.path.join(d, 'tfidf_meta.p'))
+    safe_pickle_dump({pids[i]: [pids[q] for q in IX[i]] for i in range(NUM_DOCS)}, os.path.join(d, 'sim_dict.p'))
+    t_pickle = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    arrays = {'X': X.astype(np.float32), 'idf': idf, 'vocab': sorted(vocab, key=vocab.get), 'neighbours': IX}
+    arrays.update(pid_table_arrays('pids', pids))
+    arrays.update(pid_table_arrays('rawpids', [strip_version(p) for p in pids]))
+    save_artifact(os.path.join(d, 'tfidf'), 'tfidf', arrays)
+    t_artifact = time.perf_counter() - t0
+    print('written in %.1f s as pickles, %.1f s as an artifact' % (t_pickle, t_artifact))
+
+    ctx = multiprocessing.get_context('fork')
+    for name, load in [('pickles', load_pickles), ('artifact', load_artifact_service)]:
+        queue = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(load, d, queue)) for _ in range(NUM_PROCESSES)]
+        for p in procs:
+            p.start()
+        res = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+        print('%-8s %6.3f s to the first answer, %6.1f MB private memory per process (%d processes)' %
+              (name, max(t for t, _ in res), max(m for _, m in res), NUM_PROCESSES))
+
+
+if __name__ == '__main__':
+    main()
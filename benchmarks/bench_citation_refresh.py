@@ -0,0 +1,44 @@
+"""
+Citation refresh throughput against a local stub of the semantic scholar API that
+allows 10 requests/s and takes 200 ms per request. The refresher is configured to
+go twice as fast as allowed, so it has to back off on the 429s. The old loop did
+one request, two upserts per paper and a sleep(5) between papers, i.e. at most 0.2
+papers/s whatever the quota.
+"""
+import datetime
+import time
+
+import mongomock
+
+import fetch_citations_and_references as fcr
+from benchmarks.common import StubSemSchAPI, CountingCollection
+
+NUM_PAPERS = 300
+
+
+def main():
+    api = StubSemSchAPI(latency=0.2, rate_limit=10)
+    db = mongomock.MongoClient().arxiv
+    now = datetime.datetime.utcnow()
+    db.papers.insert_many([{'_id': '1901.%05d' % i, 'title': 'Paper %d' % i, 'authors': [{'name': 'A %d' % i}],
+                            'time_updated': now, 'time_published': now} for i in range(NUM_PAPERS)])
+    db.sem_sch_papers.insert_many([{'_id': '1901.%05d' % i, 'last_rec_update': now} for i in range(0, NUM_PAPERS, 3)])
+    fcr.db_papers = db.papers
+    fcr.sem_sch_papers = CountingCollection(db.sem_sch_papers)
+    fcr.sem_sch_authors = CountingCollection(db.sem_sch_authors)
+
+    t0 = time.perf_counter()
+    fcr.update_all_papers(base_url=api.url, rate=20, num_workers=4, timeout=(1, 5), increase=0.1)
+    elapsed = time.perf_counter() - t0
+    num_fetched = sum(api.hits.values())
+    assert num_fetched == NUM_PAPERS - len(range(0, NUM_PAPERS, 3))
+    assert db.sem_sch_papers.count_documents({'found': 1}) == num_fetched
+    print('%d stale papers refreshed in %.1f s: %.1f papers/s (stub quota 10/s), %d requests throttled' %
+          (num_fetched, elapsed, num_fetched / elapsed, api.throttled))
+    print('mongo writes: %d round trips for the papers, %d for the authors' %
+          (fcr.sem_sch_papers.round_trips - 1, fcr.sem_sch_authors.round_trips))
+    api.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Cold read of a corpus of 20000 text files of ~20KB: the old analyze.py (stat every
+file, then open and read every file) versus iterating over a CorpusStore, without
+and with zlib compression. The page cache is dropped before every run with
+posix_fadvise(DONTNEED) on the files involved. Also reports the store size, the
+one-off packing time and the time of a pack_txt_dir run with nothing new.
+"""
+import os
+import random
+import tempfile
+import time
+
+from corpus_store import CorpusStore, pack_txt_dir
+
+NUM_DOCS = 20000
+WORDS = ['network', 'learning', 'model', 'training', 'results', 'the', 'of', 'a', 'we', 'show', 'propose', 'deep',
+         'image', 'loss', 'function', 'data', 'set', 'performance', 'method', 'approach', 'convolutional', 'layer']
+
+
+def drop_cache(paths):
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def read_before(txt_dir, keys):
+    """ list_txt_files and make_corpus of the old analyze.py """
+    paths = []
+    for k in keys:
+        p = os.path.join(txt_dir, k + '.pdf.txt')
+        st = os.stat(p)
+        if 1000 < st.st_size < 500000:
+            paths.append(p)
+    n = 0
+    for p in paths:
+        with open(p, 'rb') as f: # bytes, like the store yields
+            n += len(f.read())
+    return n
+
+
+def main():
+    rng = random.Random(1337)
+    txt_dir = tempfile.mkdtemp()
+    keys = ['1901.%05dv1' % i for i in range(NUM_DOCS)]
+    for k in keys:
+        with open(os.path.join(txt_dir, k + '.pdf.txt'), 'w') as f:
+            f.write(' '.join(rng.choice(WORDS) for _ in range(rng.randint(2000, 4000))))
+    txt_paths = [os.path.join(txt_dir, k + '.pdf.txt') for k in keys]
+    total = sum(os.path.getsize(p) for p in txt_paths)
+
+    drop_cache(txt_paths)
+    t0 = time.perf_counter()
+    read_before(txt_dir, keys)
+    t = time.perf_counter() - t0
+    print('before   %5.2f s cold, %4.0f MB/s, %d files' % (t, total / t / 1e6, len(txt_paths)))
+
+    for codec in ['none', 'zlib']:
+        store_dir = tempfile.mkdtemp()
+        store = CorpusStore(store_dir, codec=codec)
+        t0 = time.perf_counter()
+        pack_txt_dir(store, txt_dir)
+        t_pack = time.perf_counter() - t0
+        store.close()
+        shards = [os.path.join(store_dir, f) for f in os.listdir(store_dir)]
+        size = sum(os.path.getsize(p) for p in shards)
+
+        drop_cache(shards)
+        t0 = time.perf_counter()
+        store = CorpusStore(store_dir)
+        n = sum(len(txt) for _, txt in store.iter_texts())
+        t = time.perf_counter() - t0
+        assert n == total
+        t0 = time.perf_counter()
+        assert pack_txt_dir(store, txt_dir) == (0, 0)
+        t_repack = time.perf_counter() - t0
+        store.close()
+        print('store %-4s %5.2f s cold, %4.0f MB/s, %3.0f MB on disk (%.0f MB of text), packed in %.1f s, '
+              'nothing new to pack in %.2f s' % (codec, t, total / t / 1e6, size / 1e6, total / 1e6, t_pack, t_repack))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Mongo round trips needed to fetch the discussion counts of a listing page,
+per-paper count() versus the batched DiscussionCounts.
+"""
+import random
+
+import mongomock
+
+from benchmarks.common import CountingCollection, timeit
+from discussion_counts import DiscussionCounts
+
+NUM_PAPERS = 200  # default --num_results of serve.py
+
+
+def main():
+    random.seed(1337)
+    comments = mongomock.MongoClient().arxiv.comments
+    pids = ['%04d.%05d' % (1800 + i // 100000, i % 100000) for i in range(5000)]
+    comments.insert_many([{'pid': random.choice(pids), 'text': 'x'} for _ in range(20000)])
+    page = pids[:NUM_PAPERS]
+    counting = CountingCollection(comments)
+
+    def before():
+        return {pid: counting.count_documents({'pid': pid}) for pid in page}
+
+    counting.reset()
+    old_counts = before()
+    old_trips = counting.round_trips
+    old_time = timeit(before)
+
+    counts = DiscussionCounts(counting)
+    counting.reset()
+    new_counts = counts.get_many(page)
+    cold_trips = counting.round_trips
+    counting.reset()
+    counts.get_many(page)
+    warm_trips = counting.round_trips
+    counts.invalidate()
+    new_time = timeit(lambda: (counts.invalidate(), counts.get_many(page)))
+
+    assert old_counts == new_counts
+    print('page of %d papers' % (NUM_PAPERS, ))
+    print('before: %d round trips per request, %.1f ms' % (old_trips, old_time * 1000))
+    print('after:  %d round trips cold, %d warm, %.1f ms cold' % (cold_trips, warm_trips, new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
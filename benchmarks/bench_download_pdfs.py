@@ -0,0 +1,131 @@
+"""
+Downloads 200 fixture pdfs from a local http server that takes 0.1 s per request:
+the old sequential urlopen loop of download_pdfs.py versus PdfDownloader. One in
+20 urls answers an html error page, one a truncated pdf, and one fails with a 500
+the first time. Reports the wall clock time, the tcp connections opened and the
+broken pdfs left on disk, then checks that a second run only retries the
+failures.
+"""
+import http.server
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+from download_pdfs import PdfDownloader, check_pdf_file, BadPdf, OK
+from utils import Manifest
+
+NUM_PDFS = 200
+LATENCY = 0.1
+PDF = b'%PDF-1.4\n' + os.urandom(64 * 1024) + b'\n%%EOF\n'
+
+
+class FixturePdfServer(object):
+
+    def __init__(self, latency):
+        self.requests = 0
+        self.connections = 0
+        self.served_500 = set()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(latency)
+                i = int(self.path.split('/')[-1].split('v')[0].split('.')[1])
+                status, body, length = 200, PDF, len(PDF)
+                if i % 20 == 0:
+                    body, length = b'<html>' + b'rate limited, try later ' * 100 + b'</html>', None
+                elif i % 20 == 1:
+                    body, length = PDF[:len(PDF) // 2], len(PDF) # the connection drops half way
+                elif i % 20 == 2 and i not in server.served_500:
+                    server.served_500.add(i)
+                    status, body = 500, b'internal error'
+                self.send_response(status)
+                self.send_header('Content-Length', str(length or len(body)))
+                if length and length != len(body):
+                    self.send_header('Connection', 'close')
+                    self.close_connection = True
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/pdf/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        self.requests = self.connections = 0
+
+
+def download_before(urls, pdf_dir):
+    """ the old loop of download_pdfs.py """
+    for pdf_url in urls:
+        fname = os.path.join(pdf_dir, pdf_url.split('/')[-1])
+        try:
+            req = urlopen(pdf_url, None, 10)
+            with open(fname, 'wb') as fp:
+                shutil.copyfileobj(req, fp)
+            time.sleep(0.05 + random.uniform(0, 0.1))
+        except Exception as e:
+            pass
+
+
+def broken_pdfs(pdf_dir):
+    n = 0
+    for f in os.listdir(pdf_dir):
+        if not f.endswith('.pdf'):
+            continue
+        try:
+            check_pdf_file(os.path.join(pdf_dir, f))
+        except BadPdf:
+            n += 1
+    return n
+
+
+def main():
+    server = FixturePdfServer(LATENCY)
+    urls = [server.url + '1901.%05dv1.pdf' % i for i in range(NUM_PDFS)]
+
+    pdf_dir = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    download_before(urls, pdf_dir)
+    print('before %5.1f s, %3d requests, %3d connections, %d files, %d of them broken' %
+          (time.perf_counter() - t0, server.requests, server.connections, len(os.listdir(pdf_dir)),
+           broken_pdfs(pdf_dir)))
+
+    server.reset()
+    server.served_500 = set()
+    pdf_dir = tempfile.mkdtemp()
+    manifest_path = os.path.join(pdf_dir, 'manifest.json')
+    downloader = PdfDownloader(Manifest(manifest_path), pdf_dir=pdf_dir, rate=100, num_workers=8, backoff=0)
+    t0 = time.perf_counter()
+    stats = downloader.run(urls)
+    print('after  %5.1f s, %3d requests, %3d connections, %d files, %d of them broken, %s' %
+          (time.perf_counter() - t0, server.requests, server.connections, len(os.listdir(pdf_dir)) - 1,
+           broken_pdfs(pdf_dir), dict(stats)))
+
+    # a new run retries the failures only (their backoff is 0 here), the flaky ones succeed
+    server.reset()
+    downloader = PdfDownloader(Manifest(manifest_path), pdf_dir=pdf_dir, rate=100, num_workers=8)
+    stats = downloader.run(urls)
+    print('rerun  %3d requests, %s' % (server.requests, dict(stats)))
+    assert server.requests == 3 * NUM_PDFS // 20
+    manifest = Manifest(manifest_path)
+    assert sum(r['status'] == OK for r in manifest.entries.values()) == NUM_PDFS - 2 * NUM_PDFS // 20
+    assert all(r['attempts'] == 2 for r in manifest.entries.values() if r['status'] != OK)
+
+
+if __name__ == '__main__':
+    main()
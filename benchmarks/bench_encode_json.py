@@ -0,0 +1,66 @@
+"""
+Per-paper cost of building the json struct of the listing pages, re-parsing
+the raw feed fields on every request versus copying the precomputed card.
+"""
+import dateutil.parser
+
+from benchmarks.common import timeit
+from paper_views import build_card, encode_paper
+
+NUM_PAPERS = 200
+
+
+def make_paper(i):
+    return {
+        '_rawid': '1901.%05d' % i, '_version': 2, 'title': 'A paper about things %d' % i,
+        'arxiv_primary_category': {'term': 'cs.LG'}, 'link': 'http://arxiv.org/abs/1901.%05dv2' % i,
+        'authors': [{'name': 'Author %d' % j} for j in range(6)],
+        'tags': [{'term': t, 'scheme': 'http://arxiv.org/schemas/atom', 'label': None} for t in ['cs.LG', 'stat.ML']],
+        'updated': '2019-01-%02dT18:59:59Z' % (i % 28 + 1), 'published': '2019-01-%02dT10:00:00Z' % (i % 28 + 1),
+        'arxiv_comment': 'Accepted to a conference. ' * 10, 'summary': 'We propose things. ' * 50,
+    }
+
+
+def encode_paper_before(p, in_library=False, num_discussion=0):
+    """ the per-paper body of serve.encode_json before the cards """
+    idvv = '%sv%d' % (p['_rawid'], p['_version'])
+    struct = {}
+    struct['title'] = p['title']
+    struct['pid'] = idvv
+    struct['rawpid'] = p['_rawid']
+    struct['category'] = p['arxiv_primary_category']['term']
+    struct['authors'] = [a['name'] for a in p['authors']]
+    struct['link'] = p['link']
+    struct['in_library'] = 1 if in_library else 0
+    struct['abstract'] = p['summary']
+    struct['tags'] = [t['term'] for t in p['tags']]
+    struct['hype_score'] = p.get('hype_score', 0)
+    timestruct = dateutil.parser.parse(p['updated'])
+    struct['published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
+    timestruct = dateutil.parser.parse(p['published'])
+    struct['originally_published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
+    struct['twtr_score_dec'] = p.get('twtr_score_dec', 0)
+    struct['twtr_score'] = p.get('twtr_score', 0)
+    struct['twtr_links'] = p.get('twtr_links', [])
+    struct['num_discussion'] = num_discussion
+    cc = p.get('arxiv_comment', '')
+    if len(cc) > 100:
+        cc = cc[:100] + '...'
+    struct['comment'] = cc
+    return struct
+
+
+def main():
+    papers = [make_paper(i) for i in range(NUM_PAPERS)]
+    for p in papers:
+        p['card'] = build_card(p)
+    assert all(encode_paper_before(p) == encode_paper(p) for p in papers)
+
+    t_before = timeit(lambda: [encode_paper_before(p) for p in papers])
+    t_after = timeit(lambda: [encode_paper(p) for p in papers])
+    print('before: %.1f us per paper' % (t_before / NUM_PAPERS * 1e6, ))
+    print('after:  %.1f us per paper' % (t_after / NUM_PAPERS * 1e6, ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Wall clock time to fetch 3000 papers (15 pages) from a local stub of the arxiv
+API that takes 1 s per page, with a 1 s politeness delay: the old sequential loop
+(download, parse, write, sleep) versus the pipelined fetch_papers_main, whose
+floor is one delay per page. Also checks that a run interrupted half way resumes
+from its checkpoint.
+"""
+import http.server
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import feedparser
+import mongomock
+
+import fetch_papers
+from benchmarks.bench_ingest import make_entry
+
+NUM_PAPERS = 3000
+PAGE_SIZE = 200
+LATENCY = 1.0
+WAIT_TIME = 1.0
+
+
+def atom_entry(e):
+    authors = ''.join('<author><name>%s</name></author>' % a['name'] for a in e['authors'])
+    tags = ''.join('<category term="%s" scheme="http://arxiv.org/schemas/atom"/>' % t['term'] for t in e['tags'])
+    return ('<entry><id>%s</id><updated>%s</updated><published>%s</published><title>%s</title>'
+            '<summary>%s</summary>%s<arxiv:comment>%s</arxiv:comment><link href="%s" rel="alternate" type="text/html"/>'
+            '<link title="pdf" href="%s" rel="related" type="application/pdf"/>'
+            '<arxiv:primary_category term="cs.LG" scheme="http://arxiv.org/schemas/atom"/>%s</entry>' %
+            (e['id'], e['updated'], e['published'], e['title'], e['summary'], authors, e['arxiv_comment'], e['link'],
+             e['link'].replace('/abs/', '/pdf/'), tags))
+
+
+class StubArxivAPI(object):
+
+    def __init__(self, num_papers, latency):
+        entries = [make_entry(i, 1) for i in range(num_papers)]
+        for i, e in enumerate(entries): # newest first, like sortBy=lastUpdatedDate
+            e['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1.6e9 - i * 60))
+        self.entries = [atom_entry(e) for e in entries]
+        self.requests = 0
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                q = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                start, num = int(q['start'][0]), int(q['max_results'][0])
+                api.requests += 1
+                time.sleep(latency)
+                body = ('<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom" '
+                        'xmlns:arxiv="http://arxiv.org/schemas/atom">%s</feed>' %
+                        ''.join(api.entries[start:start + num])).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/atom+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api/query?' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def fetch_before(base_url):
+    """ the old fetch_papers_main loop, without the early exit """
+    for i in range(0, NUM_PAPERS, PAGE_SIZE):
+        query = 'search_query=all&sortBy=lastUpdatedDate&start=%i&max_results=%i' % (i, PAGE_SIZE)
+        with urllib.request.urlopen(base_url + query) as url:
+            entries = feedparser.parse(url.read()).entries
+        fetch_papers.ingest_entries(entries)
+        time.sleep(WAIT_TIME)
+
+
+def main():
+    api = StubArxivAPI(NUM_PAPERS, LATENCY)
+    os.chdir(tempfile.mkdtemp()) # the checkpoint file
+    fetch_papers.update_search_index = lambda added: None
+
+    fetch_papers.mdb = mongomock.MongoClient().arxiv
+    t0 = time.perf_counter()
+    fetch_before(api.url)
+    t_before = time.perf_counter() - t0
+
+    fetch_papers.mdb = mongomock.MongoClient().arxiv
+    t0 = time.perf_counter()
+    fetch_papers.fetch_papers_main(max_index=NUM_PAPERS, wait_time=WAIT_TIME, jitter=0, search_query='all',
+                                   base_url=api.url)
+    t_after = time.perf_counter() - t0
+    assert fetch_papers.mdb.papers.count_documents({}) == NUM_PAPERS
+    print('%d papers, %.0f s per page and %.0f s delay: before %.1f s, after %.1f s (floor %.1f s)' %
+          (NUM_PAPERS, LATENCY, WAIT_TIME, t_before, t_after, (NUM_PAPERS // PAGE_SIZE - 1) * WAIT_TIME + LATENCY))
+
+    # interrupted after 5 pages, then resumed: only the remaining pages are downloaded
+    fetch_papers.mdb = mongomock.MongoClient().arxiv
+    os.remove(fetch_papers.Config.fetch_checkpoint_path)
+    ingest = fetch_papers.ingest_entries
+    pages = []
+
+    def crashing_ingest(entries, added=None):
+        if len(pages) == 5:
+            raise RuntimeError('crash')
+        pages.append(1)
+        return ingest(entries, added)
+
+    fetch_papers.ingest_entries = crashing_ingest
+    fetch_papers.fetch_papers_main(max_index=NUM_PAPERS, wait_time=0.1, jitter=0, search_query='all', base_url=api.url)
+    fetch_papers.ingest_entries = ingest
+    requests_before = api.requests
+    fetch_papers.fetch_papers_main(max_index=NUM_PAPERS, wait_time=0.1, jitter=0, search_query='all', base_url=api.url)
+    assert fetch_papers.mdb.papers.count_documents({}) == NUM_PAPERS
+    print('resumed run downloaded %d pages out of %d' % (api.requests - requests_before, NUM_PAPERS // PAGE_SIZE))
+
+
+if __name__ == '__main__':
+    main()
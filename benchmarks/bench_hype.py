@@ -0,0 +1,73 @@
+"""
+/oldhype ranking over a synthetic collection of a million tweets: the old per
+request python loop (tweet_score on every tweet of the window, then a dict sum per
+paper) versus the HypeWindows rows maintained by the twitter daemon.
+"""
+import argparse
+import time
+from collections import defaultdict
+from math import log10
+
+import numpy as np
+
+from benchmarks.common import timeit
+from hype import HypeWindows, HYPE_WINDOWS, MAX_DAYS
+
+
+def tweet_score(t):
+    # the scoring serve.py did per tweet and per request
+    followers_score = max(log10(t['user_followers_count'] + 1), 1)
+    return (t['likes'] + 2 * t['retweets']) * (t.get('replies', 0) * 4 + 0.5) / followers_score
+
+
+def make_tweets(n, num_papers, now, rng):
+    times = now - rng.uniform(0, MAX_DAYS * 86400, size=n)
+    likes, retweets, replies = rng.zipf(2.0, size=n), rng.zipf(2.5, size=n) - 1, rng.poisson(0.3, size=n)
+    followers = rng.zipf(1.5, size=n)
+    papers = rng.zipf(1.3, size=(n, 2)) % num_papers
+    npids = rng.randint(1, 3, size=n)
+    return [{'_id': str(i), 'pids': ['%d.%05d' % (1900 + p // 100000, p % 100000) for p in papers[i, :npids[i]]],
+             'created_at_time': float(times[i]), 'likes': int(likes[i]), 'retweets': int(retweets[i]),
+             'replies': int(replies[i]), 'user_followers_count': int(followers[i])} for i in range(n)]
+
+
+def old_oldhype(tweets, now, days):
+    new_tweets = [t for t in tweets if t['created_at_time'] > now - days * 86400] # the mongo query
+    scores = list(map(tweet_score, new_tweets))
+    papers_scores = defaultdict(int)
+    for t, score in zip(new_tweets, scores):
+        for p in t.get('pids', []):
+            papers_scores[p] += score
+    return sorted(papers_scores.items(), key=lambda x: x[1], reverse=True)[:100]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-tweets', type=int, default=1000000)
+    parser.add_argument('--num-papers', type=int, default=200000)
+    args = parser.parse_args()
+    rng = np.random.RandomState(1337)
+    now = time.time()
+    tweets = make_tweets(args.num_tweets, args.num_papers, now, rng)
+
+    t0 = time.perf_counter()
+    hw = HypeWindows()
+    hw.update(tweets, now)
+    print('built %d tweet rows in %.2f s' % (len(hw), time.perf_counter() - t0))
+    batch = tweets[:500] # a daemon run re-scores a few hundred fetched tweets
+    t_update = timeit(lambda: (hw.update(batch, now), hw.rankings(now)), repeat=3)
+    rankings = hw.rankings(now)
+
+    old = old_oldhype(tweets, now, HYPE_WINDOWS['2weeks'])
+    new_pids, new_scores = rankings['2weeks']
+    assert [p for p, _ in old[:20]] == new_pids[:20]
+    assert np.allclose([s for _, s in old], new_scores)
+
+    t_old = timeit(lambda: old_oldhype(tweets, now, HYPE_WINDOWS['2weeks']), repeat=3)
+    print('before: %.0f ms per /oldhype?timefilter=2weeks request (scoring only, without the mongo reads)' % (t_old * 1000))
+    print('after:  %.0f ms per daemon run (500 tweets updated, all windows re-ranked), '
+          'requests read a stored top 100' % (t_update * 1000))
+
+
+if __name__ == '__main__':
+    main()
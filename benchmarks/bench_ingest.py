@@ -0,0 +1,78 @@
+"""
+Mongo round trips to ingest a page of 200 arxiv feed entries, the old per entry
+find/update/author updates versus the batched fetch_papers.ingest_entries, on a
+page where half the papers are new, a quarter are new versions and a quarter are
+already known.
+"""
+import mongomock
+
+from benchmarks.common import CountingCollection, timeit
+from fetch_papers import ingest_entries, parse_entry
+
+PAGE_SIZE = 200
+
+
+def make_entry(i, version):
+    rawid = '1901.%05d' % i
+    link = 'http://arxiv.org/abs/%sv%d' % (rawid, version)
+    title = 'A paper about things %d' % i
+    summary = 'We propose things and show that they work on many benchmarks. ' * 20
+    authors = [{'name': 'Author %d' % (i * 7 % 50 + j)} for j in range(5)]
+    return {
+        'id': link, 'guidislink': True, 'link': link,
+        'updated': '2019-01-%02dT18:59:59Z' % (i % 28 + 1), 'published': '2019-01-%02dT10:00:00Z' % (i % 28 + 1),
+        'title': title, 'title_detail': {'type': 'text/plain', 'language': None, 'base': '', 'value': title},
+        'summary': summary, 'summary_detail': {'type': 'text/plain', 'language': None, 'base': '', 'value': summary},
+        'authors': authors, 'author_detail': authors[-1], 'author': authors[-1]['name'],
+        'arxiv_comment': '10 pages, 4 figures',
+        'links': [{'href': link, 'rel': 'alternate', 'type': 'text/html'},
+                  {'title': 'pdf', 'href': link.replace('abs', 'pdf'), 'rel': 'related', 'type': 'application/pdf'}],
+        'arxiv_primary_category': {'term': 'cs.LG', 'scheme': 'http://arxiv.org/schemas/atom'},
+        'tags': [{'term': t, 'scheme': 'http://arxiv.org/schemas/atom', 'label': None} for t in ['cs.LG', 'stat.ML']],
+    }
+
+
+def ingest_before(entries, papers, authors):
+    """ the per entry body of fetch_papers.fetch_entries before the bulk writes """
+    num_added = num_skipped = 0
+    for e in entries:
+        j = parse_entry(e)
+        rawid = j['_rawid']
+        cur_id = {'_id': rawid}
+        cur_paper = list(papers.find(cur_id))
+        if not cur_paper or '_version' not in cur_paper[0] or j['_version'] > cur_paper[0]['_version']:
+            papers.update_one(cur_id, {'$set': j}, upsert=True)
+            num_added += 1
+        else:
+            num_skipped += 1
+        if not cur_paper:
+            for a in j['authors']:
+                authors.update_one({'_id': a['name']}, {'$addToSet': {'papers': rawid}}, upsert=True)
+    return num_added, num_skipped
+
+
+def setup():
+    db = mongomock.MongoClient().arxiv
+    known = [make_entry(i, 1) for i in range(PAGE_SIZE // 2)]
+    ingest_entries(known, papers=db.papers, authors=db.authors)
+    page = [make_entry(i, 2 if i < PAGE_SIZE // 4 else 1) for i in range(PAGE_SIZE)]
+    return db, page
+
+
+def main():
+    results = {}
+    for name, ingest in [('before', lambda page, p, a: ingest_before(page, p, a)),
+                         ('after', lambda page, p, a: ingest_entries(page, papers=p, authors=a))]:
+        db, page = setup()
+        papers, authors = CountingCollection(db.papers), CountingCollection(db.authors)
+        counts = ingest(page, papers, authors)
+        results[name] = (counts, list(db.papers.find({}, {'_version': 1}).sort('_id')),
+                         list(db.authors.find().sort('_id')))
+        t = timeit(lambda: ingest(*(lambda d, pg: (pg, d.papers, d.authors))(*setup())), repeat=3)
+        print('%-6s %4d round trips per page of %d entries (%d added, %d skipped), %.0f ms with mongomock' %
+              (name, papers.round_trips + authors.round_trips, PAGE_SIZE, counts[0], counts[1], t * 1000))
+    assert results['before'] == results['after']
+
+
+if __name__ == '__main__':
+    main()
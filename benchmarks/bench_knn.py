@@ -0,0 +1,77 @@
+"""
+All-pairs top-50 neighbours as computed by analyze.py: the old dense
+X.todense() + argsort stage versus knn.all_pairs_topk on a sparse matrix.
+Peak memory is measured with tracemalloc, so with more than one worker it only
+covers the parent process; pass --workers 1 to see the full scratch memory.
+
+python -m benchmarks.bench_knn --sizes 10000 50000 200000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from knn import all_pairs_topk
+
+NUM_FEATURES = 5000
+NNZ_PER_DOC = 100
+K = 50
+MAX_DENSE_BYTES = 2**30 # don't run the old path when the dense X alone doesn't fit this
+
+
+def make_X(n, rng):
+    X = sp.random(n, NUM_FEATURES, density=NNZ_PER_DOC / NUM_FEATURES, format='csr', random_state=rng)
+    return normalize(X)
+
+
+def topk_dense(X):
+    """ the stage of analyze.py before knn.py """
+    X = X.todense()
+    out = np.empty((X.shape[0], K), dtype=np.int32)
+    batch_size = 200
+    for i in range(0, X.shape[0], batch_size):
+        i1 = min(X.shape[0], i + batch_size)
+        xquery = X[i:i1]
+        ds = -np.asarray(np.dot(X, xquery.T))
+        IX = np.argsort(ds, axis=0)
+        out[i:i1] = IX[:K].T
+    return out
+
+
+def measure(func):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    res = func()
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, dt, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 200000])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-memory-mb', type=int, default=512)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1337)
+    for n in args.sizes:
+        X = make_X(n, rng)
+        new, dt, peak = measure(lambda: all_pairs_topk(X, K, max_memory_mb=args.max_memory_mb,
+                                                       num_workers=args.workers, log=lambda s: None))
+        print('N=%-7d sparse: %8.1f s, peak %7.1f MB' % (n, dt, peak / 2**20))
+        if n * NUM_FEATURES * 8 > MAX_DENSE_BYTES:
+            print('N=%-7d dense:  skipped, needs %.1f GB for X alone' % (n, n * NUM_FEATURES * 8 / 2**30))
+            continue
+        old, dt, peak = measure(lambda: topk_dense(X))
+        same = np.mean([set(a) == set(b) for a, b in zip(old, new)])
+        print('N=%-7d dense:  %8.1f s, peak %7.1f MB, same neighbours for %.1f%% of docs' %
+              (n, dt, peak / 2**20, same * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+BSON size of the paper documents and CPU time to turn a page of 200 parsed feed
+entries into documents: the old verbatim copy of the feedparser entries
+(encode_feedparser_dict) versus the schema driven paper_schema.normalize_entry.
+Also checks that migrate_papers.py turns the old documents into the new ones.
+"""
+import dateutil.parser
+import feedparser
+import mongomock
+from bson import BSON
+
+from benchmarks.bench_fetch_pipeline import atom_entry
+from benchmarks.bench_ingest import make_entry
+from benchmarks.common import timeit
+from fetch_papers import parse_entry
+from paper_schema import parse_arxiv_url
+from paper_views import build_card, projection
+
+PAGE_SIZE = 200
+
+
+def encode_feedparser_dict(d):
+    """ the deep copy fetch_papers.py used to store """
+    if isinstance(d, feedparser.FeedParserDict) or isinstance(d, dict):
+        return {k: encode_feedparser_dict(d[k]) for k in d.keys()}
+    elif isinstance(d, list):
+        return [encode_feedparser_dict(k) for k in d]
+    return d
+
+
+def parse_entry_before(e):
+    j = encode_feedparser_dict(e)
+    rawid, version = parse_arxiv_url(j['id'])
+    j['_rawid'] = rawid
+    j['_version'] = version
+    j['time_updated'] = dateutil.parser.parse(j['updated'])
+    j['time_published'] = dateutil.parser.parse(j['published'])
+    j['card'] = build_card(j, j['time_updated'], j['time_published'])
+    return j
+
+
+def bson_size(docs):
+    return sum(len(BSON.encode(dict(d, _id=d['_rawid']))) for d in docs) / len(docs)
+
+
+def main():
+    feed = ('<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom" '
+            'xmlns:arxiv="http://arxiv.org/schemas/atom">%s</feed>' %
+            ''.join(atom_entry(make_entry(i, 1)) for i in range(PAGE_SIZE)))
+    entries = feedparser.parse(feed).entries
+    before = [parse_entry_before(e) for e in entries]
+    after = [parse_entry(e) for e in entries]
+    for name, parse, docs in [('before', parse_entry_before, before), ('after', parse_entry, after)]:
+        t = timeit(lambda: [parse(e) for e in entries], repeat=5)
+        card = [len(BSON.encode({'_id': 1, 'card': d['card']})) for d in docs]
+        print('%-6s %5.0f bytes per paper (%d without the card), %d fields, %.1f ms per page of %d entries' %
+              (name, bson_size(docs), bson_size(docs) - sum(card) / len(card), len(docs[0]) + 1, t * 1000,
+               PAGE_SIZE))
+    assert [d['card'] for d in before] == [d['card'] for d in after]
+
+    # the old documents migrated equal the new ones, minus the fields other jobs add
+    import migrate_papers
+    db = mongomock.MongoClient().arxiv
+    db.papers.insert_many([dict(d, _id=d['_rawid'], twtr_score=1) for d in before])
+    migrate_papers.migrate_papers(db.papers)
+    migrated = list(db.papers.find({}, {'twtr_score': 0}).sort('_id'))
+    expected = [dict(d, _id=d['_rawid']) for d in after]
+    for d in migrated + expected: # mongo stores naive utc datetimes
+        d['time_updated'] = d['time_updated'].replace(tzinfo=None)
+        d['time_published'] = d['time_published'].replace(tzinfo=None)
+    assert migrated == expected
+    assert db.papers.count_documents({'twtr_score': 1}) == PAGE_SIZE
+    assert list(db.papers.find({}, projection('detail')))[0].keys() == migrated[0].keys() | {'twtr_score'}
+    print('migrated %d documents of the old layout' % len(migrated))
+
+
+if __name__ == '__main__':
+    main()
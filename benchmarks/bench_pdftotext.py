@@ -0,0 +1,64 @@
+"""
+Text extraction throughput on 200 fixture pdfs of 10 pages: the old one at a time
+os.system loop of parse_pdf_to_text.py versus TextExtractor with 1 worker and
+with one worker per core. Then checks that a rerun converts nothing and that only
+a changed pdf is converted again. Needs pdftotext.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.common import make_pdf
+from parse_pdf_to_text import TextExtractor, OK
+from utils import Manifest
+
+NUM_PDFS = 200
+
+
+def extract_before(pdf_dir, txt_dir):
+    """ the old loop of parse_pdf_to_text.py """
+    for f in os.listdir(pdf_dir):
+        pdf_path = os.path.join(pdf_dir, f)
+        txt_path = os.path.join(txt_dir, f + '.txt')
+        os.system("pdftotext %s %s" % (pdf_path, txt_path))
+        if not os.path.isfile(txt_path):
+            os.system('touch ' + txt_path)
+
+
+def main():
+    if not shutil.which('pdftotext'):
+        print('this benchmark needs pdftotext')
+        sys.exit()
+    pdf_dir = tempfile.mkdtemp()
+    pdf = make_pdf(num_pages=10)
+    for i in range(NUM_PDFS):
+        with open(os.path.join(pdf_dir, '1901.%05dv1.pdf' % i), 'wb') as f:
+            f.write(pdf)
+
+    txt_dir = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    extract_before(pdf_dir, txt_dir)
+    print('before            %6.1f pdfs/s' % (NUM_PDFS / (time.perf_counter() - t0)))
+
+    for num_workers in sorted({1, os.cpu_count()}):
+        txt_dir = tempfile.mkdtemp()
+        manifest_path = os.path.join(txt_dir, 'manifest.json')
+        extractor = TextExtractor(Manifest(manifest_path), pdf_dir=pdf_dir, txt_dir=txt_dir, num_workers=num_workers)
+        t0 = time.perf_counter()
+        stats = extractor.run()
+        print('after, %2d workers %6.1f pdfs/s, %s' % (num_workers, NUM_PDFS / (time.perf_counter() - t0), dict(stats)))
+        assert stats[OK] == NUM_PDFS
+
+    stats = TextExtractor(Manifest(manifest_path), pdf_dir=pdf_dir, txt_dir=txt_dir).run()
+    assert stats == {'unchanged': NUM_PDFS}, stats
+    with open(os.path.join(pdf_dir, '1901.00000v1.pdf'), 'wb') as f:
+        f.write(make_pdf(num_pages=3))
+    stats = TextExtractor(Manifest(manifest_path), pdf_dir=pdf_dir, txt_dir=txt_dir).run()
+    assert stats == {'unchanged': NUM_PDFS - 1, OK: 1}, stats
+    print('reruns: nothing converted, then only the changed pdf')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Bytes read from mongo by the listing routes, whole paper documents versus the
+named projections of paper_views.py. Sizes are the BSON sizes of the returned
+documents, on papers shaped like the ones fetch_papers.py stores.
+"""
+import datetime
+
+import bson
+import mongomock
+
+from paper_views import build_card, projection
+
+NUM_PAPERS = 2000
+
+
+def make_paper(i):
+    rawid = '1901.%05d' % i
+    link = 'http://arxiv.org/abs/%sv2' % rawid
+    title = 'A paper about things %d' % i
+    summary = 'We propose things and show that they work on many benchmarks. ' * 20
+    authors = [{'name': 'Author %d' % j} for j in range(6)]
+    p = {
+        '_id': rawid, '_rawid': rawid, '_version': 2, 'id': link, 'guidislink': True, 'link': link,
+        'updated': '2019-01-%02dT18:59:59Z' % (i % 28 + 1), 'published': '2019-01-%02dT10:00:00Z' % (i % 28 + 1),
+        'updated_parsed': [2019, 1, i % 28 + 1, 18, 59, 59, 0, 1, 0],
+        'published_parsed': [2019, 1, i % 28 + 1, 10, 0, 0, 0, 1, 0],
+        'title': title, 'title_detail': {'type': 'text/plain', 'language': None, 'base': '', 'value': title},
+        'summary': summary, 'summary_detail': {'type': 'text/plain', 'language': None, 'base': '', 'value': summary},
+        'authors': authors, 'author_detail': authors[-1], 'author': authors[-1]['name'],
+        'arxiv_comment': '10 pages, 4 figures',
+        'links': [{'href': link, 'rel': 'alternate', 'type': 'text/html'},
+                  {'title': 'pdf', 'href': link.replace('abs', 'pdf'), 'rel': 'related', 'type': 'application/pdf'}],
+        'arxiv_primary_category': {'term': 'cs.LG', 'scheme': 'http://arxiv.org/schemas/atom'},
+        'tags': [{'term': t, 'scheme': 'http://arxiv.org/schemas/atom', 'label': None} for t in ['cs.LG', 'stat.ML']],
+        'time_updated': datetime.datetime(2019, 1, i % 28 + 1), 'time_published': datetime.datetime(2019, 1, i % 28 + 1),
+    }
+    if i % 10 == 0:
+        p.update(twtr_score=i, twtr_score_dec=i / 2, twtr_links=[
+            {'tname': 'user%d' % j, 'tid': str(10 ** 17 + j), 'rt': j, 'name': 'User %d' % j, 'likes': 3 * j,
+             'replies': 0} for j in range(5)])
+    p['card'] = build_card(p)
+    return p
+
+
+def size(docs):
+    return sum(len(bson.encode(d)) for d in docs)
+
+
+def main():
+    papers = mongomock.MongoClient().arxiv.papers
+    papers.insert_many([make_paper(i) for i in range(NUM_PAPERS)])
+    pids = ['1901.%05d' % i for i in range(0, NUM_PAPERS, 7)][:200]
+
+    routes = [
+        ('/ (100 recent papers)', lambda proj: papers.find({}, proj).sort('time_published', -1).limit(100)),
+        ('/search, /library, ... (200 pids)', lambda proj: papers.find({'_id': {'$in': pids}}, proj)),
+        ('/toptwtr (200 papers)', lambda proj: papers.find({}, proj).sort('twtr_score', -1).limit(200)),
+    ]
+    print('%-36s %12s %12s' % ('route', 'before', 'after'))
+    for name, query in routes:
+        before, after = size(query(None)), size(query(projection('card+abstract')))
+        print('%-36s %9.1f KB %9.1f KB  (%.0f%%)' % (name, before / 1024, after / 1024, 100.0 * after / before))
+    one = {'_id': pids[0]}
+    before, after = size(papers.find(one)), size(papers.find(one, projection('detail')))
+    print('%-36s %9.1f KB %9.1f KB  (%.0f%%)' % ('/notes (1 paper)', before / 1024, after / 1024, 100.0 * after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+/search latency: the bm25 index of search_index.py on a synthetic corpus, and
+with --mongo, the same queries through mongo's $text index of the local arxiv
+db (python create_index.py must have been run). Also the cost of adding the
+papers of one fetch to the index file, rewriting it (before) versus appending
+to its delta segment.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from search_index import SearchIndex, update_search_index, delta_path
+
+VOCAB = ['neural', 'network', 'learning', 'deep', 'graph', 'attention', 'transformer', 'reinforcement', 'policy',
+         'gradient', 'adversarial', 'generative', 'image', 'segmentation', 'language', 'model', 'bayesian',
+         'inference', 'kernel', 'convolutional', 'recurrent', 'optimization', 'robust', 'sparse', 'embedding']
+VOCAB += ['w%d' % i for i in range(20000)]
+QUERIES = ['attention', 'graph neural network', 'deep reinforcement learning', 'adversarial robust',
+           'bayesian inference', 'image segmentation transformer', 'w123', 'sparse kernel optimization']
+
+
+def make_papers(n, rng):
+    weights = 1 / np.arange(1, len(VOCAB) + 1) # zipf like term distribution
+    weights /= weights.sum()
+    for i in range(n):
+        words = rng.choice(len(VOCAB), 160, p=weights)
+        yield {'_id': '19%02d.%05d' % (i // 100000, i % 100000),
+               'title': ' '.join(VOCAB[w] for w in words[:10]),
+               'authors': [{'name': 'Author %d' % rng.randint(50000)} for _ in range(4)],
+               'tags': [{'term': 'cs.LG'}],
+               'summary': ' '.join(VOCAB[w] for w in words[10:])}
+
+
+def latencies(func, queries, repeat=20):
+    ts = []
+    for _ in range(repeat):
+        for q in queries:
+            t0 = time.perf_counter()
+            func(q)
+            ts.append(time.perf_counter() - t0)
+    return np.percentile(ts, 50) * 1000, np.percentile(ts, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=50000)
+    parser.add_argument('--mongo', action='store_true')
+    args = parser.parse_args()
+    rng = np.random.RandomState(1337)
+
+    t0 = time.perf_counter()
+    index = SearchIndex.build(make_papers(args.num_docs, rng))
+    print('built an index of %d docs in %.1f s' % (args.num_docs, time.perf_counter() - t0))
+    path = os.path.join(tempfile.mkdtemp(), 'search_index.npz')
+    index.save(path)
+    t0 = time.perf_counter()
+    index = SearchIndex.load(path)
+    print('index file %.1f MB, loaded in %.2f s' % (os.path.getsize(path) / 2**20, time.perf_counter() - t0))
+
+    fetched = list(make_papers(500, np.random.RandomState(1)))
+    for p in fetched:
+        p['_id'] = p['_id'].replace('19', '20', 1)
+    t0 = time.perf_counter()
+    before = SearchIndex.load(path)
+    before.add(fetched)
+    before.save(path)
+    t_before = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    update_search_index(fetched, path)
+    t_after = time.perf_counter() - t0
+    print('adding %d fetched papers: %.2f s rewriting the index, %.3f s appending to the delta'
+          % (len(fetched), t_before, t_after))
+    os.remove(path)
+    os.remove(delta_path(path))
+
+    p50, p99 = latencies(lambda q: index.search(q, 50), QUERIES)
+    print('bm25:  p50 %.2f ms, p99 %.2f ms' % (p50, p99))
+
+    if args.mongo:
+        import pymongo
+        papers = pymongo.MongoClient().arxiv.papers
+        print('mongo collection of %d papers' % (papers.estimated_document_count(), ))
+
+        def text_search(q):
+            c = papers.find({'$text': {'$search': q}}, {'score': {'$meta': "textScore"}})
+            return list(c.sort([('score', {'$meta': 'textScore'})]).limit(50))
+        p50, p99 = latencies(text_search, QUERIES, repeat=3)
+        print('$text: p50 %.2f ms, p99 %.2f ms' % (p50, p99))
+
+
+if __name__ == '__main__':
+    main()
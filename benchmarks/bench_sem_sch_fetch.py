@@ -0,0 +1,50 @@
+"""
+/get_paper misses against a local stub of the semantic scholar API with 1 s of
+latency: 50 clients asking for the same new paper at once, then for an unknown
+one. Counts the upstream calls and how long a request thread is held.
+"""
+import threading
+import time
+
+from benchmarks.common import StubSemSchAPI
+from sem_sch_fetcher import SemSchFetcher, PENDING, FOUND, MISSING
+
+NUM_CLIENTS = 50
+
+
+def poll(fetcher, pid, held, outcomes):
+    while True:
+        t0 = time.perf_counter()
+        status, _ = fetcher.get(pid)
+        held.append(time.perf_counter() - t0)
+        if status != PENDING:
+            outcomes.append(status)
+            return
+        time.sleep(0.1)
+
+
+def main():
+    api = StubSemSchAPI(latency=1.0)
+    stored = []
+    fetcher = SemSchFetcher(stored.append, base_url=api.url, timeout=(1, 3))
+    for pid in ['1901.00001', 'missing.00001']:
+        held, outcomes = [], []
+        t0 = time.perf_counter()
+        clients = [threading.Thread(target=poll, args=(fetcher, pid, held, outcomes)) for _ in range(NUM_CLIENTS)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        print('%s: %d clients, %d upstream calls, outcomes %s, answered after %.2f s, '
+              'request thread held at most %.2f ms' % (pid, NUM_CLIENTS, api.hits[pid], set(outcomes),
+                                                       time.perf_counter() - t0, max(held) * 1000))
+    assert api.hits['1901.00001'] == 1 and len(stored) == 1
+    status, _ = fetcher.get('missing.00001')
+    assert status == MISSING and api.hits['missing.00001'] == 1 # negative cache
+    assert fetcher.get('1901.00001')[0] == FOUND
+    print('fetcher stats:', fetcher.stats)
+    api.close()
+
+
+if __name__ == '__main__':
+    main()
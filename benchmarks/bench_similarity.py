@@ -0,0 +1,41 @@
+"""
+Latency of SimilarityService.similar (the /<pid> route) on a synthetic
+100k paper tfidf matrix: precomputed neighbours, on-demand sparse dot product
+and LRU hits.
+"""
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from similarity import SimilarityService
+
+NUM_DOCS = 100000
+NUM_FEATURES = 5000
+DENSITY = 0.05  # ~250 non zero terms per paper
+
+
+def main():
+    rng = np.random.RandomState(1337)
+    X = normalize(sp.random(NUM_DOCS, NUM_FEATURES, density=DENSITY, format='csr', random_state=rng))
+    pids = ['19%02d.%05dv1' % (i // 100000, i % 100000) for i in range(NUM_DOCS)]
+    precomputed = pids[:NUM_DOCS // 2]
+    neighbours = np.full((NUM_DOCS, 50), -1, dtype=np.int32)
+    neighbours[:NUM_DOCS // 2] = np.arange(50)
+    service = SimilarityService(X, pids, neighbours)
+
+    def measure(name, queries):
+        t0 = time.perf_counter()
+        for q in queries:
+            service.similar(q)
+        print('%-12s %.3f ms per query' % (name, (time.perf_counter() - t0) / len(queries) * 1000))
+
+    on_demand = pids[NUM_DOCS // 2:NUM_DOCS // 2 + 50]
+    measure('precomputed', precomputed[:1000])
+    measure('on demand', on_demand)
+    measure('lru hit', on_demand)
+
+
+if __name__ == '__main__':
+    main()
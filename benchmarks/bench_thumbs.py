@@ -0,0 +1,69 @@
+"""
+Thumbnails per minute on 50 fixture pdfs of 10 pages: the old thumb_pdf.py (convert
+into a shared tmp dir polled for 20 s, then montage, one pdf at a time) versus
+ThumbnailRenderer with 1 worker and with one worker per core. Needs imagemagick
+and ghostscript.
+"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+from subprocess import Popen
+
+from benchmarks.common import make_pdf
+from thumb_pdf import ThumbnailRenderer, OK
+from utils import Manifest
+
+NUM_PDFS = 50
+
+
+def render_before(pdf_dir, thumbs_dir, tmp_dir):
+    """ the old loop of thumb_pdf.py """
+    for p in os.listdir(pdf_dir):
+        pdf_path = os.path.join(pdf_dir, p)
+        thumb_path = os.path.join(thumbs_dir, p + '.jpg')
+        for f in glob.glob(os.path.join(tmp_dir, 'thumb-*.png')):
+            os.remove(f)
+        pp = Popen(['convert', '%s[0-7]' % (pdf_path, ), '-thumbnail', 'x156', os.path.join(tmp_dir, 'thumb.png')])
+        t0 = time.time()
+        while time.time() - t0 < 20:
+            if pp.poll() is not None:
+                break
+            time.sleep(0.1)
+        if pp.poll() is None:
+            pp.terminate()
+        if os.path.isfile(os.path.join(tmp_dir, 'thumb-0.png')):
+            os.system("montage -mode concatenate -quality 80 -tile x1 %s %s" %
+                      (os.path.join(tmp_dir, 'thumb-*.png'), thumb_path))
+
+
+def main():
+    if not shutil.which('convert') or not shutil.which('gs'):
+        print('this benchmark needs imagemagick and ghostscript')
+        sys.exit()
+    pdf_dir = tempfile.mkdtemp()
+    pdf = make_pdf(num_pages=10)
+    for i in range(NUM_PDFS):
+        with open(os.path.join(pdf_dir, '1901.%05dv1.pdf' % i), 'wb') as f:
+            f.write(pdf)
+
+    thumbs_dir, tmp_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    render_before(pdf_dir, thumbs_dir, tmp_dir)
+    print('before            %6.1f thumbnails/minute' % (60 * len(os.listdir(thumbs_dir)) / (time.perf_counter() - t0)))
+
+    for num_workers in sorted({1, os.cpu_count()}):
+        thumbs_dir, tmp_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        renderer = ThumbnailRenderer(Manifest(os.path.join(tmp_dir, 'manifest.json')), pdf_dir=pdf_dir,
+                                     thumbs_dir=thumbs_dir, tmp_dir=tmp_dir, num_workers=num_workers)
+        t0 = time.perf_counter()
+        stats = renderer.run()
+        print('after, %2d workers %6.1f thumbnails/minute, %s' %
+              (num_workers, 60 * stats[OK] / (time.perf_counter() - t0), dict(stats)))
+        assert stats[OK] == NUM_PDFS
+
+
+if __name__ == '__main__':
+    main()
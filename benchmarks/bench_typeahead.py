@@ -0,0 +1,55 @@
+"""
+Per keystroke latency of the typeahead index (typeahead.py) with millions of
+synthetic author names, replaying every prefix of a few queries as they are typed.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from typeahead import TypeaheadIndex, ARXIV_AUTHOR, ARXIV_PAPER
+
+SYLLABLES = ['ka', 'ri', 'mo', 'an', 'li', 'zh', 'ang', 'wei', 'son', 'er', 'ta', 'ne', 'vo', 'lu', 'shi', 'go',
+             'pe', 'dra', 'kov', 'ich', 'el', 'ma', 'ra', 'jo', 'han', 'sen', 'ber', 'ger', 'ou', 'yu']
+QUERIES = ['wei zhang', 'yoshua bengio', 'kaiming he', 'attention is all', 'graph neural', 'li', 'maravich']
+
+
+def make_name(rng, n):
+    return ''.join(SYLLABLES[i] for i in rng.randint(len(SYLLABLES), size=n)).capitalize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-authors', type=int, default=2000000)
+    parser.add_argument('--num-papers', type=int, default=200000)
+    args = parser.parse_args()
+    rng = np.random.RandomState(1337)
+
+    index = TypeaheadIndex()
+    t0 = time.perf_counter()
+    for i in range(args.num_authors):
+        name = make_name(rng, rng.randint(2, 4)) + ' ' + make_name(rng, rng.randint(2, 5))
+        index.upsert(ARXIV_AUTHOR, i, name, rng.randint(1, 100))
+    for i in range(args.num_papers):
+        title = ' '.join(make_name(rng, rng.randint(1, 4)) for _ in range(8))
+        index.upsert(ARXIV_PAPER, i, title, i)
+    index.upsert(ARXIV_AUTHOR, 'wz', 'Wei Zhang', 500)
+    index.upsert(ARXIV_PAPER, 'aiayn', 'Attention Is All You Need', 1e9)
+    index.commit()
+    print('indexed %d entries in %.1f s' % (len(index), time.perf_counter() - t0))
+
+    ts = []
+    for q in QUERIES:
+        for i in range(2, len(q) + 1):
+            for kind in (ARXIV_AUTHOR, ARXIV_PAPER):
+                index._cache.clear() # measure the uncached path
+                t0 = time.perf_counter()
+                index.query(q[:i], kind, 10)
+                ts.append(time.perf_counter() - t0)
+    print('%d keystroke queries: p50 %.2f ms, p99 %.2f ms, max %.2f ms' %
+          (len(ts), np.percentile(ts, 50) * 1000, np.percentile(ts, 99) * 1000, max(ts) * 1000))
+    print(index.query('wei zh', ARXIV_AUTHOR, 3), index.query('attention is', ARXIV_PAPER, 1))
+
+
+if __name__ == '__main__':
+    main()
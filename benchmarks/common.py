@@ -0,0 +1,133 @@
+"""
+Shared helpers for the benchmark scripts. Run them from the repo root, e.g.
+python -m benchmarks.bench_discussion_counts
+"""
+import time
+
+
+class CountingCollection(object):
+    """ wraps a (mongomock or pymongo) collection and counts the calls that reach the server """
+
+    ROUND_TRIP_METHODS = {'find', 'find_one', 'count', 'count_documents', 'aggregate', 'insert_one', 'insert_many',
+                          'update', 'update_one', 'update_many', 'bulk_write', 'delete_one', 'delete_many'}
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.ROUND_TRIP_METHODS:
+            def counted(*args, **kwargs):
+                self.round_trips += 1
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+    def reset(self):
+        self.round_trips = 0
+
+
+def timeit(func, repeat=5):
+    """ returns the best wall clock time of func() in seconds """
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+class StubSemSchAPI(object):
+    """
+    a local stand-in for the semantic scholar API (GET /paper/<id>), in a background thread.
+    Ids starting with 'missing' are unknown. Above rate_limit requests per second the server answers 429 (Retry-After: 1)
+    """
+
+    def __init__(self, latency=0.0, rate_limit=None):
+        import collections
+        import http.server
+        import json
+        import threading
+
+        api = self
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.hits = collections.Counter() # id -> requests
+        self.throttled = 0
+        self._recent = collections.deque() # times of the accepted requests of the last second
+        self._lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive, so sessions can reuse connections
+
+            def do_GET(self):
+                pid = self.path.rsplit('/', 1)[-1].replace('arXiv:', '')
+                code, body = api.respond(pid)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if code == 429:
+                    self.send_header('Retry-After', '1') # the rate limit window
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, pid):
+        with self._lock:
+            now = time.time()
+            if self.rate_limit:
+                while self._recent and self._recent[0] < now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    self.throttled += 1
+                    return 429, {'error': 'Too Many Requests'}
+                self._recent.append(now)
+            self.hits[pid] += 1
+        time.sleep(self.latency)
+        if pid.startswith('missing'):
+            return 404, {'error': 'Paper not found'}
+        return 200, {
+            'arxivId': pid, 'paperId': 'ss' + pid, 'year': 2019, 'title': 'Paper %s' % pid,
+            'authors': [{'authorId': str(i), 'name': 'Author %d' % i} for i in range(3)],
+            'citations': [{'arxivId': None, 'paperId': 'c%d' % i, 'title': 'Citing %d' % i} for i in range(5)],
+            'references': [{'arxivId': None, 'paperId': 'r%d' % i, 'title': 'Cited %d' % i} for i in range(5)],
+        }
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_pdf(num_pages=10, lines_per_page=40):
+    """ the bytes of a minimal valid pdf with num_pages pages of text, for the pdf processing benchmarks """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in range(num_pages):
+        text = ' '.join('(Page %d line %d of a paper about things that work on many benchmarks.) Tj T*' % (page, i)
+                        for i in range(lines_per_page))
+        stream = ('BT /F1 11 Tf 14 TL 50 760 Td %s ET' % text).encode('ascii')
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> '
+                       b'/Contents %d 0 R >>' % (len(objects), ))
+        kids.append(b'%d 0 R' % (len(objects), ))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), num_pages)
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (i + 1, obj)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % o for o in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
@@ -0,0 +1,44 @@
+"""
+Builds the approximate nearest neighbour index (see ann_index.py) from the
+tfidf vectors written by analyze.py.
+
+With --add only the papers of the tfidf artifact that are not in the index yet are
+added to its delta segment, which is much cheaper than a rebuild. The index is
+rebuilt anyway when it was built on another vocabulary.
+"""
+import argparse
+
+from ann_index import AnnIndex
+from artifacts import artifact_exists, load_artifact
+from utils import Config
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--add', action='store_true', help='add new papers to the existing index instead of rebuilding')
+  parser.add_argument('--dim', type=int, default=256, help='dimension of the projected vectors')
+  parser.add_argument('--nlist', type=int, default=None, help='number of inverted lists, defaults to ~4 sqrt(N)')
+  args = parser.parse_args()
+
+  tfidf = load_artifact(Config.tfidf_dir, 'tfidf')
+  X = tfidf['X']
+  pids = tfidf.strings('pids')
+  vocab_fp = tfidf.meta.get('vocab_fp')
+
+  index = None
+  if args.add and artifact_exists(Config.ann_index_dir):
+    index = AnnIndex.load(Config.ann_index_dir)
+    if index.vocab_fp != vocab_fp:
+      print("the index was built on another vocabulary")
+      index = None
+  if index is not None:
+    have = set(str(p) for p in index.pids) | set(str(p) for p in index.delta_pids)
+    new_ix = [i for i,p in enumerate(pids) if p not in have]
+    print("adding %d new papers to an index of %d" % (len(new_ix), len(index)))
+    if new_ix:
+      index.add(X[new_ix], [pids[i] for i in new_ix], vocab_fp)
+      index.save_delta(Config.ann_index_dir)
+  else:
+    print("building an index of %d papers..." % (len(pids), ))
+    index = AnnIndex.build(X, pids, dim=args.dim, nlist=args.nlist, vocab_fp=vocab_fp)
+    print("writing", Config.ann_index_dir)
+    index.save(Config.ann_index_dir)
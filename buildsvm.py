@@ -1,66 +1,174 @@
+"""
+Trains a linear SVM per user on the tfidf vectors of the papers in their library
+and writes the top recommendations of every user to the user_sim artifact (see
+artifacts.py): the sorted user ids, and a matrix of the rows of their recommended
+papers in the raw pid table stored next to it
+
+Runs are incremental: the model of every user is kept in user_models.p together
+with a fingerprint of their library. Users whose library didn't change keep their
+recommendations (or are only re-scored when the tfidf matrix changed), the others
+are retrained in a process pool, warm started from their previous coefficients.
+"""
 # standard imports
 import os
 import sys
 import pickle
+import argparse
+import multiprocessing
 # non-standard imports
 import numpy as np
-from sklearn import svm
+import scipy.sparse as sp
+from sklearn.linear_model import SGDClassifier
 from sqlite3 import dbapi2 as sqlite3
 # local imports
-from utils import safe_pickle_dump, strip_version, Config
+from artifacts import artifact_exists, load_artifact, save_artifact
+from utils import safe_pickle_dump, strip_version, Config, to_shared_memory, attach_shared_memory, fingerprint
 
 num_recommendations = 1000 # papers to recommend per user
+C = 0.1 # regularization of the svm, as in the LinearSVC(C=0.1) this script used to train
+LOSS = 'squared_hinge' # the default loss of LinearSVC, models trained with another one are retrained
 # -----------------------------------------------------------------------------
 
-if not os.path.isfile(Config.database_path):
-  print("the database file as.db should exist. You can create an empty database with sqlite3 as.db < schema.sql")
-  sys.exit()
-
-sqldb = sqlite3.connect(Config.database_path)
-sqldb.row_factory = sqlite3.Row # to return dicts rather than tuples
-
-def query_db(query, args=(), one=False):
+def query_db(sqldb, query, args=(), one=False):
   """Queries the database and returns a list of dictionaries."""
   cur = sqldb.execute(query, args)
   rv = cur.fetchall()
   return (rv[0] if rv else None) if one else rv
 
-# -----------------------------------------------------------------------------
+def top_recommendations(X, coef, intercept):
+  s = X.dot(coef) + intercept
+  k = min(num_recommendations, len(s))
+  ix = np.argpartition(-s, k - 1)[:k]
+  return ix[np.argsort(-s[ix], kind='stable')] # crop paper recommendations to save space
 
-# fetch all users
-users = query_db('''select * from user''')
-print('number of users: ', len(users))
-
-# load the tfidf matrix and meta
-meta = pickle.load(open(Config.meta_path, 'rb'))
-out = pickle.load(open(Config.tfidf_path, 'rb'))
-X = out['X']
-X = X.todense()
-
-xtoi = { strip_version(x):i for x,i in meta['ptoi'].items() }
-
-user_sim = {}
-for ii,u in enumerate(users):
-  print("%d/%d building an SVM for %s" % (ii, len(users), u['username'].encode('utf-8')))
-  uid = u['user_id']
-  lib = query_db('''select * from library where user_id = ?''', [uid])
-  pids = [x['paper_id'] for x in lib] # raw pids without version
-  posix = [xtoi[p] for p in pids if p in xtoi]
-  
-  if not posix:
-    continue # empty library for this user maybe?
-
-  print(pids)
+def train(X, posix, coef_init=None, intercept_init=None):
   y = np.zeros(X.shape[0])
-  for ix in posix: y[ix] = 1
+  y[posix] = 1
+  # the LinearSVC objective (squared hinge, C) solved by SGD, which unlike liblinear can be warm started
+  clf = SGDClassifier(loss=LOSS, alpha=1.0 / (C * X.shape[0]), class_weight='balanced',
+                      max_iter=50, tol=1e-4, random_state=1337)
+  clf.fit(X, y, coef_init=coef_init, intercept_init=intercept_init)
+  return clf.coef_[0].astype(np.float32), float(clf.intercept_[0])
+
+# workers of the process pool, X lives in shared memory
+# -----------------------------------------------------------------------------
+
+_worker = {}
+
+def _init_worker(specs, shape):
+  shms = []
+  data, indices, indptr = [attach_shared_memory(s, shms) for s in specs]
+  _worker['shms'] = shms # keep the mappings alive
+  _worker['X'] = sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+def _train_user(job):
+  uid, posix, coef_init, intercept_init = job
+  X = _worker['X']
+  coef, intercept = train(X, posix, coef_init, intercept_init)
+  return uid, coef, intercept, top_recommendations(X, coef, intercept)
+
+def run_jobs(X, jobs, num_workers):
+  if num_workers == 1 or len(jobs) <= 1:
+    for uid, posix, coef_init, intercept_init in jobs:
+      coef, intercept = train(X, posix, coef_init, intercept_init)
+      yield uid, coef, intercept, top_recommendations(X, coef, intercept)
+    return
+
+  shms = []
+  try:
+    specs = [to_shared_memory(a, shms) for a in (X.data, X.indices, X.indptr)]
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(specs, X.shape)) as pool:
+      for res in pool.imap_unordered(_train_user, jobs):
+        yield res
+  finally:
+    for shm in shms:
+      shm.close()
+      shm.unlink()
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--full', action='store_true', help='retrain every user from scratch')
+  parser.add_argument('--workers', type=int, default=None, help='training processes, defaults to the number of cores')
+  args = parser.parse_args()
+
+  if not os.path.isfile(Config.database_path):
+    print("the database file as.db should exist. You can create an empty database with sqlite3 as.db < schema.sql")
+    sys.exit()
+
+  sqldb = sqlite3.connect(Config.database_path)
+  sqldb.row_factory = sqlite3.Row # to return dicts rather than tuples
+
+  # fetch all users
+  users = query_db(sqldb, '''select * from user''')
+  print('number of users: ', len(users))
+
+  # load the tfidf matrix and meta, X stays sparse
+  tfidf = load_artifact(Config.tfidf_dir, 'tfidf')
+  X = sp.csr_matrix(tfidf['X'], dtype=np.float64)
+  pids = tfidf.strings('pids')
+  rawpids = [strip_version(x) for x in pids]
+  xtoi = { r:i for i,r in enumerate(rawpids) } # later versions win
+  vocab_fp = fingerprint(sorted((t, i) for i,t in enumerate(tfidf.strings('vocab'))))
+  rows_fp = fingerprint(pids)
+
+  # previous models and recommendations (rows of X), the recommendations are stale if the rows changed
+  models, user_sim = {}, {}
+  if not args.full and os.path.isfile(Config.user_models_path):
+    models = pickle.load(open(Config.user_models_path, 'rb'))
+  if not args.full and artifact_exists(Config.user_sim_dir):
+    prev_sim = load_artifact(Config.user_sim_dir, 'user_sim', mmap=False)
+    if prev_sim.meta['rows'] == rows_fp:
+      recs = prev_sim['recs']
+      user_sim = {uid: r[r >= 0] for uid,r in zip(prev_sim['uids'].tolist(), recs)}
+
+  jobs = []
+  num_rescored = num_unchanged = 0
+  active_uids = set()
+  for u in users:
+    uid = u['user_id']
+    lib = query_db(sqldb, '''select paper_id from library where user_id = ?''', [uid])
+    pids = sorted(x['paper_id'] for x in lib) # raw pids without version
+    posix = [xtoi[p] for p in pids if p in xtoi]
+    if not posix:
+      continue # empty library for this user maybe?
+    active_uids.add(uid)
+
+    lib_fp = fingerprint(pids)
+    prev = models.get(uid)
+    if prev and prev['vocab'] == vocab_fp and prev['library'] == lib_fp and prev.get('loss') == LOSS:
+      if prev['rows'] == rows_fp and uid in user_sim:
+        num_unchanged += 1
+      else:
+        # same model, but the papers changed, only score them again
+        user_sim[uid] = top_recommendations(X, prev['coef'], prev['intercept'])
+        prev['rows'] = rows_fp
+        num_rescored += 1
+      continue
+
+    # warm start from the previous model when it lives in the same feature space
+    warm = prev is not None and prev['vocab'] == vocab_fp
+    jobs.append((uid, np.array(posix), prev['coef'] if warm else None, prev['intercept'] if warm else None))
+    models[uid] = {'library': lib_fp, 'vocab': vocab_fp, 'rows': rows_fp, 'loss': LOSS}
 
-  clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=0.1)
-  clf.fit(X,y)
-  s = clf.decision_function(X)
+  print('%d users unchanged, %d re-scored, %d to train' % (num_unchanged, num_rescored, len(jobs)))
+  num_workers = args.workers or os.cpu_count() or 1
+  for ii, (uid, coef, intercept, sortix) in enumerate(run_jobs(X, jobs, num_workers)):
+    print("%d/%d built an SVM for user %d" % (ii + 1, len(jobs), uid))
+    models[uid].update(coef=coef, intercept=intercept)
+    user_sim[uid] = sortix
 
-  sortix = np.argsort(-s)
-  sortix = sortix[:min(num_recommendations, len(sortix))] # crop paper recommendations to save space
-  user_sim[uid] = [strip_version(meta['pids'][ix]) for ix in list(sortix)]
+  # forget users that emptied their library or were deleted
+  models = {uid: m for uid,m in models.items() if uid in active_uids}
+  user_sim = {uid: s for uid,s in user_sim.items() if uid in active_uids}
 
-print('writing', Config.user_sim_path)
-safe_pickle_dump(user_sim, Config.user_sim_path)
+  print('writing', Config.user_models_path)
+  safe_pickle_dump(models, Config.user_models_path)
+  uids = sorted(user_sim)
+  recs = np.full((len(uids), num_recommendations), -1, dtype=np.int32)
+  for i,uid in enumerate(uids):
+    recs[i, :len(user_sim[uid])] = user_sim[uid]
+  print('writing', Config.user_sim_dir)
+  save_artifact(Config.user_sim_dir, 'user_sim', {'uids': np.array(uids, dtype=np.int64), 'recs': recs,
+                                                  'rawpids': rawpids}, rows=rows_fp)
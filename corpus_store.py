@@ -0,0 +1,206 @@
+"""
+Packed store of the extracted texts of the papers (data/txt/<idvv>.pdf.txt).
+
+The texts are appended to a few large shard files, optionally compressed one by
+one with zlib (or zstd, when the zstandard package is installed). An index of
+(shard, offset, length) per document, kept sorted by idvv as the arrays of one
+index.npz next to the shards, is replaced atomically as a whole by sync(), so
+readers never see columns of different syncs. Shards are read through mmap: an
+uncompressed text is a zero-copy memoryview of the page cache, and iterating
+over the corpus in storage order reads the shards sequentially, instead of one
+open/stat/read per small file.
+
+Shards are append-only: a changed text is appended again and the index points to
+the new copy, bytes written after the last sync() are ignored.
+pack_txt_dir() adds the new or changed text files of data/txt, it's what
+analyze.py runs before reading the corpus.
+"""
+import mmap
+import os
+import zlib
+
+import numpy as np
+
+from utils import open_atomic, Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORE_VERSION = 1
+SHARD_SIZE = 1 << 30 # bytes, a new shard is started above it
+NONE, ZLIB, ZSTD = 0, 1, 2
+CODECS = {'none': NONE, 'zlib': ZLIB, 'zstd': ZSTD}
+INDEX_FILE = 'index.npz'
+INDEX_FIELDS = ['shard', 'offset', 'length', 'raw_length', 'codec', 'source_size', 'source_mtime']
+INDEX_DTYPES = [np.int32, np.int64, np.int64, np.int64, np.int8, np.int64, np.float64]
+
+
+class CorpusStore(object):
+
+    def __init__(self, path=Config.corpus_dir, codec='none', shard_size=SHARD_SIZE):
+        """
+        opens (or creates) the store in directory path
+        :param codec: compression of the documents added from now on, 'none', 'zlib' or 'zstd'
+        """
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError('the zstd codec needs the zstandard package')
+        self.path = path
+        self.codec = CODECS[codec]
+        self.shard_size = shard_size
+        self.records = {} # idvv -> (shard, offset, length, raw_length, codec, source_size, source_mtime)
+        self._maps = {} # shard -> mmap
+        self._writer = None # (shard, file) being appended to
+        if not os.path.exists(path): os.makedirs(path)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.isfile(index_path):
+            with np.load(index_path) as index:
+                version = int(index['version'])
+                assert version == STORE_VERSION, 'corpus store version %s, repack it' % (version, )
+                keys = index['keys']
+                columns = [index[f].tolist() for f in INDEX_FIELDS]
+            self.records = dict(zip(keys.astype(str).tolist(), zip(*columns)))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, 'shard-%05d.bin' % (shard, ))
+
+    # -------------------------------------------------------------------------
+    # writing
+
+    def add(self, key, data, source_size=0, source_mtime=0.0):
+        """ appends the text (bytes) of document key, replacing any previous version. call sync() when done """
+        if self._writer is None:
+            shards = [r[0] for r in self.records.values()]
+            shard = max(shards) if shards else 0
+            self._writer = (shard, open(self._shard_path(shard), 'ab'))
+        shard, f = self._writer
+        if f.tell() >= self.shard_size:
+            f.close()
+            shard += 1
+            self._writer = (shard, open(self._shard_path(shard), 'ab'))
+            shard, f = self._writer
+
+        raw_length = len(data)
+        if self.codec == ZLIB:
+            data = zlib.compress(data, 6)
+        elif self.codec == ZSTD:
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+        offset = f.tell()
+        f.write(data)
+        self.records[key] = (shard, offset, len(data), raw_length, self.codec, source_size, source_mtime)
+
+    def remove(self, key):
+        self.records.pop(key, None)
+
+    def sync(self):
+        """ flushes the shards and writes the index, the documents added before are durable after it """
+        if self._writer is not None:
+            f = self._writer[1]
+            f.flush()
+            os.fsync(f.fileno())
+        keys = sorted(self.records)
+        rows = [self.records[k] for k in keys]
+        index = {field: np.array([r[i] for r in rows], dtype=dtype)
+                 for i, (field, dtype) in enumerate(zip(INDEX_FIELDS, INDEX_DTYPES))}
+        index['keys'] = np.array(keys, dtype='S')
+        index['version'] = np.array(STORE_VERSION)
+        with open_atomic(os.path.join(self.path, INDEX_FILE), 'wb', fsync=True) as f:
+            np.savez(f, **index) # all the columns or none of them
+
+    def close(self):
+        if self._writer is not None:
+            self._writer[1].close()
+            self._writer = None
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+
+    # -------------------------------------------------------------------------
+    # reading
+
+    def _map(self, shard):
+        if self._writer is not None and self._writer[0] == shard:
+            self._writer[1].flush() # documents added since the last read
+        m = self._maps.get(shard)
+        if m is None or len(m) < os.path.getsize(self._shard_path(shard)):
+            with open(self._shard_path(shard), 'rb') as f:
+                m = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def get(self, key):
+        """ the text of document key as bytes, or a zero-copy memoryview when it isn't compressed """
+        shard, offset, length, raw_length, codec, _, _ = self.records[key]
+        if length == 0:
+            return b''
+        data = memoryview(self._map(shard))[offset:offset + length]
+        if codec == ZLIB:
+            return zlib.decompress(data)
+        if codec == ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_length)
+        return data
+
+    def fingerprint(self, key):
+        """ (size, mtime) of the text file the document was read from """
+        return self.records[key][5:]
+
+    def raw_length(self, key):
+        return self.records[key][3]
+
+    def storage_order(self, keys=None):
+        """ the keys (all of them by default) sorted by where they are stored, the fastest order to read them in """
+        keys = self.records if keys is None else keys
+        return sorted(keys, key=lambda k: self.records[k][:2])
+
+    def iter_texts(self, keys=None):
+        """ yields (key, bytes) of the documents (all of them in storage order by default) """
+        keys = self.storage_order() if keys is None else keys
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            for shard in set(self.records[k][0] for k in keys if self.records[k][2] > 0):
+                self._map(shard).madvise(mmap.MADV_SEQUENTIAL)
+        for k in keys:
+            yield k, bytes(self.get(k))
+
+
+def pack_txt_dir(store, txt_dir=Config.txt_dir, suffix='.pdf.txt'):
+    """
+    adds the text files of txt_dir that are new or changed to the store, and removes the documents whose file is
+    gone. returns the (added, removed) counts
+    """
+    seen = set()
+    num_added = 0
+    with os.scandir(txt_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(suffix):
+                continue
+            key = entry.name[:-len(suffix)]
+            seen.add(key)
+            st = entry.stat()
+            if key in store and store.fingerprint(key) == (st.st_size, st.st_mtime):
+                continue
+            with open(entry.path, 'rb') as f:
+                store.add(key, f.read(), st.st_size, st.st_mtime)
+            num_added += 1
+    removed = [k for k in store.records if k not in seen]
+    for k in removed:
+        store.remove(k)
+    store.sync()
+    return num_added, len(removed)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codec', default='none', choices=list(CODECS), help='compression of the added documents')
+    args = parser.parse_args()
+
+    store = CorpusStore(codec=args.codec)
+    num_added, num_removed = pack_txt_dir(store)
+    print('%d documents added, %d removed, %d in %s' % (num_added, num_removed, len(store), store.path))
+    store.close()
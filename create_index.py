@@ -21,6 +21,13 @@ if __name__ == '__main__':
         }
     )
 
+    # incremental typeahead refresh of the server, see typeahead.refresh_index
+    papers.create_index('time_ingested')
+
+    # bounded top k of /toptwtr, see hype.TopTwitterPapers
+    for field in ['twtr_score', 'twtr_score_dec']:
+        papers.create_index([('time_published', pymongo.ASCENDING), (field, pymongo.DESCENDING)])
+
     sem_sch_papers.drop_indexes()
     res = sem_sch_papers.create_index(
         [
@@ -0,0 +1,73 @@
+"""
+Batched discussion counts for the paper listings.
+
+Rendering a page used to cost one comments.count() per paper. Instead we keep
+an in-process counter cache (pid -> number of comments) and resolve all the
+pids of a page that are not cached yet with a single aggregation.
+"""
+import threading
+import time
+
+
+class DiscussionCounts(object):
+
+    def __init__(self, comments, ttl=300, max_size=100000):
+        """
+        :param comments: the comments mongo collection
+        :param ttl: seconds before a cached count is refreshed. Other server processes don't see our
+                    increments, so this bounds how stale their counts can get
+        :param max_size: max number of cached pids, the cache is cleared when it grows above it
+        """
+        self.comments = comments
+        self.ttl = ttl
+        self.max_size = max_size
+        self._counts = {}  # pid -> (count, time fetched)
+        self._lock = threading.Lock()
+
+    def _aggregate(self, pids):
+        res = self.comments.aggregate([
+            {'$match': {'pid': {'$in': pids}}},
+            {'$group': {'_id': '$pid', 'total': {'$sum': 1}}},
+        ])
+        return {r['_id']: r['total'] for r in res}
+
+    def get_many(self, pids):
+        """ returns a dict of pid -> number of comments, with at most one round trip to mongo """
+        now = time.time()
+        res = {}
+        missing = []
+        with self._lock:
+            for pid in pids:
+                cached = self._counts.get(pid)
+                if cached and now - cached[1] < self.ttl:
+                    res[pid] = cached[0]
+                else:
+                    missing.append(pid)
+
+        if missing:
+            fetched = self._aggregate(missing)
+            with self._lock:
+                if len(self._counts) + len(missing) > self.max_size:
+                    self._counts.clear()
+                for pid in missing:
+                    cnt = fetched.get(pid, 0)
+                    self._counts[pid] = (cnt, now)
+                    res[pid] = cnt
+        return res
+
+    def get(self, pid):
+        return self.get_many([pid])[pid]
+
+    def increment(self, pid, n=1):
+        """ keeps the cache current after a comment was inserted """
+        with self._lock:
+            cached = self._counts.get(pid)
+            if cached:
+                self._counts[pid] = (cached[0] + n, cached[1])
+
+    def invalidate(self, pid=None):
+        with self._lock:
+            if pid is None:
+                self._counts.clear()
+            else:
+                self._counts.pop(pid, None)
@@ -1,44 +1,161 @@
+"""
+Downloads the pdfs of the papers of db.p into Config.pdf_dir.
+
+A pool of threads downloads them, each thread with its own requests session so the
+connections to arxiv are reused, and all of them share one rate limit. A pdf is
+written to a temporary file that is renamed only once it's complete and looks like
+a pdf (starts with %PDF, sane size), so an interrupted run never leaves a
+truncated pdf behind.
+
+The outcome of every pdf is kept in Config.pdf_manifest_path: downloaded pdfs are
+never checked again, failed ones are retried by later runs after an exponential
+backoff.
+"""
+import argparse
 import os
-import time
 import pickle
-import shutil
-import random
-from  urllib.request import urlopen
-
-from utils import Config
-
-timeout_secs = 10 # after this many seconds we give up on a paper
-if not os.path.exists(Config.pdf_dir): os.makedirs(Config.pdf_dir)
-have = set(os.listdir(Config.pdf_dir)) # get list of all pdfs we already have
-
-numok = 0
-numtot = 0
-db = pickle.load(open(Config.db_path, 'rb'))
-for pid,j in db.items():
-  
-  pdfs = [x['href'] for x in j['links'] if x['type'] == 'application/pdf']
-  assert len(pdfs) == 1
-  pdf_url = pdfs[0] + '.pdf'
-  basename = pdf_url.split('/')[-1]
-  fname = os.path.join(Config.pdf_dir, basename)
-
-  # try retrieve the pdf
-  numtot += 1
-  try:
-    if not basename in have:
-      print('fetching %s into %s' % (pdf_url, fname))
-      req = urlopen(pdf_url, None, timeout_secs)
-      with open(fname, 'wb') as fp:
-          shutil.copyfileobj(req, fp)
-      time.sleep(0.05 + random.uniform(0,0.1))
-    else:
-      print('%s exists, skipping' % (fname, ))
-    numok+=1
-  except Exception as e:
-    print('error downloading: ', pdf_url)
-    print(e)
-  
-  print('%d/%d of %d downloaded ok.' % (numok, numtot, len(db)))
-  
-print('final number of papers downloaded okay: %d/%d' % (numok, len(db)))
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from paper_schema import pdf_url
+from utils import open_atomic, Config, Manifest, TokenBucket, retry_after_seconds
+
+OK, FAILED = 'ok', 'failed'
+MIN_SIZE = 1024 # bytes, anything smaller is an error page
+MAX_SIZE = 100 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class BadPdf(Exception):
+  pass
+
+
+def check_pdf_file(path, min_size=MIN_SIZE, max_size=MAX_SIZE):
+  """ raises BadPdf unless the file looks like a complete pdf """
+  size = os.path.getsize(path)
+  with open(path, 'rb') as f:
+    head = f.read(4)
+  if head != b'%PDF':
+    raise BadPdf('not a pdf')
+  if not min_size <= size <= max_size:
+    raise BadPdf('bad size %d' % (size, ))
+  return size
+
+
+class PdfDownloader(object):
+
+  def __init__(self, manifest, pdf_dir=Config.pdf_dir, rate=4, num_workers=8, timeout=(5, 60), min_size=MIN_SIZE,
+               max_size=MAX_SIZE, backoff=3600, max_backoff=7 * 86400):
+    """
+    :param manifest: utils.Manifest of the outcomes, keyed by pdf basename
+    :param rate: max requests per second, all workers together
+    :param timeout: (connect, read) seconds of every request
+    :param backoff: seconds before the first retry of a failed pdf, doubled on every failure up to max_backoff
+    """
+    self.manifest = manifest
+    self.pdf_dir = pdf_dir
+    self.num_workers = num_workers
+    self.timeout = timeout
+    self.min_size = min_size
+    self.max_size = max_size
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.bucket = TokenBucket(rate, capacity=num_workers)
+    self.stats = Counter() # ok, failed, skipped, recovered
+    self._local = threading.local()
+
+  def _session(self):
+    session = getattr(self._local, 'session', None)
+    if session is None:
+      session = self._local.session = requests.Session()
+    return session
+
+  def is_due(self, basename, now=None):
+    """ whether the pdf should be downloaded now: never downloaded, or failed and its backoff elapsed """
+    record = self.manifest.get(basename)
+    if record is None:
+      # downloaded before the manifest existed? it's checked once
+      path = os.path.join(self.pdf_dir, basename)
+      if os.path.isfile(path):
+        try:
+          size = check_pdf_file(path, self.min_size, self.max_size)
+          self.manifest.set(basename, status=OK, size=size, time=time.time())
+          self.stats['recovered'] += 1
+          return False
+        except BadPdf:
+          pass
+      return True
+    if record['status'] == OK:
+      return False
+    return record['retry_at'] <= (time.time() if now is None else now)
+
+  def fetch(self, url, path):
+    """ downloads url into path atomically, returns its size """
+    self.bucket.acquire()
+    with self._session().get(url, stream=True, timeout=self.timeout) as r:
+      if r.status_code in (429, 503):
+        self.bucket.pause(retry_after_seconds(r.headers.get('Retry-After')))
+      r.raise_for_status()
+      size = 0
+      head = b''
+      with open_atomic(path, 'wb') as f:
+        for chunk in r.iter_content(CHUNK_SIZE):
+          if len(head) < 4:
+            head += chunk[:4 - len(head)]
+            if len(head) == 4 and head != b'%PDF':
+              raise BadPdf('not a pdf')
+          size += len(chunk)
+          if size > self.max_size:
+            raise BadPdf('larger than %d bytes' % (self.max_size, ))
+          f.write(chunk)
+        if head != b'%PDF' or size < self.min_size:
+          raise BadPdf('bad size %d' % (size, ))
+    return size
+
+  def download(self, url):
+    basename = url.split('/')[-1]
+    try:
+      size = self.fetch(url, os.path.join(self.pdf_dir, basename))
+      self.manifest.set(basename, status=OK, size=size, time=time.time())
+      self.stats[OK] += 1
+    except Exception as e:
+      record = self.manifest.get(basename) or {}
+      attempts = record.get('attempts', 0) + 1
+      retry_at = time.time() + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+      self.manifest.set(basename, status=FAILED, attempts=attempts, retry_at=retry_at, error=str(e)[:200])
+      self.stats[FAILED] += 1
+      print('error downloading %s: %s' % (url, e))
+
+  def run(self, urls):
+    """ downloads the pdfs that are due, returns the stats """
+    if not os.path.exists(self.pdf_dir): os.makedirs(self.pdf_dir)
+    now = time.time()
+    todo = [u for u in urls if self.is_due(u.split('/')[-1], now)]
+    self.stats['skipped'] += len(urls) - len(todo)
+    print('%d pdfs to download, %d skipped' % (len(todo), len(urls) - len(todo)))
+    try:
+      with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+        for i, _ in enumerate(executor.map(self.download, todo)):
+          if (i + 1) % 100 == 0:
+            print('%d/%d done, %s' % (i + 1, len(todo), dict(self.stats)))
+    finally:
+      self.manifest.save()
+    return self.stats
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rate', type=float, default=4, help='max requests per second')
+  parser.add_argument('--workers', type=int, default=8, help='number of concurrent downloads')
+  args = parser.parse_args()
 
+  db = pickle.load(open(Config.db_path, 'rb'))
+  urls = [pdf_url(j) + '.pdf' for j in db.values()]
+  downloader = PdfDownloader(Manifest(Config.pdf_manifest_path), rate=args.rate, num_workers=args.workers)
+  stats = downloader.run(urls)
+  numok = sum(1 for u in urls if (downloader.manifest.get(u.split('/')[-1]) or {}).get('status') == OK)
+  print('final number of papers downloaded okay: %d/%d, this run %s' % (numok, len(urls), dict(stats)))
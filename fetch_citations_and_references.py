@@ -1,12 +1,15 @@
 import logging
-from datetime import datetime
-from time import sleep
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from datetime import datetime, timedelta
 
 import pymongo
 import requests
+from pymongo import UpdateOne, ReplaceOne
 
 from logger import logger_config
-from utils import catch_exceptions
+from utils import catch_exceptions, TokenBucket, retry_after_seconds
 
 client = pymongo.MongoClient()
 mdb = client.arxiv
@@ -17,10 +20,28 @@ sem_sch_authors = mdb.sem_sch_authors  # semantic scholar data
 logger_config(info_filename='citations_fetcher.log')
 logger = logging.getLogger(__name__)
 
-def send_query(p, is_arxiv):
+SEM_SCH_API = 'https://api.semanticscholar.org/v1'
+PAPER_FIELDS = {'title': 1, 'authors': 1, 'time_updated': 1, 'time_published': 1} # read by not_found_data
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after=0):
+        super().__init__(f'rate limited, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+def send_query(p, is_arxiv, session=requests, base_url=SEM_SCH_API, timeout=None):
+    """
+    :param session: requests or a requests.Session to reuse connections
+    :param timeout: requests timeout, (connect, read) seconds
+    """
     p_id = p['_id']
     prefix = "arXiv:" if is_arxiv else ""
-    response = requests.get(f'https://api.semanticscholar.org/v1/paper/{prefix}{p_id}').json()
+    resp = session.get(f'{base_url}/paper/{prefix}{p_id}', timeout=timeout)
+    if resp.status_code == 429:
+        raise RateLimited(retry_after_seconds(resp.headers.get('Retry-After')))
+    response = resp.json()
     if 'error' in response:
         logger.info(f'Error - {p_id} - {response}')
         return None
@@ -37,53 +58,129 @@ def send_query(p, is_arxiv):
     }
 
 
-def fetch_paper_data(p, is_arxiv=True):
-    p_id = p['_id']
-    retries = 3
-    res = None
-    success = False
-
-    for i in range(retries):
-        try:
-            res = send_query(p, is_arxiv)
-            success = True
-            break
-        except Exception as e:
-            logger.warning(f'Failed to fetch paper data - {e}')
-            sleep(10)
-
-    if not success:
+def not_found_data(p):
+    """ what we store for papers semantic scholar doesn't know """
+    return {'_id': p['_id'], 'title': p['title'], 'authors': p['authors'], 'last_rec_update': datetime.utcnow(),
+            'time_updated': p['time_updated'], 'time_published': p['time_published'], 'found': 0}
+
+
+class Refresher(object):
+    """
+    fetches papers from semantic scholar with a few concurrent workers, as fast as the API quota allows.
+    Requests go through a token bucket. On a 429 all the workers pause and the rate is halved, then it grows
+    back by `increase` per successful request, up to `rate`.
+    """
+
+    def __init__(self, base_url=SEM_SCH_API, rate=1 / 3, num_workers=4, timeout=(5, 30), min_rate=1 / 60,
+                 increase=0.01, max_retries=5):
+        self.base_url = base_url
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.stats = {'fetched': 0, 'not_found': 0, 'failed': 0, 'throttled': 0}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _throttled(self, retry_after):
+        with self._lock:
+            self.stats['throttled'] += 1
+            rate = max(self.min_rate, self.bucket.rate / 2)
+        self.bucket.set_rate(rate)
+        self.bucket.pause(retry_after or 1 / rate)
+        logger.info(f'Rate limited by semantic scholar, slowing down to {rate:.3f} requests/s')
+
+    def _succeeded(self):
+        if self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+    def fetch(self, p):
+        """ the semantic scholar data of a paper, None if it failed """
+        for i in range(self.max_retries):
+            self.bucket.acquire()
+            try:
+                res = send_query(p, True, session=self._session(), base_url=self.base_url, timeout=self.timeout)
+            except RateLimited as e:
+                self._throttled(e.retry_after)
+                continue
+            except Exception as e:
+                logger.warning(f'Failed to fetch paper data - {p["_id"]} - {e}')
+                time.sleep(2 ** i) # backs off this paper only, the other workers go on
+                continue
+            self._succeeded()
+            with self._lock:
+                self.stats['fetched' if res else 'not_found'] += 1
+            return res or not_found_data(p)
+        with self._lock:
+            self.stats['failed'] += 1
         return None
 
-    if not res:
-        res = {'_id': p_id, 'title': p['title'], 'authors': p['authors'], 'last_rec_update': datetime.utcnow(),
-               'time_updated': p['time_updated'],'time_published': p['time_published'], 'found': 0}
-    return res
+    def run(self, papers):
+        """ yields the fetched semantic scholar documents of the papers, in completion order """
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            in_flight = set()
+            for p in papers:
+                in_flight.add(executor.submit(self.fetch, p))
+                if len(in_flight) >= 2 * self.num_workers: # don't queue up the whole collection
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        if f.result():
+                            yield f.result()
+            for f in as_completed(in_flight):
+                if f.result():
+                    yield f.result()
+
+
+def write_papers(results):
+    """ upserts fetched papers and their authors with one bulk_write per collection """
+    authors = {a['name'] for res in results for a in res['authors']}
+    sem_sch_papers.bulk_write([UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True) for res in results],
+                              ordered=False)
+    if authors:
+        sem_sch_authors.bulk_write([ReplaceOne({'_id': a}, {}, upsert=True) for a in authors], ordered=False)
+
+
+def load_papers(ids, batch_size=100):
+    """
+    yields the papers of ids, read batch_size at a time. The refresh takes hours at the API rate, far longer than
+    the idle timeout of a mongo cursor, so no cursor is kept open between batches
+    """
+    for i in range(0, len(ids), batch_size):
+        yield from list(db_papers.find({'_id': {'$in': ids[i:i + batch_size]}}, PAPER_FIELDS))
 
 
 @catch_exceptions(logger=logger)
-def update_all_papers(age_days=5):
+def update_all_papers(age_days=5, batch_size=100, **refresher_kwargs):
     logger.info('Updating citations and references')
-    min_days_to_update = age_days * 86400
-    papers = list(db_papers.find())
-    logger.info(f'Fetching {len(papers)} documents')
-    for idx, p in enumerate(papers):
-        if idx % 500 == 0:
-            logger.info(f'Updating batch {idx}')
-        cur_sem_sch = sem_sch_papers.find_one({'_id': p['_id']})
-        if not cur_sem_sch or (datetime.utcnow() - cur_sem_sch['last_rec_update']).total_seconds() > min_days_to_update:
-            res = fetch_paper_data(p)
-            if res:
-                sem_sch_papers.update({'_id': res['_id']}, {'$set': res}, True)
-                for a in res['authors']:
-                    sem_sch_authors.update({'_id': a['name']}, {}, True)
-            else:
-                logger.error('Failed to fetch paper data - {}'.format(p['_id']))
-            sleep(5)
-        else:
-            logger.debug('Paper is already in DB')
-
-    logger.info('Finished updating refs')
+    min_update = datetime.utcnow() - timedelta(days=age_days)
+    fresh = {p['_id'] for p in sem_sch_papers.find({'last_rec_update': {'$gt': min_update}}, {'_id': 1})}
+    stale = [p['_id'] for p in db_papers.find({}, {'_id': 1}) if p['_id'] not in fresh]
+    logger.info(f'{len(fresh)} papers are up to date, {len(stale)} to update')
+
+    refresher = Refresher(**refresher_kwargs)
+    batch = []
+    num_written = 0
+    for res in refresher.run(load_papers(stale, batch_size)):
+        batch.append(res)
+        if len(batch) >= batch_size:
+            write_papers(batch)
+            num_written += len(batch)
+            batch = []
+            logger.info(f'Updated {num_written} papers - {refresher.stats}')
+    if batch:
+        write_papers(batch)
+        num_written += len(batch)
+
+    logger.info(f'Finished updating refs of {num_written} papers - {refresher.stats}')
 
 
 if __name__ == '__main__':
@@ -3,10 +3,17 @@ Queries arxiv API and downloads papers (the query is a parameter).
 The script is intended to enrich an existing database pickle (by default db.p),
 so this file will be loaded first, and then new results will be added to it.
 """
+import datetime
+import json
 import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import dateutil.parser
 import pymongo
+from pymongo import UpdateOne
 import time
 import random
 import argparse
@@ -14,7 +21,10 @@ import urllib.request
 import feedparser
 
 from logger import logger_config
-from utils import catch_exceptions
+from paper_schema import normalize_entry
+from paper_views import build_card
+from search_index import update_search_index
+from utils import catch_exceptions, open_atomic, Config
 
 logger_config(info_filename='arxiv_fetcher.log')
 logger = logging.getLogger(__name__)
@@ -26,98 +36,179 @@ papers = mdb.papers
 authors = mdb.authors
 
 
-def encode_feedparser_dict(d):
+def parse_entry(e):
+    """ the mongo document of a feed entry """
+    j = normalize_entry(e)
+    j['card'] = build_card(j, j['time_updated'], j['time_published'])
+    return j
+
+
+def ingest_entries(entries, added=None, papers=None, authors=None):
     """
-    helper function to get rid of feedparser bs with a deep copy.
-    I hate when libs wrap simple things in their own classes.
+    adds new papers (or new versions) of a page of feed entries to the db: one query for the versions we
+    have, then one unordered bulk write per collection
+    :param added: optional list, the added papers are appended to it
+    :param papers, authors: the collections, default to the arxiv db ones
     """
-    if isinstance(d, feedparser.FeedParserDict) or isinstance(d, dict):
-        j = {}
-        for k in d.keys():
-            j[k] = encode_feedparser_dict(d[k])
-        return j
-    elif isinstance(d, list):
-        l = []
-        for k in d:
-            l.append(encode_feedparser_dict(k))
-        return l
-    else:
-        return d
-
-def parse_arxiv_url(url):
+    papers = mdb.papers if papers is None else papers
+    authors = mdb.authors if authors is None else authors
+    page = {}
+    for e in entries:
+        j = parse_entry(e)
+        if j['_rawid'] not in page or j['_version'] > page[j['_rawid']]['_version']:
+            page[j['_rawid']] = j
+    if not page:
+        return 0, 0
+
+    # the newer version wins
+    known = {p['_id']: p.get('_version') for p in papers.find({'_id': {'$in': list(page)}}, {'_version': 1})}
+    now = datetime.datetime.utcnow() # time_ingested, what the typeahead refresh of the server queries
+    paper_ops = []
+    author_papers = defaultdict(list)
+    for rawid, j in page.items():
+        if rawid not in known or known[rawid] is None or j['_version'] > known[rawid]:
+            paper_ops.append(UpdateOne({'_id': rawid}, {'$set': dict(j, time_ingested=now)}, upsert=True))
+            if added is not None:
+                added.append(dict(j, _id=rawid))
+        if rawid not in known:
+            for a in j['authors']:
+                author_papers[a['name']].append(rawid)
+
+    if paper_ops:
+        papers.bulk_write(paper_ops, ordered=False)
+    if author_papers:
+        authors.bulk_write([UpdateOne({'_id': name}, {'$addToSet': {'papers': {'$each': pids}}}, upsert=True)
+                            for name, pids in author_papers.items()], ordered=False)
+    num_added = len(paper_ops)
+    return num_added, len(page) - num_added
+
+
+def fetch_entries(query, added=None):
     """
-    examples is http://arxiv.org/abs/1512.08756v2
-    we want to extract the raw id and the version
+    fetches a page of results and adds new papers (or new versions) to the db
+    :param added: optional list, the added papers are appended to it
     """
-    ix = url.rfind('/')
-    idversion = url[ix+1:] # extract just the id (and the version)
-    parts = idversion.split('v')
-    assert len(parts) == 2, 'error parsing url ' + url
-    return parts[0], int(parts[1])
-
-def fetch_entries(query):
     with urllib.request.urlopen(BASE_URL + query) as url:
         response = url.read()
     parse = feedparser.parse(response)
-    num_added = 0
-    num_skipped = 0
-    for e in parse.entries:
-
-        j = encode_feedparser_dict(e)
-
-        # extract just the raw arxiv id and version for this paper
-        rawid, version = parse_arxiv_url(j['id'])
-        j['_rawid'] = rawid
-        j['_version'] = version
-
-        # add to our database if we didn't have it before, or if this is a new version
-        cur_id = {'_id': rawid}
-        cur_paper = list(papers.find(cur_id))
-        j['time_updated'] = dateutil.parser.parse(j['updated'])
-        j['time_published'] = dateutil.parser.parse(j['published'])
-
-        if not cur_paper or '_version' not in cur_paper[0] or j['_version'] > cur_paper[0]['_version']:
-            papers.update(cur_id, {'$set': j}, True)
-            num_added += 1
-        else:
-            num_skipped += 1
-
-        if not cur_paper:
-            for a in j['authors']:
-                authors.update({'_id': a['name']}, {'$addToSet': {'papers': rawid}}, True)
-
-    return num_added, num_skipped
+    return ingest_entries(parse.entries, added)
 
 
 DEF_QUERY = 'cat:cs.CV+OR+cat:cs.AI+OR+cat:cs.LG+OR+cat:cs.CL+OR+cat:cs.NE+OR+cat:stat.ML'
 
 
+# checkpoints
+# -----------------------------------------------------------------------------
+# Results come newest first (sortBy=lastUpdatedDate). A run walks down from index 0
+# until it reaches the papers that were already the newest of the previous complete
+# run (stop_at). After every page we save the next index, so an interrupted run
+# resumes there instead of starting over.
+
+def load_checkpoint(search_query, path=Config.fetch_checkpoint_path):
+    checkpoint = {'index': 0, 'stop_at': None, 'run_newest': None}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            checkpoint.update(json.load(f).get(search_query, {}))
+    return checkpoint
+
+
+def save_checkpoint(search_query, checkpoint, path=Config.fetch_checkpoint_path):
+    checkpoints = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            checkpoints = json.load(f)
+    checkpoints[search_query] = checkpoint
+    with open_atomic(path, 'w') as f:
+        json.dump(checkpoints, f)
+
+
+# pipelined fetch loop
+# -----------------------------------------------------------------------------
+
+class Pacer(object):
+    """ spaces the api requests by at least wait_time (+ jitter) seconds, can be interrupted with stop """
+
+    def __init__(self, wait_time, jitter, stop):
+        self.wait_time = wait_time
+        self.jitter = jitter
+        self.stop = stop
+        self._next = 0
+
+    def wait(self):
+        """ returns False if stopped while waiting """
+        if self.stop.wait(max(0, self._next - time.time())):
+            return False
+        self._next = time.time() + self.wait_time + random.uniform(0, self.jitter)
+        return True
+
+
+def download_page(pacer, search_query, start, num, base_url=BASE_URL, max_failures=10):
+    """ the feed entries of a page of results, None if stopped """
+    query = 'search_query=%s&sortBy=lastUpdatedDate&start=%i&max_results=%i' % (search_query, start, num)
+    for _ in range(max_failures):
+        if not pacer.wait():
+            return None
+        with urllib.request.urlopen(base_url + query) as url:
+            entries = feedparser.parse(url.read()).entries
+        if entries:
+            return entries
+        logger.info('Received no results from arxiv. Retrying after sleep')
+    return []
+
+
 @catch_exceptions(logger=logger)
-def fetch_papers_main(start_index=0, max_index=3000, results_per_iteration=200, wait_time=5, search_query=DEF_QUERY, break_on_no_added=1):
-    # main loop where we fetch the new results
+def fetch_papers_main(start_index=None, max_index=3000, results_per_iteration=200, wait_time=5, search_query=DEF_QUERY,
+                      break_on_no_added=1, jitter=3, base_url=BASE_URL):
+    """
+    fetches pages of results until it caught up with the previous run. The download of the next page
+    overlaps with the parsing and writing of the current one, only the api politeness delay is waited for
+    :param start_index: None resumes from the checkpoint
+    :param break_on_no_added: without a checkpoint, stop at the first page with only known papers
+    """
     logger.info('Updating paper DB')
-    for i in range(start_index, max_index, results_per_iteration):
-        num_failures = 0
-
-        logger.info("Results %i - %i" % (i, i + results_per_iteration))
-        query = 'search_query=%s&sortBy=lastUpdatedDate&start=%i&max_results=%i' % (search_query, i, results_per_iteration)
-        while num_failures < 10:
-            num_added, num_skipped = fetch_entries(query)
-            if num_added == 0 and num_skipped > 0 and break_on_no_added == 1:
-                logger.info('No new papers were added. Assuming no new papers exist. Exiting.')
-                return
-
-            elif num_added + num_skipped > 0:
+    checkpoint = load_checkpoint(search_query)
+    if start_index is not None:
+        checkpoint['index'] = start_index
+    elif checkpoint['index']:
+        logger.info(f'Resuming the interrupted run from result {checkpoint["index"]}')
+    stop_at = checkpoint['stop_at'] and dateutil.parser.parse(checkpoint['stop_at'])
+    run_newest = checkpoint['run_newest']
+    indices = list(range(checkpoint['index'], max_index, results_per_iteration))
+
+    added = []
+    stop = threading.Event()
+    pacer = Pacer(wait_time, jitter, stop)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as downloader:
+            download = lambda i: downloader.submit(download_page, pacer, search_query, i, results_per_iteration, base_url)
+            next_page = download(indices[0]) if indices else None
+            for n, i in enumerate(indices):
+                logger.info("Results %i - %i" % (i, i + results_per_iteration))
+                entries = next_page.result()
+                if n + 1 < len(indices):
+                    next_page = download(indices[n + 1])
+                if not entries:
+                    continue
+
+                num_added, num_skipped = ingest_entries(entries, added)
                 logger.info('Added %d papers, already had %d.' % (num_added, num_skipped))
-                break
-            else:
-                logger.info('Received no results from arxiv. Retrying after sleep')
-                num_failures += 1
-                time.sleep(5)
-        # print some information
-
-        logger.info(f'Sleeping for {wait_time} seconds')
-        time.sleep(wait_time + random.uniform(0, 3))
+                updated = sorted(e['updated'] for e in entries)
+                run_newest = max(run_newest or updated[-1], updated[-1])
+                save_checkpoint(search_query, {'index': i + results_per_iteration, 'stop_at': checkpoint['stop_at'],
+                                               'run_newest': run_newest})
+
+                if stop_at and dateutil.parser.parse(updated[0]) <= stop_at:
+                    logger.info('Reached the papers of the previous run. Exiting.')
+                    break
+                if not stop_at and num_added == 0 and num_skipped > 0 and break_on_no_added == 1:
+                    logger.info('No new papers were added. Assuming no new papers exist. Exiting.')
+                    break
+            stop.set() # don't wait for the prefetched page
+        # the run is complete, the next one starts over from the top
+        save_checkpoint(search_query, {'index': 0, 'stop_at': run_newest or checkpoint['stop_at'], 'run_newest': None})
+    finally:
+        stop.set()
+        update_search_index(added)
 
 
 if __name__ == "__main__":
@@ -128,7 +219,7 @@ if __name__ == "__main__":
     parser.add_argument('--search-query', type=str,
                         default=DEF_QUERY,
                         help='query used for arxiv API. See http://arxiv.org/help/api/user-manual#detailed_examples')
-    parser.add_argument('--start-index', type=int, default=0, help='0 = most recent API result')
+    parser.add_argument('--start-index', type=int, default=None, help='0 = most recent API result, defaults to resuming the last run')
     parser.add_argument('--max-index', type=int, default=3000, help='upper bound on paper index we will fetch')
     parser.add_argument('--results-per-iteration', type=int, default=200, help='passed to arxiv API')
     parser.add_argument('--wait-time', type=float, default=5.0, help='lets be gentle to arxiv API (in number of seconds)')
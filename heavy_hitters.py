@@ -0,0 +1,260 @@
+"""
+Rolling counts of the most requested papers and authors, behind /popular_queries.
+
+Requests are counted in hourly buckets, shared by all the server processes in the
+request_counts mongo collection: one document per (hour, id, type) holding its
+count. Every process counts its own requests in memory and adds them to the
+collection with one unordered bulk of $inc upserts every few seconds, so no
+process overwrites the counts of another.
+
+In memory, the requests of every hour are counted by a Space-Saving summary: at
+most `capacity` keys, and a new key arriving in a full summary replaces the least
+counted one and inherits its count (+1), so the heavy hitters of the hour are kept
+and their counts are overestimated by at most the evicted count. Summaries are
+kept as stream summaries (keys grouped by count), so every request is O(1).
+
+Once an hour is over (plus `settle_seconds` for the late flushes), one process
+closes it: the bucket is trimmed to its `capacity` most counted keys, and the
+merged top `capacity` of every tracked window up to that hour is stored as a
+single summary document in the request_counts_summary collection. top() reads
+that summary plus the `capacity` best keys of each hour still open (an index
+range), so its cost and the stored counts are bounded whatever the traffic. The
+summaries are refreshed hourly, so a tracked window may span an hour or two more
+than its nominal length. Buckets expire through a TTL index after `num_buckets`
+hours.
+"""
+import atexit
+import datetime
+import heapq
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 3600
+WEEK_HOURS = 24 * 7
+SEEDED_ID = 'seeded' # marker document of the one-off import of the request log
+
+
+class SpaceSaving(object):
+    """ Space-Saving counts of at most capacity keys, as a stream summary: keys grouped by count """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {} # key -> count
+        self.by_count = {} # count -> {key: None}, in arrival order
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _move(self, key, c):
+        """ moves key from count c to c + 1 """
+        if c:
+            group = self.by_count[c]
+            del group[key]
+            if not group:
+                del self.by_count[c]
+                if self.min_count == c:
+                    self.min_count = c + 1 # key is there
+        self.by_count.setdefault(c + 1, {})[key] = None
+        self.counts[key] = c + 1
+
+    def add(self, key):
+        c = self.counts.get(key)
+        if c is None:
+            if len(self.counts) < self.capacity:
+                c = 0
+                self.min_count = 1
+            else:
+                c = self.min_count
+                evicted = next(iter(self.by_count[c]))
+                del self.by_count[c][evicted]
+                del self.counts[evicted]
+                self.by_count[c][key] = None
+        self._move(key, c)
+
+    def items(self):
+        return self.counts.items()
+
+
+class RollingTopK(object):
+
+    def __init__(self, collection, num_buckets=WEEK_HOURS, capacity=2000, cache_seconds=60, windows=(WEEK_HOURS, ),
+                 settle_seconds=300):
+        """
+        :param collection: the mongo collection of the shared hourly counts
+        :param num_buckets: hours of history kept
+        :param capacity: max keys counted per hourly bucket by a process between two flushes, and kept per closed hour
+        :param cache_seconds: how long a computed top k is served before it's recomputed
+        :param windows: hours of the windows whose merged summary is stored when an hour closes
+        :param settle_seconds: how long after its end an hour is closed
+        """
+        self.collection = collection
+        self.summaries = collection.database[collection.name + '_summary']
+        self.num_buckets = num_buckets
+        self.capacity = capacity
+        self.cache_seconds = cache_seconds
+        self.windows = windows
+        self.settle_seconds = settle_seconds
+        self.pending = {} # hour -> SpaceSaving of the requests not flushed yet
+        self._unsaved = defaultdict(int) # (hour, key) -> count of a flush that failed, retried with the next one
+        self._top = {} # (hours, k) -> (hour, time computed, top k)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        collection.create_index([('hour', pymongo.ASCENDING), ('id', pymongo.ASCENDING),
+                                 ('type', pymongo.ASCENDING)], unique=True)
+        collection.create_index([('hour', pymongo.ASCENDING), ('count', pymongo.DESCENDING)])
+        collection.create_index('expires', expireAfterSeconds=0)
+
+    @staticmethod
+    def hour_of(t):
+        return int(t // BUCKET_SECONDS)
+
+    def add(self, key, t=None):
+        """ counts one request of key, an (id, type) tuple, at time t """
+        hour = self.hour_of(time.time() if t is None else t)
+        with self._lock:
+            summary = self.pending.get(hour)
+            if summary is None:
+                summary = self.pending[hour] = SpaceSaving(self.capacity)
+            summary.add(key)
+
+    def flush(self):
+        """ adds the counts of this process to the shared buckets, returns the number of (hour, key) written """
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+            for hour, summary in pending.items():
+                for key, c in summary.items():
+                    self._unsaved[(hour, key)] += c
+            oldest = self.hour_of(time.time()) - self.num_buckets
+            for hk in [hk for hk in self._unsaved if hk[0] <= oldest]:
+                del self._unsaved[hk]
+            if not self._unsaved:
+                return 0
+            unsaved = list(self._unsaved.items())
+            ops = []
+            for (hour, (obj_id, obj_type)), c in unsaved:
+                expires = datetime.datetime.utcfromtimestamp((hour + 1 + self.num_buckets) * BUCKET_SECONDS)
+                ops.append(UpdateOne({'hour': hour, 'id': obj_id, 'type': obj_type},
+                                     {'$inc': {'count': c}, '$setOnInsert': {'expires': expires}}, upsert=True))
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # the other counts were added, keep only the failed ones
+                failed = {err['index'] for err in e.details.get('writeErrors', [])}
+                self._unsaved = defaultdict(int, (unsaved[i] for i in failed))
+                raise
+            self._unsaved.clear()
+            return len(ops)
+
+    def _merged(self, first, last, limit):
+        """ the `limit` most counted (key, count) of the hours first..last, one aggregation """
+        res = self.collection.aggregate([
+            {'$match': {'hour': {'$gte': first, '$lte': last}}},
+            {'$group': {'_id': {'id': '$id', 'type': '$type'}, 'count': {'$sum': '$count'}}},
+            {'$sort': {'count': -1}},
+            {'$limit': limit},
+        ])
+        return [((r['_id']['id'], r['_id']['type']), r['count']) for r in res]
+
+    def _best_of_hour(self, hour):
+        """ the `capacity` most counted (key, count) of an hour, an index range of the (hour, count) index """
+        cursor = self.collection.find({'hour': hour}, {'id': 1, 'type': 1, 'count': 1, '_id': 0})
+        return [((d['id'], d['type']), d['count']) for d in cursor.sort('count', -1).limit(self.capacity)]
+
+    def top(self, k=10, hours=WEEK_HOURS, now=None):
+        """ returns the k most counted (key, count) of the last `hours` hours, most counted first """
+        hour = self.hour_of(time.time() if now is None else now)
+        cached = self._top.get((hours, k))
+        if cached and cached[0] == hour and time.time() - cached[1] < self.cache_seconds:
+            return cached[2]
+        summary = self.summaries.find_one({'_id': hours}) if hours in self.windows else None
+        if summary is not None and summary['hour'] > hour - hours:
+            counts = Counter({(i, t): c for i, t, c in summary['top']})
+            for h in range(summary['hour'] + 1, hour + 1):
+                for key, c in self._best_of_hour(h):
+                    counts[key] += c
+            res = heapq.nlargest(k, counts.items(), key=lambda kv: kv[1])
+        else:
+            res = self._merged(hour - hours + 1, hour, k) # closed hours hold at most capacity keys
+        self._top[(hours, k)] = (hour, time.time(), res)
+        return res
+
+    def close_hours(self, now=None):
+        """
+        trims the hours that ended (more than settle_seconds ago) to their capacity most counted keys and stores the
+        summaries of the windows up to the last of them. Done once per hour by whichever process gets there first,
+        returns True if it was this one
+        """
+        last = self.hour_of((time.time() if now is None else now) - self.settle_seconds) - 1
+        try:
+            # matches (and is updated) only if the last closed hour is older, else the upsert hits the existing _id
+            prev = self.summaries.find_one_and_update({'_id': 'closed', 'hour': {'$lt': last}},
+                                                      {'$set': {'hour': last}}, upsert=True)
+        except DuplicateKeyError:
+            return False
+        first = max(prev['hour'] + 1 if prev else 0, last - self.num_buckets + 1)
+        for h in range(first, last + 1):
+            extra = [d['_id'] for d in self.collection.find({'hour': h}, {'_id': 1}).sort('count', -1).skip(self.capacity)]
+            for i in range(0, len(extra), 10000):
+                self.collection.delete_many({'_id': {'$in': extra[i:i + 10000]}})
+        for w in self.windows:
+            best = self._merged(last - w + 1, last, self.capacity)
+            self.summaries.replace_one({'_id': w}, {'_id': w, 'hour': last, 'top': [[i, t, c] for (i, t), c in best]},
+                                       upsert=True)
+        return True
+
+    def claim_seed(self):
+        """ True for the first process to call it on a collection never seeded, which then seeds it from the request log """
+        if self.collection.find_one({'_id': SEEDED_ID}) is not None:
+            return False
+        try:
+            self.collection.insert_one({'_id': SEEDED_ID})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def start_flusher(self, interval=10):
+        """ flushes the counts (and closes the past hours) every interval seconds in a daemon thread, and at exit """
+        def flush():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush the request counts, retrying with the next flush')
+            try:
+                self.close_hours()
+            except Exception:
+                logger.exception('Failed to close the past hours of the request counts')
+
+        def run():
+            while True:
+                time.sleep(interval)
+                flush()
+
+        atexit.register(flush)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+def seed_from_requests(counter, network_requests, hours=WEEK_HOURS):
+    """ one-off import of the request log, for the first start without shared counts """
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    query = {'dt': {'$gt': since}}
+    n = 0
+    for r in network_requests.find(query, {'id': 1, 'type': 1, 'dt': 1}).sort('dt', 1):
+        counter.add((r['id'], r['type']), r['dt'].replace(tzinfo=datetime.timezone.utc).timestamp())
+        n += 1
+        if n % 100000 == 0:
+            counter.flush()
+    counter.flush()
+    counter.close_hours()
+    return n
@@ -0,0 +1,206 @@
+"""
+Twitter rankings: the materialized hype rankings behind /oldhype, and the bounded
+top k queries behind /toptwtr.
+
+The twitter daemon keeps the (tweet, paper, time, score) rows of the tweets of the
+last MAX_DAYS days as flat numpy arrays (papers as integer codes), pickled to
+Config.hype_state_path. When process_tweets inserts or updates tweets, their rows
+are replaced, the expired rows dropped, and the per paper score sums of every window are recomputed with
+one bincount each. The top papers of every window are written to the
+hype_windows mongo collection as two sorted arrays, which the server reads as is.
+"""
+import datetime
+import logging
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from utils import safe_pickle_dump, Config
+
+logger = logging.getLogger(__name__)
+
+HYPE_WINDOWS = {'day': 1, '3days': 3, 'week': 7, '2weeks': 14}
+MAX_DAYS = max(HYPE_WINDOWS.values())
+TOP_N = 100
+TWEET_FIELDS = {'pids': 1, 'created_at_time': 1, 'likes': 1, 'retweets': 1, 'replies': 1, 'user_followers_count': 1}
+
+
+def tweet_scores(likes, retweets, replies, followers):
+    """ hype score of tweets, arrays of their counts in, array of scores out """
+    likes, retweets, replies, followers = (np.asarray(a, dtype=np.float64) for a in (likes, retweets, replies, followers))
+    followers_score = np.maximum(np.log10(followers + 1), 1)
+    return (likes + 2 * retweets) * (replies * 4 + 0.5) / followers_score
+
+
+def _created_time(t):
+    if 'created_at_time' in t:
+        return float(t['created_at_time'])
+    return t['created_at_date'].replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class HypeWindows(object):
+
+    def __init__(self):
+        self.vocab = [] # pid of every paper code
+        self.tids = np.zeros(0, dtype=np.int64) # tweet id of every (tweet, paper) row
+        self.codes = np.zeros(0, dtype=np.int32) # paper code of every row
+        self.times = np.zeros(0, dtype=np.float64) # tweet creation, seconds since epoch
+        self.scores = np.zeros(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.tids)
+
+    def update(self, tweets, now=None):
+        """ adds new tweets (dicts as stored in mongo) or replaces the rows of updated ones, drops the expired """
+        now = time.time() if now is None else now
+        tweets = [t for t in tweets if t.get('pids')]
+        ptoc = {p: c for c, p in enumerate(self.vocab)}
+        for t in tweets:
+            for p in t['pids']:
+                if p not in ptoc:
+                    ptoc[p] = len(self.vocab)
+                    self.vocab.append(p)
+        scores = tweet_scores([t['likes'] for t in tweets], [t['retweets'] for t in tweets],
+                              [t.get('replies', 0) for t in tweets], [t['user_followers_count'] for t in tweets])
+        counts = [len(t['pids']) for t in tweets]
+        new_tids = np.repeat(np.array([int(t['_id']) for t in tweets], dtype=np.int64), counts)
+        new_codes = np.array([ptoc[p] for t in tweets for p in t['pids']], dtype=np.int32)
+        new_times = np.repeat(np.array([_created_time(t) for t in tweets], dtype=np.float64), counts)
+        new_scores = np.repeat(scores, counts)
+
+        keep = (self.times > now - MAX_DAYS * 86400) & ~np.isin(self.tids, new_tids)
+        self.tids = np.concatenate([self.tids[keep], new_tids])
+        self.codes = np.concatenate([self.codes[keep], new_codes])
+        self.times = np.concatenate([self.times[keep], new_times])
+        self.scores = np.concatenate([self.scores[keep], new_scores])
+
+        # forget the papers that have no tweets left
+        used, self.codes = np.unique(self.codes, return_inverse=True)
+        self.codes = self.codes.astype(np.int32)
+        self.vocab = [self.vocab[c] for c in used]
+
+    def rankings(self, now=None, top_n=TOP_N):
+        """ returns window name -> (pids, scores) of its top_n papers, best first """
+        now = time.time() if now is None else now
+        res = {}
+        for name, days in HYPE_WINDOWS.items():
+            recent = self.times > now - days * 86400
+            sums = np.bincount(self.codes[recent], weights=self.scores[recent], minlength=len(self.vocab))
+            top = np.flatnonzero(sums > 0)
+            if len(top) > top_n:
+                top = top[np.argpartition(-sums[top], top_n - 1)[:top_n]]
+            top = top[np.argsort(-sums[top], kind='stable')]
+            res[name] = ([self.vocab[c] for c in top], sums[top])
+        return res
+
+    def save(self, path=Config.hype_state_path):
+        safe_pickle_dump({'vocab': self.vocab, 'tids': self.tids, 'codes': self.codes, 'times': self.times,
+                          'scores': self.scores}, path)
+
+    @classmethod
+    def load(cls, path=Config.hype_state_path):
+        hw = cls()
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        hw.vocab, hw.tids, hw.codes, hw.times, hw.scores = [state[k] for k in ['vocab', 'tids', 'codes', 'times',
+                                                                                'scores']]
+        return hw
+
+    @classmethod
+    def from_tweets(cls, db_tweets, now=None):
+        """ rebuilds the rows from the tweets collection, when there is no saved state """
+        now = time.time() if now is None else now
+        since = datetime.datetime.utcfromtimestamp(now - MAX_DAYS * 86400)
+        hw = cls()
+        hw.update(db_tweets.find({'created_at_date': {'$gt': since}}, TWEET_FIELDS), now)
+        return hw
+
+
+def update_hype_windows(db_tweets, db_hype, tweets, path=Config.hype_state_path):
+    """ called by the twitter daemon with the tweets it inserted or updated, rewrites the rankings """
+    if os.path.isfile(path):
+        hw = HypeWindows.load(path)
+        hw.update(tweets)
+    else:
+        hw = HypeWindows.from_tweets(db_tweets)
+    hw.save(path)
+    now = datetime.datetime.utcnow()
+    for name, (pids, scores) in hw.rankings().items():
+        db_hype.replace_one({'_id': name}, {'_id': name, 'pids': pids, 'scores': scores.tolist(),
+                                            'updated': now}, upsert=True)
+    logger.info(f'Updated the hype rankings from {len(hw)} tweet rows')
+
+
+class HypeRankings(object):
+    """ the server's cached view of the hype_windows collection """
+
+    def __init__(self, db_hype, ttl=60):
+        self.db_hype = db_hype
+        self.ttl = ttl
+        self._cache = {} # window -> (time fetched, pids, scores)
+        self._lock = threading.Lock()
+
+    def get(self, window):
+        """ returns the (pids, scores) of the top papers of the window, best first """
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(window)
+        if cached and now - cached[0] < self.ttl:
+            return cached[1], cached[2]
+        doc = self.db_hype.find_one({'_id': window}) or {}
+        pids, scores = doc.get('pids', []), doc.get('scores', [])
+        with self._lock:
+            self._cache[window] = (now, pids, scores)
+        return pids, scores
+
+
+class TopTwitterPapers(object):
+    """
+    the papers of a publication window with the highest twtr_score (or twtr_score_dec), for /toptwtr.
+
+    Short windows are one query on the (time_published, score) index: mongo scans the
+    papers of the window and keeps the top `limit` of them. For long windows that
+    range covers most of the collection, so instead we keep the `depth` best papers
+    overall in memory (refreshed every ttl seconds) and filter them by date. Either
+    way a request holds at most `limit` (or `depth`) slim documents.
+    """
+
+    def __init__(self, db_papers, projection, index_days=30, depth=2000, ttl=600):
+        self.db_papers = db_papers
+        self.projection = projection
+        self.index_days = index_days
+        self.depth = depth
+        self.ttl = ttl
+        self._candidates = {} # score field -> (time fetched, [(pid, time_published)] best first)
+        self._lock = threading.Lock()
+
+    def _query(self, since, field, limit):
+        # the planner picks the (time_published, field) index of create_index.py when it exists
+        return list(self.db_papers.find({'time_published': {'$gt': since}}, self.projection).sort(field, -1).limit(limit))
+
+    def _best(self, field):
+        now = time.time()
+        with self._lock:
+            cached = self._candidates.get(field)
+        if cached and now - cached[0] < self.ttl:
+            return cached[1]
+        cursor = self.db_papers.find({field: {'$gt': 0}}, {'time_published': 1}).sort(field, -1).limit(self.depth)
+        best = [(p['_id'], p['time_published']) for p in cursor]
+        with self._lock:
+            self._candidates[field] = (now, best)
+        return best
+
+    def top(self, days, field='twtr_score', limit=200):
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        if days <= self.index_days:
+            return self._query(since, field, limit)
+
+        best = self._best(field)
+        pids = [pid for pid, published in best if published > since][:limit]
+        if len(pids) < limit:
+            return self._query(since, field, limit) # not enough scored papers in the window, or beyond depth
+        papers = {p['_id']: p for p in self.db_papers.find({'_id': {'$in': pids}}, self.projection)}
+        return [papers[pid] for pid in pids if pid in papers]
@@ -0,0 +1,159 @@
+"""
+All-pairs top-k neighbours of the rows of a sparse (l2 normalized) tfidf matrix.
+
+X stays in CSR form. Its arrays are copied once into shared memory and a pool of
+worker processes computes X * X[i:i1].T for blocks of rows, selecting the top-k of
+every column with argpartition instead of fully sorting it. The block size is
+derived from max_memory_mb, which bounds the scratch memory of all the workers
+together, so the whole job never holds anything close to a dense NxN matrix.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import to_shared_memory, attach_shared_memory
+
+# bytes of scratch space per (row, query) pair of a block: the scores (float64)
+# and the int64 indices returned by argpartition, plus slack for the temporaries
+BYTES_PER_SCORE = 32
+
+_worker = {}
+
+
+def _init_worker(specs, shape, k):
+    shms = []
+    data, indices, indptr, out, scores = [attach_shared_memory(s, shms) for s in specs]
+    _worker['shms'] = shms  # keep the mappings alive
+    _worker['X'] = sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    _worker['out'] = out
+    _worker['scores'] = scores
+    _worker['k'] = k
+
+
+def topk_columns(ds, k):
+    """ row indices and values of the k largest entries of every column of ds, largest first """
+    IX = np.argpartition(-ds, k - 1, axis=0)[:k] # kxB, unsorted
+    top = np.take_along_axis(ds, IX, axis=0)
+    order = np.argsort(-top, axis=0, kind='stable')
+    return np.take_along_axis(IX, order, axis=0), np.take_along_axis(top, order, axis=0)
+
+
+def block_topk(X, i0, i1, k):
+    """
+    the indices of the k most similar rows of X for each of the rows i0..i1, most similar first,
+    and their similarities. both Bxk
+    """
+    xquery = X[i0:i1].T.toarray() # DxB
+    ds = X.dot(xquery) # NxD * DxB => NxB
+    IX, top = topk_columns(ds, min(k, X.shape[0]))
+    return IX.T, top.T
+
+
+def _run_block(block):
+    i0, i1 = block
+    IX, top = block_topk(_worker['X'], i0, i1, _worker['k'])
+    _worker['out'][i0:i1] = IX
+    _worker['scores'][i0:i1] = top
+    return i1 - i0
+
+
+def block_size_for(n, max_memory_mb, num_workers):
+    return max(1, int(max_memory_mb * 2**20 / (num_workers * n * BYTES_PER_SCORE)))
+
+
+def all_pairs_topk(X, k=50, max_memory_mb=2048, num_workers=None, block_size=None, return_scores=False, log=print):
+    """
+    returns an int32 matrix of shape N x min(k, N) with the indices of the nearest rows of every row of X
+    (and a float32 matrix of their similarities if return_scores is set)
+    :param max_memory_mb: bound on the scratch memory of all the workers together (X itself not included)
+    :param num_workers: processes to use, defaults to the number of cores
+    :param block_size: rows per task, derived from max_memory_mb if not given
+    """
+    X = sp.csr_matrix(X)
+    n = X.shape[0]
+    k = min(k, n)
+    num_workers = num_workers or os.cpu_count() or 1
+    block_size = block_size or block_size_for(n, max_memory_mb, num_workers)
+    blocks = [(i, min(n, i + block_size)) for i in range(0, n, block_size)]
+    log('computing top %d neighbours of %d docs in %d blocks of %d with %d workers' %
+        (k, n, len(blocks), block_size, num_workers))
+
+    if num_workers == 1:
+        out = np.empty((n, k), dtype=np.int32)
+        scores = np.empty((n, k), dtype=np.float32)
+        for idx, (i0, i1) in enumerate(blocks):
+            out[i0:i1], scores[i0:i1] = block_topk(X, i0, i1, k)
+            if idx % 10 == 0:
+                log('%d/%d...' % (i0, n))
+        return (out, scores) if return_scores else out
+
+    shms = []
+    try:
+        specs = [to_shared_memory(a, shms) for a in (X.data, X.indices, X.indptr)]
+        specs.append(to_shared_memory(np.empty((n, k), dtype=np.int32), shms))
+        specs.append(to_shared_memory(np.empty((n, k), dtype=np.float32), shms))
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(specs, X.shape, k)) as pool:
+            done = 0
+            for idx, num_rows in enumerate(pool.imap_unordered(_run_block, blocks)):
+                done += num_rows
+                if idx % 10 == 0:
+                    log('%d/%d...' % (done, n))
+        out, scores = [np.ndarray((n, k), dtype=np.dtype(s['dtype']), buffer=shm.buf).copy()
+                       for s, shm in zip(specs[3:], shms[3:])]
+        return (out, scores) if return_scores else out
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def update_topk(X, IX, S, new_rows, max_memory_mb=2048, log=print):
+    """
+    incrementally updates the neighbour lists IX (and similarities S) of all the rows of X after some rows were
+    added or changed, without recomputing all pairs. similarities of pairs that don't involve a new row are not
+    refreshed, a periodic all_pairs_topk takes care of that.
+    :param IX, S: the previous N x k neighbours and similarities, aligned with the rows of X. entries that pointed
+                  to removed rows must be -1 (and -inf), those rows are requeried
+    :param new_rows: indices of the rows that are new or changed since IX was computed. they get a fresh top-k
+                     and become candidates in the lists of all the other rows
+    """
+    X = sp.csr_matrix(X)
+    n, k = IX.shape
+    new_rows = np.asarray(new_rows, dtype=np.int64)
+    is_new = np.zeros(n, dtype=bool)
+    is_new[new_rows] = True
+
+    # rows that lost a neighbour need a fresh list of their own
+    requery_rows = np.nonzero((IX < 0).any(axis=1) & ~is_new)[0]
+    # stale entries of changed rows are replaced by their new similarity below
+    stale = (IX >= 0) & is_new[np.maximum(IX, 0)]
+    IX[stale] = -1
+    S[stale] = -np.inf
+
+    query_rows = np.union1d(new_rows, requery_rows)
+    is_queried = np.zeros(n, dtype=bool)
+    is_queried[query_rows] = True
+    block_size = block_size_for(n, max_memory_mb, 1)
+    log('updating top %d neighbours of %d docs with %d new and %d requeried docs' %
+        (k, n, len(new_rows), len(requery_rows)))
+
+    for i in range(0, len(query_rows), block_size):
+        rows = query_rows[i:i + block_size]
+        ds = X.dot(X[rows].T.toarray()) # NxB
+        # fresh lists for the queried rows
+        IX[rows], S[rows] = [a.T for a in topk_columns(ds, k)]
+        # the new rows of this block are candidates for everybody else
+        new_cols = is_new[rows]
+        if not new_cols.any():
+            continue
+        keep = ~is_queried
+        cand = ds[keep][:, new_cols] # MxC
+        cand_ix = np.broadcast_to(rows[new_cols], cand.shape)
+        merged_s = np.hstack([S[keep], cand]).T # (k+C)xM
+        merged_ix = np.hstack([IX[keep], cand_ix]).T
+        top_ix, top_s = topk_columns(merged_s, k)
+        IX[keep] = np.take_along_axis(merged_ix, top_ix, axis=0).T
+        S[keep] = top_s.T
+    return IX, S
@@ -0,0 +1,95 @@
+"""
+In-process cache of the users' libraries (the library table of as.db).
+
+Every toggle writes through the cache and stamps a new version for the user in
+the library_version table. Other server processes notice the new stamp the next
+time they check it (at most every check_interval seconds) and reload that
+user's library, so a page view normally doesn't touch SQLite at all.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from utils import strip_version
+
+
+def ensure_schema(db):
+    """ as.db files created before the library cache don't have the version table """
+    db.execute('''create table if not exists library_version (
+      user_id integer primary key,
+      version integer not null
+    )''')
+    db.commit()
+
+
+def new_version():
+    return time.time_ns()
+
+
+class LibraryCache(object):
+
+    def __init__(self, check_interval=5, max_users=10000):
+        """
+        :param check_interval: seconds during which a cached library is served without checking its version stamp
+        :param max_users: number of libraries kept, the least recently used ones are evicted
+        """
+        self.check_interval = check_interval
+        self.max_users = max_users
+        self._entries = OrderedDict()  # user id -> entry dict
+        self._lock = threading.Lock()
+
+    def _read_version(self, db, uid):
+        rv = db.execute('select version from library_version where user_id = ?', [uid]).fetchone()
+        return rv[0] if rv else 0
+
+    def _load(self, db, uid, version):
+        rows = db.execute('select paper_id, update_time from library where user_id = ?', [uid]).fetchall()
+        return {'version': version, 'checked': time.time(),
+                'pids': {strip_version(r[0]): r[1] for r in rows}}
+
+    def _store(self, uid, entry):
+        with self._lock:
+            self._entries[uid] = entry
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def _entry(self, db, uid, force_check=False):
+        with self._lock:
+            entry = self._entries.get(uid)
+        if entry and not force_check and time.time() - entry['checked'] < self.check_interval:
+            return entry
+
+        version = self._read_version(db, uid)
+        if entry and entry['version'] == version:
+            entry['checked'] = time.time()
+        else:
+            # never seen or changed by another process
+            entry = self._load(db, uid, version)
+        self._store(uid, entry)
+        return entry
+
+    def get(self, db, uid):
+        """ returns a dict of raw pid -> update time of the papers in the user's library. don't modify it """
+        return self._entry(db, uid)['pids']
+
+    def toggle(self, db, uid, pid):
+        """ adds or removes the raw pid from the user's library, returns True if it was added """
+        entry = self._entry(db, uid, force_check=True)
+        pids = dict(entry['pids'])
+        if pid in pids:
+            db.execute('''delete from library where user_id = ? and paper_id = ?''', [uid, pid])
+            del pids[pid]
+            added = False
+        else:
+            update_time = int(time.time())
+            db.execute('''insert into library (paper_id, user_id, update_time) values (?, ?, ?)''',
+                       [pid, uid, update_time])
+            pids[pid] = update_time
+            added = True
+
+        version = new_version()
+        db.execute('''insert or replace into library_version (user_id, version) values (?, ?)''', [uid, version])
+        db.commit()
+        self._store(uid, {'version': version, 'checked': time.time(), 'pids': pids})
+        return added
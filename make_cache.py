@@ -11,10 +11,11 @@ import json
 import pymongo
 import time
 import pickle
-import dateutil.parser
 
 from sqlite3 import dbapi2 as sqlite3
 from utils import safe_pickle_dump, Config
+from paper_schema import paper_times
+from paper_views import build_card
 
 sqldb = sqlite3.connect(Config.database_path)
 sqldb.row_factory = sqlite3.Row # to return dicts rather than tuples
@@ -24,24 +25,24 @@ CACHE = {}
 print('loading the paper database', Config.db_path)
 db = pickle.load(open(Config.db_path, 'rb'))
 
-print('loading tfidf_meta', Config.meta_path)
-# meta = pickle.load(open(Config.meta_path, "rb"))
-# vocab = meta['vocab']
+print('loading tfidf_meta', Config.tfidf_dir)
+# meta = load_artifact(Config.tfidf_dir, 'tfidf')
+# vocab = meta.strings('vocab')
 # idf = meta['idf']
 
 print('decorating the database with additional information...')
+tts = []
 for pid,p in db.items():
-  timestruct = dateutil.parser.parse(p['updated'])
-  p['time_updated'] = int(timestruct.strftime("%s")) # store in struct for future convenience
-  timestruct = dateutil.parser.parse(p['published'])
-  p['time_published'] = int(timestruct.strftime("%s")) # store in struct for future convenience
+  updated, published = paper_times(p)
+  p['time_updated'] = int(updated.strftime("%s")) # store in struct for future convenience
+  tts.append(time.mktime(updated.timetuple()))
+  p['time_published'] = int(published.strftime("%s")) # store in struct for future convenience
+  p['card'] = build_card(p, updated, published)
 
 print('computing min/max time for all papers...')
-tts = [time.mktime(dateutil.parser.parse(p['updated']).timetuple()) for pid,p in db.items()]
 ttmin = min(tts)*1.0
 ttmax = max(tts)*1.0
-for pid,p in db.items():
-  tt = time.mktime(dateutil.parser.parse(p['updated']).timetuple())
+for (pid,p),tt in zip(db.items(), tts):
   p['tscore'] = (tt-ttmin)/(ttmax-ttmin)
 
 print('precomputing papers date sorted...')
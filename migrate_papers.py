@@ -0,0 +1,52 @@
+"""
+One-off job that rewrites the papers stored before the current layout (see
+paper_schema.py) into it: the fields of SCHEMA are normalized and the leftovers
+of the feed entries are removed. The other fields (card, twitter scores, ...)
+are kept. Safe to rerun, only papers of an older layout are touched.
+"""
+import logging
+
+import pymongo
+from pymongo import UpdateOne
+
+from logger import logger_config
+from paper_schema import normalize_entry, LAYOUT_VERSION, LEGACY_FIELDS, SCHEMA
+from utils import catch_exceptions
+
+logger_config(info_filename='migrate_papers.log')
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+SOURCE_FIELDS = ['id', 'link', 'updated', 'published'] + list(SCHEMA)
+
+
+def migrate_op(p):
+    """ the update of a paper of the previous layout """
+    j = normalize_entry(p)
+    unset = {f: '' for f in LEGACY_FIELDS}
+    unset.update({f: '' for f in SCHEMA if f in p and f not in j}) # e.g. an empty comment
+    return UpdateOne({'_id': p['_id']}, {'$set': j, '$unset': unset})
+
+
+@catch_exceptions(logger=logger)
+def migrate_papers(papers):
+    q = {'_layout': {'$ne': LAYOUT_VERSION}}
+    logger.info(f'Migrating {papers.count_documents(q)} papers to layout {LAYOUT_VERSION}')
+    ops = []
+    num_done = 0
+    for p in papers.find(q, {f: 1 for f in SOURCE_FIELDS}):
+        ops.append(migrate_op(p))
+        if len(ops) >= BATCH_SIZE:
+            papers.bulk_write(ops, ordered=False)
+            num_done += len(ops)
+            ops = []
+            logger.info(f'Migrated {num_done} papers')
+    if ops:
+        papers.bulk_write(ops, ordered=False)
+        num_done += len(ops)
+    logger.info(f'Finished migrating {num_done} papers')
+
+
+if __name__ == '__main__':
+    client = pymongo.MongoClient()
+    migrate_papers(client.arxiv.papers)
@@ -0,0 +1,82 @@
+"""
+Layout of the documents of the papers collection.
+
+Papers used to be stored as a verbatim copy of their arxiv feed entry, with the
+*_detail duplicates, the parsed time tuples and both links of every paper. Now a
+feed entry goes through normalize_entry, which keeps only the fields listed in
+SCHEMA (in the shape their readers expect: authors as [{'name'}], tags as
+[{'term'}], ...) and stamps the document with LAYOUT_VERSION. The dates are kept
+as datetimes only, and the pdf link is derived from the abstract link.
+
+Documents of the previous layout have the same keys as feed entries, so they are
+normalized the same way by migrate_papers.py.
+"""
+import datetime
+
+import dateutil.parser
+
+LAYOUT_VERSION = 1  # bump when SCHEMA changes, then rerun migrate_papers.py
+
+
+def parse_arxiv_url(url):
+    """
+    examples is http://arxiv.org/abs/1512.08756v2
+    we want to extract the raw id and the version
+    """
+    ix = url.rfind('/')
+    idversion = url[ix+1:] # extract just the id (and the version)
+    parts = idversion.split('v')
+    assert len(parts) == 2, 'error parsing url ' + url
+    return parts[0], int(parts[1])
+
+
+def _time(field):
+    def read(e):
+        if e.get(field + '_parsed'): # the utc time tuple feedparser parsed, much cheaper than parsing the string
+            return datetime.datetime(*e[field + '_parsed'][:6], tzinfo=datetime.timezone.utc)
+        if field in e:
+            return dateutil.parser.parse(e[field])
+        return e['time_' + field] # already migrated
+    return read
+
+
+# stored field -> how it's read from a feed entry (or a document of the previous layout), None values aren't stored
+SCHEMA = {
+    'title': lambda e: e['title'],
+    'summary': lambda e: e['summary'],
+    'authors': lambda e: [{'name': a['name']} for a in e['authors']],
+    'tags': lambda e: [{'term': t['term']} for t in e['tags']],
+    'arxiv_primary_category': lambda e: {'term': e['arxiv_primary_category']['term']},
+    'arxiv_comment': lambda e: e.get('arxiv_comment'),
+    'link': lambda e: e['link'],
+    'time_updated': _time('updated'),
+    'time_published': _time('published'),
+}
+
+# fields of the feed entries, and so of the previous layout, that aren't stored anymore
+LEGACY_FIELDS = ['id', 'guidislink', 'updated', 'updated_parsed', 'published', 'published_parsed', 'title_detail',
+                 'summary_detail', 'author_detail', 'author', 'links', 'arxiv_journal_ref', 'arxiv_doi',
+                 'arxiv_affiliation']
+
+
+def normalize_entry(e):
+    """ the document of a feed entry (a feedparser dict), without the card """
+    rawid, version = parse_arxiv_url(e['link'] if 'id' not in e else e['id'])
+    j = {'_rawid': rawid, '_version': version, '_layout': LAYOUT_VERSION}
+    for field, read in SCHEMA.items():
+        value = read(e)
+        if value is not None:
+            j[field] = value
+    return j
+
+
+def paper_times(p):
+    """ the (updated, published) datetimes of a paper of any layout """
+    if 'time_updated' in p and 'time_published' in p:
+        return p['time_updated'], p['time_published']
+    return dateutil.parser.parse(p['updated']), dateutil.parser.parse(p['published'])
+
+
+def pdf_url(p):
+    """ e.g. http://arxiv.org/pdf/1512.08756v2 for the abstract link http://arxiv.org/abs/1512.08756v2 """
+    return p['link'].replace('/abs/', '/pdf/', 1)
@@ -0,0 +1,104 @@
+"""
+Render-ready views of the papers collection.
+
+Papers get a compact "card" subdocument when they are ingested (see fetch_papers.py),
+holding everything the listing pages show in the form they show it. That way the
+server only copies fields instead of re-parsing dates and flattening lists on
+every request.
+"""
+from paper_schema import paper_times, LEGACY_FIELDS
+
+CARD_VERSION = 1  # bump when the card layout changes, then rerun backfill_cards.py
+MAX_COMMENT_LEN = 100
+
+
+def format_date(timestruct):
+    return '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
+
+
+def build_card(p, updated=None, published=None):
+    """
+    builds the card subdocument of a paper (a mongo document or a parsed feed entry)
+    :param updated, published: the already parsed datetimes of the paper, if the caller has them
+    """
+    if updated is None or published is None:
+        updated, published = paper_times(p)
+
+    # arxiv comments from the authors (when they submit the paper)
+    cc = p.get('arxiv_comment', '')
+    if len(cc) > MAX_COMMENT_LEN:
+        cc = cc[:MAX_COMMENT_LEN] + '...' # crop very long comments
+
+    return {
+        'v': CARD_VERSION,
+        'pid': '%sv%d' % (p['_rawid'], p['_version']),
+        'rawpid': p['_rawid'],
+        'title': p['title'],
+        'category': p['arxiv_primary_category']['term'],
+        'authors': [a['name'] for a in p['authors']],
+        'link': p['link'],
+        'tags': [t['term'] for t in p['tags']],
+        'published_time': format_date(updated),
+        'originally_published_time': format_date(published),
+        'comment': cc,
+    }
+
+
+# fields of a paper that build_card reads
+CARD_SOURCE_FIELDS = ['_rawid', '_version', 'title', 'arxiv_primary_category', 'authors', 'link', 'tags',
+                      'time_updated', 'time_published', 'updated', 'published', 'arxiv_comment']
+# fields of the raw arxiv feed entries that nothing renders, left on papers not migrated yet (see paper_schema.py)
+FEED_LEFTOVER_FIELDS = LEGACY_FIELDS
+
+# named mongo projections of the papers collection, find papers with the one the page renders
+_card = ['card', '_rawid', '_version', 'twtr_score', 'twtr_score_dec', 'twtr_links']
+PROJECTIONS = {
+    'card': {f: 1 for f in _card}, # a listing without abstracts
+    'card+abstract': {f: 1 for f in _card + ['summary']}, # a listing, what encode_paper reads
+    'detail': {f: 0 for f in FEED_LEFTOVER_FIELDS}, # a single paper, everything but the feed leftovers
+}
+
+
+def projection(view, **extra):
+    """ the named projection, optionally with extra fields e.g. projection('card', score={'$meta': 'textScore'}) """
+    return dict(PROJECTIONS[view], **extra)
+
+
+def ensure_cards(papers_collection, papers):
+    """
+    sets an up to date card on the papers (fetched with a card projection) that don't have one yet,
+    with one query for the fields build_card needs
+    """
+    stale = [p for p in papers if p.get('card', {}).get('v') != CARD_VERSION]
+    if not stale:
+        return
+    sources = {s['_id']: s for s in papers_collection.find({'_id': {'$in': [p['_id'] for p in stale]}},
+                                                          {f: 1 for f in CARD_SOURCE_FIELDS})}
+    for p in stale:
+        if p['_id'] in sources:
+            p['card'] = build_card(sources[p['_id']])
+
+
+def get_card(p):
+    card = p.get('card')
+    if not card or card.get('v') != CARD_VERSION:
+        # paper wasn't backfilled yet
+        card = build_card(p)
+    return card
+
+
+def encode_paper(p, in_library=False, num_discussion=0, send_images=False, send_abstracts=True):
+    """ the json struct of a single paper, as consumed by as-common.js """
+    struct = dict(get_card(p))
+    del struct['v']
+    struct['in_library'] = 1 if in_library else 0
+    if send_abstracts:
+        struct['abstract'] = p['summary']
+    if send_images:
+        struct['img'] = '/static/thumbs/' + struct['pid'] + '.pdf.jpg'
+    struct['hype_score'] = p.get('hype_score', 0)
+    struct['twtr_score_dec'] = p.get('twtr_score_dec', 0)
+    struct['twtr_score'] = p.get('twtr_score', 0)
+    struct['twtr_links'] = p.get('twtr_links', [])
+    struct['num_discussion'] = num_discussion
+    return struct
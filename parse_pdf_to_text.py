@@ -1,48 +1,135 @@
 """
-Very simple script that simply iterates over all files data/pdf/f.pdf
-and create a file data/txt/f.pdf.txt that contains the raw text, extracted
-using the "pdftotext" command. If a pdf cannot be converted, this
-script will not produce the output file.
-"""
+Iterates over all files data/pdf/f.pdf and creates a file data/txt/f.pdf.txt
+that contains the raw text, extracted using the "pdftotext" command.
 
+As many pdftotext processes as there are cores run at a time, and one that takes
+more than --timeout seconds is killed. The outcome of every pdf (ok, failed or
+timeout, and how long it took) is kept in Config.txt_manifest_path with the sha1
+of the pdf, so a pdf is converted again only when its content changed. The text
+is written to a temporary file that is renamed when pdftotext succeeded, a pdf
+that cannot be converted has no text file.
+"""
+import argparse
+import hashlib
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import time
-import shutil
-import pickle
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import Config, Manifest
+
+OK, FAILED, TIMEOUT = 'ok', 'failed', 'timeout'
+
+
+def file_sha1(path):
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def pdftotext(pdf_path, txt_path, timeout):
+  """ converts the pdf, returns its status """
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(txt_path), suffix='.tmp')
+  os.close(fd)
+  try:
+    subprocess.run(['pdftotext', pdf_path, tmp_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   timeout=timeout, check=True) # the process is killed on timeout
+    os.replace(tmp_path, txt_path)
+    return OK
+  except subprocess.TimeoutExpired:
+    return TIMEOUT
+  except (subprocess.CalledProcessError, OSError):
+    return FAILED
+  finally:
+    if os.path.isfile(tmp_path):
+      os.remove(tmp_path)
+
 
-from utils import Config
+class TextExtractor(object):
 
-# make sure pdftotext is installed
-if not shutil.which('pdftotext'): # needs Python 3.3+
-  print('ERROR: you don\'t have pdftotext installed. Install it first before calling this script')
-  sys.exit()
+  def __init__(self, manifest, pdf_dir=Config.pdf_dir, txt_dir=Config.txt_dir, num_workers=None, timeout=60,
+               retry_failed=False):
+    """
+    :param manifest: utils.Manifest of the outcomes, keyed by pdf basename
+    :param num_workers: pdftotext processes at a time, the number of cores by default
+    :param timeout: seconds after which a pdftotext process is killed
+    :param retry_failed: convert again the pdfs that failed or timed out even if they didn't change
+    """
+    self.manifest = manifest
+    self.pdf_dir = pdf_dir
+    self.txt_dir = txt_dir
+    self.num_workers = num_workers or os.cpu_count()
+    self.timeout = timeout
+    self.retry_failed = retry_failed
+    self.stats = Counter() # ok, failed, timeout, unchanged
 
-if not os.path.exists(Config.txt_dir):
-  print('creating ', Config.txt_dir)
-  os.makedirs(Config.txt_dir)
+  def process(self, f):
+    """ converts data/pdf/f if it's new or changed, returns its status (or 'unchanged') """
+    pdf_path = os.path.join(self.pdf_dir, f)
+    txt_path = os.path.join(self.txt_dir, f + '.txt')
+    st = os.stat(pdf_path)
+    record = self.manifest.get(f)
+    if record and (record['size'], record['mtime']) == (st.st_size, st.st_mtime) and \
+        (record['status'] == OK or not self.retry_failed):
+      return 'unchanged' # don't even hash it
 
-have = set(os.listdir(Config.txt_dir))
-files = os.listdir(Config.pdf_dir)
-for i,f in enumerate(files): # there was a ,start=1 here that I removed, can't remember why it would be there. shouldn't be, i think.
+    sha1 = file_sha1(pdf_path)
+    if record is None and os.path.isfile(txt_path) and os.path.getmtime(txt_path) >= st.st_mtime:
+      # converted before the manifest existed, empty text files were the record of the failures
+      status = OK if os.path.getsize(txt_path) > 0 else FAILED
+      self.manifest.set(f, status=status, sha1=sha1, size=st.st_size, mtime=st.st_mtime, seconds=None)
+      return 'unchanged'
+    if record and record['sha1'] == sha1 and (record['status'] == OK or not self.retry_failed):
+      self.manifest.set(f, **dict(record, size=st.st_size, mtime=st.st_mtime)) # touched, not changed
+      return 'unchanged'
 
-  txt_basename = f + '.txt'
-  if txt_basename in have:
-    print('%d/%d skipping %s, already exists.' % (i, len(files), txt_basename, ))
-    continue
+    t0 = time.time()
+    status = pdftotext(pdf_path, txt_path, self.timeout)
+    seconds = time.time() - t0
+    if status != OK and os.path.isfile(txt_path):
+      os.remove(txt_path) # the text of a previous version of the pdf
+    self.manifest.set(f, status=status, sha1=sha1, size=st.st_size, mtime=st.st_mtime, seconds=round(seconds, 3))
+    if status != OK:
+      print('there was a problem with parsing %s to text: %s after %.1fs' % (pdf_path, status, seconds))
+    return status
 
-  pdf_path = os.path.join(Config.pdf_dir, f)
-  txt_path = os.path.join(Config.txt_dir, txt_basename)
-  cmd = "pdftotext %s %s" % (pdf_path, txt_path)
-  os.system(cmd)
+  def run(self, files=None):
+    """ converts the new or changed pdfs of pdf_dir (or the given basenames), returns the stats """
+    if not os.path.exists(self.txt_dir):
+      print('creating ', self.txt_dir)
+      os.makedirs(self.txt_dir)
+    if files is None:
+      files = [f for f in os.listdir(self.pdf_dir) if f.endswith('.pdf')]
+    try:
+      with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+        for i, status in enumerate(executor.map(self.process, files)):
+          self.stats[status] += 1
+          if (i + 1) % 100 == 0:
+            print('%d/%d %s' % (i + 1, len(files), dict(self.stats)))
+    finally:
+      self.manifest.save()
+    return self.stats
 
-  print('%d/%d %s' % (i, len(files), cmd))
 
-  # check output was made
-  if not os.path.isfile(txt_path):
-    # there was an error with converting the pdf
-    print('there was a problem with parsing %s to text, creating an empty text file.' % (pdf_path, ))
-    os.system('touch ' + txt_path) # create empty file, but it's a record of having tried to convert
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--workers', type=int, default=None, help='pdftotext processes at a time, defaults to the cores')
+  parser.add_argument('--timeout', type=float, default=60, help='seconds after which pdftotext is killed')
+  parser.add_argument('--retry-failed', action='store_true', help='convert again the pdfs that failed or timed out')
+  args = parser.parse_args()
 
-  time.sleep(0.01) # silly way for allowing for ctrl+c termination
+  # make sure pdftotext is installed
+  if not shutil.which('pdftotext'): # needs Python 3.3+
+    print('ERROR: you don\'t have pdftotext installed. Install it first before calling this script')
+    sys.exit()
 
+  extractor = TextExtractor(Manifest(Config.txt_manifest_path), num_workers=args.workers, timeout=args.timeout,
+                            retry_failed=args.retry_failed)
+  stats = extractor.run()
+  print('done: %s' % (dict(stats), ))
@@ -12,3 +12,8 @@ create table library (
   user_id integer not null,
   update_time integer
 );
+drop table if exists library_version;
+create table library_version (
+  user_id integer primary key,
+  version integer not null
+);
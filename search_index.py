@@ -0,0 +1,362 @@
+"""
+In-process BM25 search over the arXiv papers, used by /search instead of mongo's $text.
+
+Every paper is indexed on its title, authors, categories and abstract, each field
+with its own boost (the weights of the old search_dict of make_cache.py). The
+boosted term frequencies are summed into one tf per (term, paper) and scored with
+BM25, as in BM25F.
+
+The posting lists live in one byte array: per term, the sorted doc ids are delta
+encoded with the narrowest of uint8/uint16/uint32 that fits the largest gap, and
+the tfs are quantized to uint16. The term dictionary is a sorted string array, so
+the whole index loads from a single .npz without unpickling.
+
+Papers added after the index was built (see fetch_papers.py) are appended to a
+delta segment file next to the index (their boosted term frequencies, a few KB
+per paper), without reading or rewriting the main arrays. Loading the index
+replays the delta into a small in-memory tail segment, deleting the older
+versions of the papers it replaces. Once the delta holds `max_delta` papers, or
+with python search_index.py --compact, it's merged into the arrays by save(),
+which also drops the deleted documents.
+
+Document frequencies only count the documents that aren't deleted, so replaced
+versions don't skew the idf while they wait for a compaction.
+
+python search_index.py builds the index from mongo, --compact merges the delta.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from utils import open_atomic, Config
+
+logger = logging.getLogger(__name__)
+
+FIELD_BOOSTS = {'title': 3.0, 'authors': 2.0, 'tags': 2.0, 'summary': 1.0}
+INDEX_FIELDS = ['_id', 'title', 'authors', 'tags', 'summary'] # mongo projection of the indexed fields
+TF_SCALE = 8 # tfs are stored as uint16 in units of 1/TF_SCALE
+WIDTHS = [(1, np.uint8), (2, np.uint16), (4, np.uint32)]
+token_re = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+
+
+def delta_path(path):
+    """ the delta segment of the index file path """
+    return os.path.splitext(path)[0] + '.delta.npz'
+
+
+def tokenize(s):
+    return token_re.findall(s.lower())
+
+
+def doc_terms(p):
+    """ boosted term frequencies of a paper (a mongo document) and its boosted length """
+    fields = {
+        'title': p.get('title', ''),
+        'authors': ' '.join(a['name'] for a in p.get('authors', [])),
+        'tags': ' '.join(t['term'] for t in p.get('tags', [])),
+        'summary': p.get('summary', ''),
+    }
+    tfs = defaultdict(float)
+    length = 0.0
+    for field, text in fields.items():
+        boost = FIELD_BOOSTS[field]
+        tokens = tokenize(text)
+        if field == 'authors':
+            tokens = [t for t in tokens if t != 'and'] # special case for "and" handling in authors list
+        for t in tokens:
+            tfs[t] += boost
+        length += boost * len(tokens)
+    return tfs, length
+
+
+class SearchIndex(object):
+
+    def __init__(self, terms, offsets, counts, widths, blob, tfs, pids, lengths, deleted, k1=1.2, b=0.75):
+        """ use build() or load() """
+        self.terms = terms # sorted term strings
+        self.offsets = offsets # byte offset of every term's doc ids in blob
+        self.counts = counts # number of postings of every term
+        self.widths = widths # bytes per delta of every term
+        self.blob = blob # uint8, the delta encoded doc ids
+        self.tf_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.tfs = tfs # uint16, quantized boosted tfs aligned with the postings
+        self.pids = [str(p) for p in pids]
+        self.lengths = lengths
+        self.deleted = deleted
+        self.k1 = k1
+        self.b = b
+        self.ptod = {p: i for i, p in enumerate(self.pids)} # later docs of the same pid win
+        self.tail = defaultdict(list) # term -> [(doc, tf)] of the docs added since the build
+        self._norm = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, papers, **kwargs):
+        """ :param papers: iterable of mongo paper documents """
+        postings = defaultdict(list)
+        pids, lengths = [], []
+        for doc, p in enumerate(papers):
+            tfs, length = doc_terms(p)
+            for t, tf in tfs.items():
+                postings[t].append((doc, tf))
+            pids.append(p['_id'])
+            lengths.append(length)
+        postings = {t: (np.array([d for d, _ in ps], dtype=np.int64), np.array([tf for _, tf in ps]))
+                    for t, ps in postings.items()}
+        index = cls(*cls._encode(postings), pids, np.array(lengths, dtype=np.float32),
+                    np.zeros(len(pids), dtype=bool), **kwargs)
+        return index
+
+    @staticmethod
+    def _encode(postings):
+        """ :param postings: term -> (sorted doc ids, tfs) """
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms), dtype=np.int64)
+        counts = np.zeros(len(terms), dtype=np.int64)
+        widths = np.zeros(len(terms), dtype=np.uint8)
+        chunks, tf_chunks = [], []
+        pos = 0
+        for i, t in enumerate(terms):
+            docs, tfs = postings[t]
+            deltas = np.diff(docs, prepend=0)
+            width, dtype = next((w, dt) for w, dt in WIDTHS if deltas.max() <= np.iinfo(dt).max)
+            enc = deltas.astype(dtype).tobytes()
+            offsets[i], counts[i], widths[i] = pos, len(docs), width
+            pos += len(enc)
+            chunks.append(enc)
+            tf_chunks.append(np.minimum(np.rint(tfs * TF_SCALE), 65535))
+        blob = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+        tfs = np.concatenate(tf_chunks).astype(np.uint16) if tf_chunks else np.zeros(0, dtype=np.uint16)
+        return np.array(terms, dtype=str), offsets, counts, widths, blob, tfs
+
+    def _postings(self, term):
+        """ doc ids and tfs of a term, from the arrays and the tail """
+        docs, tfs = [], []
+        i = np.searchsorted(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            dtype = dict(WIDTHS)[int(self.widths[i])]
+            deltas = np.frombuffer(self.blob, dtype=dtype, count=int(self.counts[i]), offset=int(self.offsets[i]))
+            docs.append(np.cumsum(deltas, dtype=np.int64))
+            tfs.append(self.tfs[self.tf_offsets[i]:self.tf_offsets[i + 1]].astype(np.float32) / TF_SCALE)
+        tail = self.tail.get(term)
+        if tail:
+            docs.append(np.array([d for d, _ in tail], dtype=np.int64))
+            tfs.append(np.array([tf for _, tf in tail], dtype=np.float32))
+        if not docs:
+            return None, None
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def add(self, papers):
+        """ indexes new papers, or new versions of papers (the old document is deleted) """
+        self._add_docs((p['_id'],) + doc_terms(p) for p in papers)
+
+    def _add_docs(self, docs):
+        """ :param docs: iterable of (pid, {term: boosted tf}, boosted length) """
+        with self._lock:
+            new_lengths = []
+            for pid, tfs, length in docs:
+                doc = len(self.pids)
+                old = self.ptod.get(pid)
+                if old is not None:
+                    self.deleted[old] = True
+                for t, tf in tfs.items():
+                    self.tail[t].append((doc, tf))
+                self.pids.append(pid)
+                self.ptod[pid] = doc
+                new_lengths.append(length)
+            self.lengths = np.concatenate([self.lengths, np.array(new_lengths, dtype=np.float32)])
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(new_lengths), dtype=bool)])
+            self._norm = None
+
+    def search(self, q, k=50):
+        """ returns the pids of the top k papers for the query, best first """
+        tokens = set(tokenize(q))
+        n = len(self.pids)
+        live = n - int(self.deleted.sum())
+        if not tokens or live == 0:
+            return []
+        norm = self._norm
+        if norm is None:
+            # bm25 length normalization of every doc, only changes when docs are added
+            avgdl = float(self.lengths[~self.deleted].mean()) or 1.0
+            norm = self._norm = self.k1 * (1 - self.b + self.b * self.lengths / avgdl)
+        scores = np.zeros(n, dtype=np.float32)
+        for t in tokens:
+            docs, tfs = self._postings(t)
+            if docs is None:
+                continue
+            alive = ~self.deleted[docs]
+            docs, tfs = docs[alive], tfs[alive]
+            df = len(docs) # of the documents that aren't deleted
+            if df == 0:
+                continue
+            idf = np.log(1 + (live - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        cand = np.flatnonzero(scores)
+        if len(cand) > k:
+            cand = cand[np.argpartition(-scores[cand], k - 1)[:k]]
+        cand = cand[np.argsort(-scores[cand], kind='stable')]
+        return [self.pids[i] for i in cand]
+
+    def compact(self):
+        """ merges the tail into the posting arrays and drops the deleted documents """
+        with self._lock:
+            keep = np.flatnonzero(~self.deleted)
+            remap = -np.ones(len(self.pids), dtype=np.int64)
+            remap[keep] = np.arange(len(keep))
+            postings = {}
+            for t in set(self.terms) | set(self.tail):
+                docs, tfs = self._postings(t)
+                docs = remap[docs]
+                alive = docs >= 0
+                if alive.any():
+                    postings[t] = (docs[alive], tfs[alive])
+            (self.terms, self.offsets, self.counts, self.widths,
+             self.blob, self.tfs) = self._encode(postings)
+            self.tf_offsets = np.concatenate([[0], np.cumsum(self.counts)]).astype(np.int64)
+            self.pids = [self.pids[i] for i in keep]
+            self.ptod = {p: i for i, p in enumerate(self.pids)}
+            self.lengths = self.lengths[keep]
+            self.deleted = np.zeros(len(keep), dtype=bool)
+            self.tail = defaultdict(list)
+            self._norm = None
+
+    def save(self, path=Config.search_index_path):
+        """ compacts and writes the whole index, the delta segment is merged in it and removed """
+        self.compact()
+        with open_atomic(path, 'wb') as f:
+            np.savez(f, terms=self.terms, offsets=self.offsets, counts=self.counts, widths=self.widths,
+                     blob=self.blob, tfs=self.tfs, pids=np.array(self.pids, dtype=str), lengths=self.lengths,
+                     deleted=self.deleted)
+        if os.path.isfile(delta_path(path)):
+            os.remove(delta_path(path)) # replaying it again after a crash before this is harmless
+
+    @classmethod
+    def load(cls, path=Config.search_index_path, **kwargs):
+        """ loads the index file and replays its delta segment """
+        with np.load(path) as d:
+            arrays = [d[name] for name in ['terms', 'offsets', 'counts', 'widths', 'blob', 'tfs', 'pids',
+                                           'lengths', 'deleted']]
+        index = cls(*arrays, **kwargs)
+        delta = load_delta(delta_path(path))
+        if len(delta['pids']):
+            index._add_docs(iter_delta(delta))
+        return index
+
+
+# delta segment
+# -----------------------------------------------------------------------------
+
+DELTA_DTYPES = {'pids': str, 'lengths': np.float32, 'num_terms': np.int32, 'terms': str, 'tfs': np.float32}
+
+
+def load_delta(path):
+    """ the arrays of a delta segment: per paper its pid, length and number of terms, and the flat terms and tfs """
+    if not os.path.isfile(path):
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in DELTA_DTYPES.items()}
+    with np.load(path) as d:
+        return {name: d[name] for name in DELTA_DTYPES}
+
+
+def iter_delta(delta):
+    """ yields the (pid, {term: tf}, length) of the papers of a delta segment, in the order they were added """
+    ends = np.cumsum(delta['num_terms'])
+    terms, tfs = delta['terms'].tolist(), delta['tfs'].tolist()
+    for pid, length, end, n in zip(delta['pids'].tolist(), delta['lengths'].tolist(), ends.tolist(),
+                                   delta['num_terms'].tolist()):
+        yield pid, dict(zip(terms[end - n:end], tfs[end - n:end])), length
+
+
+def append_delta(delta, papers):
+    """ the delta segment with the papers appended """
+    new = {name: [] for name in DELTA_DTYPES}
+    for p in papers:
+        tfs, length = doc_terms(p)
+        new['pids'].append(p['_id'])
+        new['lengths'].append(length)
+        new['num_terms'].append(len(tfs))
+        new['terms'].extend(tfs.keys())
+        new['tfs'].extend(tfs.values())
+    return {name: np.concatenate([delta[name], np.array(new[name], dtype=dtype)])
+            for name, dtype in DELTA_DTYPES.items()}
+
+
+class ReloadingSearchIndex(object):
+    """ the server's handle on the index file, reloaded when the ingest job rewrote it """
+
+    def __init__(self, path=Config.search_index_path, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self.index = None
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """ the current index, or None if it wasn't built yet """
+        now = time.time()
+        if now - self._checked > self.check_interval:
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.path.getmtime(self.path)
+                except OSError:
+                    return self.index
+                try:
+                    mtime = (mtime, os.path.getmtime(delta_path(self.path)))
+                except OSError:
+                    mtime = (mtime, None) # no delta
+                if mtime != self._mtime:
+                    logger.info(f'Loading the search index from {self.path}')
+                    self.index = SearchIndex.load(self.path)
+                    self._mtime = mtime
+        return self.index
+
+
+def update_search_index(papers, path=Config.search_index_path, max_delta=5000):
+    """
+    adds freshly ingested papers to the delta segment of the index file, if there is one. The delta is merged into
+    the index once it holds max_delta papers
+    """
+    if not papers or not os.path.isfile(path):
+        return
+    delta = append_delta(load_delta(delta_path(path)), papers)
+    if len(delta['pids']) < max_delta:
+        with open_atomic(delta_path(path), 'wb') as f:
+            np.savez(f, **delta)
+        logger.info(f'Added {len(papers)} papers to the search index delta, {len(delta["pids"])} papers in it')
+    else:
+        compact_search_index(path, papers)
+
+
+def compact_search_index(path=Config.search_index_path, papers=()):
+    """ merges the delta segment (and papers) into the index file """
+    index = SearchIndex.load(path)
+    index.add(papers)
+    index.save(path)
+    logger.info(f'Compacted the search index, {len(index.pids)} papers')
+
+
+if __name__ == '__main__':
+    import argparse
+    import pymongo
+    from logger import logger_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--compact', action='store_true', help='merge the delta segment instead of rebuilding')
+    args = parser.parse_args()
+
+    logger_config()
+    if args.compact:
+        compact_search_index()
+    else:
+        papers = pymongo.MongoClient().arxiv.papers
+        logger.info('Building the search index')
+        index = SearchIndex.build(papers.find({}, {f: 1 for f in INDEX_FIELDS}))
+        index.save()
+        logger.info(f'Wrote the search index of {len(index.pids)} papers to {Config.search_index_path}')
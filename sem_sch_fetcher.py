@@ -0,0 +1,89 @@
+"""
+Fetches the semantic scholar data of papers /get_paper doesn't know yet, without
+holding the request thread for the upstream call.
+
+get() starts a fetch in a small thread pool and returns PENDING right away, the
+client polls until the paper is in sem_sch_papers. Concurrent requests for the
+same id share one in-flight fetch. Every upstream call has a (connect, read)
+timeout. Ids semantic scholar doesn't know are cached as MISSING for hours,
+failed fetches as FAILED for a few seconds, so polling clients don't hammer the
+API.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fetch_citations_and_references import send_query, SEM_SCH_API
+
+logger = logging.getLogger(__name__)
+
+PENDING, FOUND, MISSING, FAILED = 'pending', 'found', 'missing', 'failed'
+
+
+class SemSchFetcher(object):
+
+    def __init__(self, on_result, base_url=SEM_SCH_API, max_workers=4, timeout=(3, 10), found_ttl=60,
+                 missing_ttl=6 * 3600, failed_ttl=30, max_entries=10000):
+        """
+        :param on_result: called from the pool with every paper found, before it's reported as FOUND
+        :param timeout: (connect, read) seconds of every upstream request
+        :param found_ttl, missing_ttl, failed_ttl: seconds an outcome is answered from memory
+        :param max_entries: max outcomes kept, the expired ones are pruned above it
+        """
+        self.on_result = on_result
+        self.base_url = base_url
+        self.timeout = timeout
+        self.ttls = {FOUND: found_ttl, MISSING: missing_ttl, FAILED: failed_ttl}
+        self.max_entries = max_entries
+        self.stats = {'fetches': 0, 'collapsed': 0, FOUND: 0, MISSING: 0, FAILED: 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sem_sch')
+        self._in_flight = set()
+        self._outcomes = {} # id -> (expires, status, paper)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def get(self, pid):
+        """ returns (status, paper), paper is set when status is FOUND """
+        now = time.time()
+        with self._lock:
+            outcome = self._outcomes.get(pid)
+            if outcome and outcome[0] > now:
+                return outcome[1], outcome[2]
+            if pid in self._in_flight:
+                self.stats['collapsed'] += 1
+            else:
+                self._in_flight.add(pid)
+                self.stats['fetches'] += 1
+                self._executor.submit(self._fetch, pid)
+        return PENDING, None
+
+    def _fetch(self, pid):
+        status, paper = FAILED, None
+        try:
+            paper = send_query({'_id': pid}, is_arxiv='.' in pid, session=self._session(), base_url=self.base_url,
+                               timeout=self.timeout)
+            if paper:
+                self.on_result(paper)
+                status = FOUND
+            else:
+                status = MISSING
+        except Exception as e:
+            logger.warning(f'Failed to fetch {pid} from semantic scholar - {e}')
+        with self._lock:
+            now = time.time()
+            if len(self._outcomes) >= self.max_entries:
+                self._outcomes = {k: v for k, v in self._outcomes.items() if v[0] > now}
+                if len(self._outcomes) >= self.max_entries:
+                    self._outcomes.clear()
+            self._outcomes[pid] = (now + self.ttls[status], status, paper)
+            self._in_flight.discard(pid)
+            self.stats[status] += 1
@@ -2,14 +2,11 @@ import datetime
 import logging
 import os
 import json
-import re
 import time
 import argparse
 import uuid
-from collections import Counter, defaultdict
-from math import log10
+from collections import Counter
 
-import dateutil.parser
 from random import randrange, uniform
 
 from sqlite3 import dbapi2 as sqlite3
@@ -23,13 +20,23 @@ from werkzeug import check_password_hash, generate_password_hash
 from flask_caching import Cache
 
 import pymongo
-
-from fetch_citations_and_references import send_query
+from bson import ObjectId
 
 from logger import logger_config
 
 
+from discussion_counts import DiscussionCounts
+from heavy_hitters import RollingTopK, seed_from_requests
+from hype import HypeRankings, TopTwitterPapers, HYPE_WINDOWS
+from library_cache import LibraryCache, ensure_schema as ensure_library_schema
+from paper_views import encode_paper, ensure_cards, projection
+from search_index import ReloadingSearchIndex
+from sem_sch_fetcher import SemSchFetcher, PENDING, FAILED
+from similarity import SimilarityService
+from typeahead import typeahead_index, start_refresher as start_typeahead_refresher, \
+    ARXIV_AUTHOR, ARXIV_PAPER, SEM_SCH_AUTHOR, SEM_SCH_PAPER
 from utils import strip_version, isvalidid, Config
+from write_behind import write_behind
 from voting import voting_app
 
 # various globals
@@ -53,6 +60,8 @@ app.register_blueprint(voting_app)
 
 limiter = Limiter(app, key_func=get_remote_address, default_limits=["5000 per hour", "100 per minute"])
 cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+library_cache = LibraryCache()
+search_index = ReloadingSearchIndex()
 
 REQUESTER_COOKIE = 'network_requester'
 
@@ -108,23 +117,31 @@ def teardown_request(exception):
 # -----------------------------------------------------------------------------
 
 def papers_search(qraw):
-    q = db_papers.find({'$text': {'$search': qraw}}, {'score': {'$meta': "textScore"}})
-    return list(q.sort([('score', {'$meta': 'textScore'})]).limit(50))
+    index = search_index.get()
+    if index is None:
+        # the bm25 index wasn't built yet, fall back to mongo's text index
+        q = db_papers.find({'$text': {'$search': qraw}}, projection('card+abstract', score={'$meta': "textScore"}))
+        return list(q.sort([('score', {'$meta': 'textScore'})]).limit(50))
+    pids = index.search(qraw, 50)
+    papers = {p['_id']: p for p in db_papers.find({'_id': {'$in': pids}}, projection('card+abstract'))}
+    return [papers[x] for x in pids if x in papers]
 
 
 def papers_similar(pid):
-    rawpid = strip_version(pid)
-    return []
+    if similarity is None:
+        return []
+    similar_pids = similarity.similar(pid)
+    papers = {p['_id']: p for p in db_papers.find({'_id': {'$in': similar_pids}}, projection('card+abstract'))}
+    return [papers[x] for x in similar_pids if x in papers]
 
 
 def papers_from_library():
     out = []
     if g.user:
         # user is logged in, lets fetch their saved library data
-        uid = session['user_id']
-        user_library = query_db('''select * from library where user_id = ?''', [uid])
-        libids = [strip_version(x['paper_id']) for x in user_library]
-        out = list(db_papers.find({'_id': {'$in': libids}}).sort("time_updated", pymongo.DESCENDING))
+        libids = list(library_cache.get(g.db, session['user_id']))
+        out = list(db_papers.find({'_id': {'$in': libids}}, projection('card+abstract'))
+                   .sort("time_updated", pymongo.DESCENDING))
     return out
 
 
@@ -137,49 +154,20 @@ def papers_filter_version(papers, v):
 
 def encode_json(ps, n=10, send_images=False, send_abstracts=True):
 
-    libids = set()
+    libids = {}
     if g.user:
         # user is logged in, lets fetch their saved library data
-        uid = session['user_id']
-        user_library = query_db('''select * from library where user_id = ?''', [uid])
-        libids = {strip_version(x['paper_id']) for x in user_library}
+        libids = library_cache.get(g.db, session['user_id'])
 
-    ret = []
-    for i in range(min(len(ps),n)):
-        p = ps[i]
-        idvv = '%sv%d' % (p['_rawid'], p['_version'])
-        struct = {}
-        struct['title'] = p['title']
-        struct['pid'] = idvv
-        struct['rawpid'] = p['_rawid']
-        struct['category'] = p['arxiv_primary_category']['term']
-        struct['authors'] = [a['name'] for a in p['authors']]
-        struct['link'] = p['link']
-        struct['in_library'] = 1 if p['_rawid'] in libids else 0
-        if send_abstracts:
-            struct['abstract'] = p['summary']
-        if send_images:
-            struct['img'] = '/static/thumbs/' + idvv + '.pdf.jpg'
-        struct['tags'] = [t['term'] for t in p['tags']]
-
-        struct['hype_score'] = p.get('hype_score', 0)
-        # render time information nicely
-        timestruct = dateutil.parser.parse(p['updated'])
-        struct['published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
-        timestruct = dateutil.parser.parse(p['published'])
-        struct['originally_published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
-        struct['twtr_score_dec'] = p.get('twtr_score_dec', 0)
-        struct['twtr_score'] = p.get('twtr_score', 0)
-        struct['twtr_links'] = p.get('twtr_links', [])
-        # fetch amount of discussion on this paper
-        struct['num_discussion'] = comments.count({ 'pid': p['_rawid'] })
-
-        # arxiv comments from the authors (when they submit the paper)
-        cc = p.get('arxiv_comment', '')
-        if len(cc) > 100:
-            cc = cc[:100] + '...' # crop very long comments
-        struct['comment'] = cc
+    ps = ps[:n]
+    ensure_cards(db_papers, ps)
+    # fetch amount of discussion on all papers in one go
+    num_discussion = discussion_counts.get_many([p['_rawid'] for p in ps])
 
+    ret = []
+    for p in ps:
+        struct = encode_paper(p, in_library=p['_rawid'] in libids, num_discussion=num_discussion[p['_rawid']],
+                              send_images=send_images, send_abstracts=send_abstracts)
         ret.append(struct)
     return ret
 
@@ -197,8 +185,7 @@ def default_context(papers, **kws):
             uid = session['user_id']
             entry = goaway_collection.find_one({ 'uid':uid })
             if not entry:
-                lib_count = query_db('''select count(*) from library where user_id = ?''', [uid], one=True)
-                lib_count = lib_count['count(*)']
+                lib_count = len(library_cache.get(g.db, uid))
                 if lib_count > 0: # user has some items in their library too
                     show_prompt = 'yes'
     except Exception as e:
@@ -225,7 +212,7 @@ def intmain():
     if vstr != 'time_published':
         vstr = 'time_updated'
 
-    papers = list(db_papers.find().sort(vstr, pymongo.DESCENDING).limit(100))
+    papers = list(db_papers.find({}, projection('card+abstract')).sort(vstr, pymongo.DESCENDING).limit(100))
     papers = papers_filter_version(papers, vstr)
     ctx = default_context(papers, render_format='recent',
                           msg='Showing most recent Arxiv papers:')
@@ -243,18 +230,23 @@ def rank(request_pid=None):
 def discuss():
     """ return discussion related to a paper """
     pid = request.args.get('id', '') # paper id of paper we wish to discuss
-    papers = list(db_papers.find({'_id': pid}))
+    papers = list(db_papers.find({'_id': pid}, projection('detail')))
 
     # fetch the comments
     comms_cursor = comments.find({ 'pid':pid }).sort([('time_posted', pymongo.DESCENDING)])
     comms = list(comms_cursor)
+    # and the ones just posted, still in the write-behind queue (the page reloads right after posting)
+    written = set(c['_id'] for c in comms)
+    comms += [dict(c) for c in write_behind.pending(comments) if c['pid'] == pid and c['_id'] not in written]
+    comms.sort(key=lambda c: c['time_posted'], reverse=True)
     for c in comms:
         c['_id'] = str(c['_id']) # have to convert these to strs from ObjectId, and backwards later http://api.mongodb.com/python/current/tutorial.html
 
-    # fetch the counts for all tags
+    # fetch the counts for all tags, queued ones included
+    pending_tags = Counter((t['comment_id'], t['tag_name']) for t in write_behind.pending(tags_collection))
     tag_counts = []
     for c in comms:
-        cc = [tags_collection.count({ 'comment_id':c['_id'], 'tag_name':t }) for t in TAGS]
+        cc = [tags_collection.count({ 'comment_id':c['_id'], 'tag_name':t }) + pending_tags[(c['_id'], t)] for t in TAGS]
         tag_counts.append(cc);
 
     # and render
@@ -263,7 +255,7 @@ def discuss():
 
 
 def _get_paper_data(pid):
-    return list(db_papers.find({'_id': pid}).limit(1))
+    return list(db_papers.find({'_id': pid}, {'_version': 1}).limit(1))
 
 
 @app.route('/comment', methods=['POST'])
@@ -289,6 +281,7 @@ def comment():
 
     # create the entry
     entry = {
+        '_id': ObjectId(), # set now so /notes can show it, and its tags, before it's written
         'user': username,
         'pid': pid, # raw pid with no version, for search convenience
         'version': version, # version as int, again as convenience
@@ -300,7 +293,8 @@ def comment():
 
     # enter into database
     print(entry)
-    comments.insert_one(entry)
+    write_behind.put(comments, entry)
+    discussion_counts.increment(pid)
     return 'OK'
 
 
@@ -315,7 +309,7 @@ def discussions():
     comms_pids = [x for x in comms_pids if not (x in seen or seen.add(x))]
 
     # get papers for pids
-    papers = list(db_papers.find({'_id': {'$in': comms_pids}}))
+    papers = list(db_papers.find({'_id': {'$in': comms_pids}}, projection('card+abstract')))
     papers = {p['_id']:p for p in papers}
 
     # sort by comments order
@@ -349,14 +343,15 @@ def toggletag():
         'time': time_toggled,
     }
 
-    # remove any existing entries for this user/comment/tag
-    result = tags_collection.delete_one({ 'username':username, 'comment_id':comment_id, 'tag_name':tag_name })
-    if result.deleted_count > 0:
+    # remove any existing entries for this user/comment/tag, also the ones not written yet
+    query = { 'username':username, 'comment_id':comment_id, 'tag_name':tag_name }
+    discarded = write_behind.discard(tags_collection, lambda t: all(t[k] == v for k, v in query.items()))
+    if discarded > 0 or tags_collection.delete_one(query).deleted_count > 0:
         print('cleared an existing entry from database')
     else:
         print('no entry existed, so this is a toggle ON. inserting:')
         print(entry)
-        tags_collection.insert_one(entry)
+        write_behind.put(tags_collection, entry)
 
     return 'OK'
 
@@ -375,41 +370,22 @@ def toptwtr():
     sort_field = 'twtr_score_dec' if age_decay else 'twtr_score'
     legend = {'day': 1, '3days': 3, 'week': 7, 'month': 30, 'year': 365, 'alltime': 10000}
     days = legend.get(ttstr)
-    dnow_utc = datetime.datetime.now()
-    dminus = dnow_utc - datetime.timedelta(days=int(days))
-    papers, tweets = [], []
-    papers = list(db_papers.find({'time_published': {'$gt': dminus}}).sort(sort_field, pymongo.DESCENDING))
+    tweets = []
+    papers = top_twitter.top(int(days), sort_field, args.num_results)
 
     ctx = default_context(papers, render_format='toptwtr', tweets=tweets,
                           msg=f'Top new papers from the last {days} days on Twitter')
     return render_template('main.html', **ctx)
 
 
-def tweet_score(t):
-    followers_score = max(log10(t['user_followers_count'] + 1), 1)
-    return (t['likes'] + 2 * t['retweets']) * (t.get('replies', 0) * 4 + 0.5) / followers_score
-
 @app.route('/oldhype', methods=['GET'])
 def oldhype():
     """ return top papers """
     ttstr = request.args.get('timefilter', 'week') # default is day
-    legend = {'day': 1, '3days': 3, 'week': 7, '2weeks': 14}
-    days = legend.get(ttstr)
-    dnow_utc = datetime.datetime.now()
-    dminus = dnow_utc - datetime.timedelta(days=int(days))
-    new_tweets = list(db_tweets.find({'created_at_date': {'$gt': dminus}}))
-    scores = list(map(tweet_score, new_tweets))
-
-    papers_scores = defaultdict(int)
-    for t, score in zip(new_tweets, scores):
-        for p in t.get('pids', []):
-            papers_scores[p] += score
-
-    papers = list(db_papers.find({'_id': {'$in': list(papers_scores.keys())}}))
-    for p in papers:
-        p['hype_score'] = papers_scores[p['_id']]
-
-    papers = sorted(papers, key=lambda x: x['hype_score'], reverse=True)[:100]
+    days = HYPE_WINDOWS.get(ttstr)
+    pids, scores = hype_rankings.get(ttstr)
+    papers = {p['_id']: p for p in db_papers.find({'_id': {'$in': pids}}, projection('card+abstract'))}
+    papers = [dict(papers[pid], hype_score=score) for pid, score in zip(pids, scores) if pid in papers]
 
     ctx = default_context(papers, render_format='oldhype',
                           msg=f'Top papers mentioned on Twitter over last {days} days')
@@ -446,25 +422,9 @@ def review():
 
     uid = session['user_id'] # id of logged in user
 
-    # check this user already has this paper in library
-    record = query_db('''select * from library where
-          user_id = ? and paper_id = ?''', [uid, pid], one=True)
-
-    ret = 'NO'
-    if record:
-        # record exists, erase it.
-        g.db.execute('''delete from library where user_id = ? and paper_id = ?''', [uid, pid])
-        g.db.commit()
-        ret = 'OFF'
-    else:
-        # record does not exist, add it.
-        rawpid = strip_version(pid)
-        g.db.execute('''insert into library (paper_id, user_id, update_time) values (?, ?, ?)''',
-                     [rawpid, uid, int(time.time())])
-        g.db.commit()
-        ret = 'ON'
-
-    return ret
+    # erase the record if this user already has this paper in library, add it otherwise
+    added = library_cache.toggle(g.db, uid, pid)
+    return 'ON' if added else 'OFF'
 
 @app.route('/account')
 def account():
@@ -549,7 +509,8 @@ def categories():
 @app.route('/author_papers')
 def author_papers():
     authors = json.loads(request.args.get('q', ''))
-    papers = list(db_papers.find({'authors.name': {'$in': authors}}).sort("time_published", pymongo.DESCENDING))
+    papers = list(db_papers.find({'authors.name': {'$in': authors}}, {'title': 1, 'link': 1})
+                  .sort("time_published", pymongo.DESCENDING))
     papers = [{'title': p['title'], 'url': p['link']} for p in papers]
     return jsonify(papers)
 
@@ -563,8 +524,10 @@ def add_new_paper_to_db(res):
 
 def record_request(obj_id, obj_type):
     is_first = int(request.args.get('first', 0))
-    network_requests.insert_one({'id': obj_id, 'type': obj_type, 'dt': datetime.datetime.utcnow(), 'ip': request.remote_addr,
-                                 'session': request.cookies.get(REQUESTER_COOKIE, ''), 'is_first': is_first})
+    write_behind.put(network_requests, {'id': obj_id, 'type': obj_type, 'dt': datetime.datetime.utcnow(), 'ip': request.remote_addr,
+                                        'session': request.cookies.get(REQUESTER_COOKIE, ''), 'is_first': is_first},
+                     droppable=True)
+    popular_requests.add((obj_id, obj_type))
 
 @app.route('/get_paper')
 def get_paper():
@@ -572,10 +535,12 @@ def get_paper():
     if id:
         paper = sem_sch_papers.find_one({'$or': [{'_id': id}, {'paperId': id}]})
         if not paper:
-            is_arxiv = '.' in id
-            paper = send_query({'_id': id}, is_arxiv=is_arxiv)
-            if paper:
-                add_new_paper_to_db(paper)
+            # fetched in the background, the client polls until it's there
+            status, paper = sem_sch_fetcher.get(id)
+            if status == PENDING:
+                return jsonify({'status': 'pending', 'retry_after': 1}), 202
+            if status == FAILED:
+                return jsonify({'error': 'Semantic Scholar is not responding, try again later'}), 503
 
         if paper:
             fields = ['title', '_id', 'paper_id', 'authors', 'citations', 'references', 'time_published', 'year']
@@ -588,14 +553,8 @@ def get_paper():
 
 
 @app.route('/popular_queries')
-@cache.cached(timeout=3600)
 def popular_queries():
-    now = datetime.datetime.utcnow()
-    max_age = now - datetime.timedelta(days=7)
-    new_reqs = network_requests.find({'$and': [{'dt': {'$gt': max_age}}]}) # {'is_first': True},
-    new_reqs = ([(r['id'], r['type'], r['ip']) for r in new_reqs])
-    cnt = Counter([(r[0], r[1]) for r in new_reqs])
-    most_common = dict(cnt.most_common(10))
+    most_common = dict(popular_requests.top(10))
 
     authors = [{'name': key[0], 'type': 'author', 'count': val} for key, val in most_common.items() if key[1] == 'author']
 
@@ -623,12 +582,16 @@ def autocomplete_2():
         return jsonify([])
 
     MAX_ITEMS = 10
-    author_q = f'.*{q.replace(" ", ".*")}.*'
-    authors = list(sem_sch_authors.find({'_id': {'$regex': re.compile(author_q, re.IGNORECASE)}}).limit(MAX_ITEMS))
-    authors = [{'name': a['_id'], 'type': 'author'} for a in authors]
+    authors = typeahead_index.query(q, SEM_SCH_AUTHOR, MAX_ITEMS)
+    authors = [{'name': name, 'type': 'author'} for name, _ in authors]
 
-    papers = list(sem_sch_papers.find({'$or': [{'_id': q}, {'$text': {'$search': q}}]}).limit(MAX_ITEMS))
-    papers = [{'name': p['title'], 'type': 'paper', 'id': p['_id'], 'sem_id': p.get('paperId', '')} for p in papers]
+    papers = typeahead_index.query(q, SEM_SCH_PAPER, MAX_ITEMS)
+    papers = [{'name': name, 'type': 'paper', 'id': p['id'], 'sem_id': p['sem_id']} for name, p in papers]
+    if isvalidid(q):
+        exact = sem_sch_papers.find_one({'_id': q}, {'title': 1, 'paperId': 1})
+        if exact:
+            exact = {'name': exact['title'], 'type': 'paper', 'id': exact['_id'], 'sem_id': exact.get('paperId', '')}
+            papers = [exact] + [p for p in papers if p['id'] != exact['id']]
 
     papers_len = len(papers)
     authors_len = len(authors)
@@ -651,12 +614,11 @@ def autocomplete():
     if len(q) <= 2:
         return jsonify([])
 
-    authors = list(db_authors.find({'_id': {'$regex': re.compile(f'.*{q}.*', re.IGNORECASE)}}).limit(50))
-    authors = sorted(authors, key=lambda x: len(x['papers']), reverse=True)[:5]
-    authors = [{'name': a['_id'], 'type': 'author'} for a in authors]
+    authors = typeahead_index.query(q, ARXIV_AUTHOR, 5)
+    authors = [{'name': name, 'type': 'author'} for name, _ in authors]
 
-    papers = list(db_papers.find({'title': {'$regex': re.compile(f'.*{q}.*', re.IGNORECASE)}}).sort("time_published", pymongo.DESCENDING).limit(5))
-    papers = [{'name': p['title'], 'type': 'paper', 'authors': p['authors']} for p in papers]
+    papers = typeahead_index.query(q, ARXIV_PAPER, 5)
+    papers = [{'name': name, 'type': 'paper', 'authors': p['authors']} for name, p in papers]
 
     return jsonify(authors + papers)
 
@@ -681,6 +643,7 @@ if __name__ == "__main__":
         logger.info('did not find as.db, trying to create an empty database from schema.sql...')
         logger.info('this needs sqlite3 to be installed!')
         os.system('sqlite3 as.db < schema.sql')
+    ensure_library_schema(connect_db())
 
     logger.info('connecting to mongodb...')
     client = pymongo.MongoClient()
@@ -688,12 +651,21 @@ if __name__ == "__main__":
     db_papers = mdb.papers
     db_authors = mdb.authors
     db_tweets = mdb.tweets
+    hype_rankings = HypeRankings(mdb.hype_windows)
+    top_twitter = TopTwitterPapers(db_papers, projection('card+abstract'))
     sem_sch_papers = mdb.sem_sch_papers
     sem_sch_authors = mdb.sem_sch_authors
+    sem_sch_fetcher = SemSchFetcher(add_new_paper_to_db)
 
     network_requests = mdb.network_requests
+    popular_requests = RollingTopK(mdb.request_counts)
+    if popular_requests.claim_seed():
+        logger.info('seeding the request counters from the request log...')
+        seed_from_requests(popular_requests, network_requests)
+    popular_requests.start_flusher()
 
     comments = mdb.comments
+    discussion_counts = DiscussionCounts(comments)
     tags_collection = mdb.tags
     goaway_collection = mdb.goaway
     follow_collection = mdb.follow
@@ -701,6 +673,12 @@ if __name__ == "__main__":
     TAGS = ['insightful!', 'thank you', 'agree', 'disagree', 'not constructive', 'troll', 'spam']
     ARXIV_CATEGORIES = json.load(open('relevant_arxiv_categories.json', 'r'))
 
+    logger.info('building the typeahead index...')
+    start_typeahead_refresher(mdb)
+
+    logger.info('loading the tfidf vectors for similar papers...')
+    similarity = SimilarityService.load()
+
     # start
     if args.prod:
         # run on Tornado instead, since running raw Flask in prod is not recommended
@@ -0,0 +1,130 @@
+"""
+Nearest neighbour queries over the tfidf vectors computed by analyze.py.
+
+The tfidf matrix, the pid tables and the precomputed neighbours are memory mapped
+from the artifact of analyze.py (see artifacts.py), so loading takes no time and
+all the server processes share one copy in the page cache. Queries are answered
+from the precomputed neighbours when possible, otherwise with a
+sparse dot product of the paper's row against the whole matrix, or through the
+approximate index of build_ann_index.py when there is one. Recent on-demand
+results are kept in an LRU.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ann_index import AnnIndex
+from artifacts import artifact_exists, load_artifact, PidTable
+from utils import Config, strip_version
+
+logger = logging.getLogger(__name__)
+
+
+def _freeze(X):
+    """ csr matrix in float32 with read-only buffers, so nothing can write into the shared pages by mistake """
+    X = X.tocsr().astype(np.float32, copy=False) # a mapped float32 matrix isn't copied
+    for a in (X.data, X.indices, X.indptr):
+        a.flags.writeable = False
+    return X
+
+
+def topk_indices(scores, k):
+    """ indices of the k largest scores, sorted by decreasing score """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    ix = np.argpartition(-scores, k - 1)[:k]
+    return ix[np.argsort(-scores[ix], kind='stable')]
+
+
+class SimilarityService(object):
+
+    def __init__(self, X, pids, neighbours=None, ann=None, k=50, cache_size=10000, rawpids=None):
+        """
+        :param X: tfidf matrix, one l2 normalized row per paper
+        :param pids: PidTable (or list) of the full idvv strings of the rows of X
+        :param neighbours: precomputed rows of the most similar papers of every row, -1 padded
+        :param ann: AnnIndex used instead of the exact product for papers without enough precomputed neighbours
+        :param k: number of neighbours returned by default
+        :param cache_size: number of on-demand results kept in the LRU
+        :param rawpids: PidTable of the ids without version of the rows, later versions win. derived from pids if None
+        """
+        self.X = _freeze(X)
+        if isinstance(pids, list):
+            pids = PidTable.from_list('pids', pids)
+        if rawpids is None:
+            rawpids = PidTable.from_list('rawpids', [strip_version(p) for p in pids.tolist()])
+        self.pids = pids
+        self.rawpids = rawpids
+        self.neighbours = neighbours
+        self.ann = ann
+        self.k = k
+        self.cache_size = cache_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, tfidf_dir=Config.tfidf_dir, ann_dir=Config.ann_index_dir, **kwargs):
+        """ returns None if analyze.py wasn't run yet """
+        if not artifact_exists(tfidf_dir):
+            logger.warning('tfidf artifact is missing, similar papers are disabled')
+            return None
+        tfidf = load_artifact(tfidf_dir, 'tfidf')
+        X = tfidf['X']
+        ann = None
+        if artifact_exists(ann_dir):
+            ann = AnnIndex.load(ann_dir)
+            if ann.vocab_fp != tfidf.meta.get('vocab_fp'):
+                logger.warning('ann index was built on another vocabulary, not used until build_ann_index.py rebuilds it')
+                ann = None
+        logger.info(f'Mapped tfidf matrix of shape {X.shape} with {X.nnz} non zeros')
+        return cls(X, PidTable.from_artifact(tfidf, 'pids'), tfidf['neighbours'], ann,
+                   rawpids=PidTable.from_artifact(tfidf, 'rawpids'), **kwargs)
+
+    def __contains__(self, pid):
+        return self.rawpids.index(strip_version(pid)) is not None
+
+    def _exact_rows(self, pids):
+        ixs = [self.pids.index(str(p)) for p in pids]
+        ixs = [-1 if i is None else i for i in ixs]
+        known = np.array([i >= 0 for i in ixs], dtype=bool)
+        return known, self.X[[i for i in ixs if i >= 0]]
+
+    def _compute(self, ix, k):
+        row = self.X[ix]
+        if self.ann is not None:
+            pids, _ = self.ann.search(row, k, exact=self._exact_rows)
+            return [strip_version(p) for p in pids]
+        q = np.zeros(self.X.shape[1], dtype=np.float32)
+        q[row.indices] = row.data
+        scores = self.X.dot(q)
+        return [self.rawpids[i] for i in topk_indices(scores, k)]
+
+    def similar(self, pid, k=None):
+        """ returns up to k raw pids similar to pid (most similar first, starting with pid itself) """
+        k = k or self.k
+        ix = self.rawpids.index(strip_version(pid))
+        if ix is None:
+            return []
+
+        if self.neighbours is not None:
+            precomputed = self.neighbours[ix]
+            precomputed = precomputed[precomputed >= 0]
+            if len(precomputed) >= k:
+                return [self.rawpids[q] for q in precomputed[:k]]
+
+        key = (ix, k)
+        with self._lock:
+            res = self._lru.get(key)
+            if res is not None:
+                self._lru.move_to_end(key)
+                return res
+
+        res = self._compute(ix, k)
+        with self._lock:
+            self._lru[key] = res
+            while len(self._lru) > self.cache_size:
+                self._lru.popitem(last=False)
+        return res
@@ -256,6 +256,17 @@ function build_paper_desc(res) {
     $('#node_data').show();
 }
 
+// papers the server doesn't have yet are fetched in the background, poll until they're there
+function get_paper(params, callback) {
+    $.get('/get_paper', params, function(res, status, xhr) {
+        if (xhr.status === 202) {
+            setTimeout(function() { get_paper(params, callback); }, 1000 * (res.retry_after || 1));
+        } else {
+            callback(res);
+        }
+    });
+}
+
 function init_network_events() {
     network.on('stabilized', function() {
         set_network_physics(false);
@@ -267,7 +278,7 @@ function init_network_events() {
                 expand_author(sel_node.id, res);
             });
         } else {
-            $.get('/get_paper', {id: sel_node.id}, function(res) {
+            get_paper({id: sel_node.id}, function(res) {
                 expand_paper(res);
             });
         }
@@ -280,7 +291,7 @@ function init_network_events() {
                 if (res) build_author_desc(sel_node_id, res);
             });
         } else {
-            $.get('/get_paper', {id: sel_node_id}, function(res) {
+            get_paper({id: sel_node_id}, function(res) {
                 build_paper_desc(res);
             });
         }
@@ -328,7 +339,7 @@ function draw_network(data, is_paper, author) {
 function fetch_data_and_draw(cur_s) {
     cur_s['first'] = 1;
     if (cur_s.type == 'paper') {
-        $.get('/get_paper', cur_s, function(res) {
+        get_paper(cur_s, function(res) {
             draw_network(res, true);
         });
     } else {
@@ -1,86 +1,143 @@
 """
-Use imagemagick to convert all pfds to a sequence of thumbnail images
+Use imagemagick to convert all pdfs to a strip of thumbnails of their first pages
 requires: sudo apt-get install imagemagick
-"""
 
+Every pdf is rendered by a single convert command, which rasterizes its first 8
+pages at a density close to the thumbnail height and tiles them horizontally
+(+append). Each job has its own temporary directory for the intermediate files
+and its output, which is renamed into Config.thumbs_dir when complete, so as many
+jobs as there are cores run at a time. A job taking more than --timeout seconds
+is killed with its ghostscript process (convert can enter an infinite loop on
+some pdfs).
+
+The outcome of every pdf is kept in Config.thumbs_manifest_path, failures aren't
+retried until the pdf changes or --retry-failed is given.
+"""
+import argparse
+import filecmp
 import os
-import time
 import shutil
-from subprocess import Popen
-
-from utils import Config
-
-# make sure imagemagick is installed
-if not shutil.which('convert'): # shutil.which needs Python 3.3+
-  print("ERROR: you don\'t have imagemagick installed. Install it first before calling this script")
-  sys.exit()
-
-# create if necessary the directories we're using for processing and output
-pdf_dir = os.path.join('data', 'pdf')
-if not os.path.exists(Config.thumbs_dir): os.makedirs(Config.thumbs_dir)
-if not os.path.exists(Config.tmp_dir): os.makedirs(Config.tmp_dir)
-
-# fetch all pdf filenames in the pdf directory
-files_in_pdf_dir = os.listdir(pdf_dir)
-pdf_files = [x for x in files_in_pdf_dir if x.endswith('.pdf')] # filter to just pdfs, just in case
-
-# iterate over all pdf files and create the thumbnails
-for i,p in enumerate(pdf_files):
-  pdf_path = os.path.join(pdf_dir, p)
-  thumb_path = os.path.join(Config.thumbs_dir, p + '.jpg')
-
-  if os.path.isfile(thumb_path): 
-    print("skipping %s, thumbnail already exists." % (pdf_path, ))
-    continue
-
-  print("%d/%d processing %s" % (i, len(pdf_files), p))
-
-  # take first 8 pages of the pdf ([0-7]), since 9th page are references
-  # tile them horizontally, use JPEG compression 80, trim the borders for each image
-  #cmd = "montage %s[0-7] -mode Concatenate -tile x1 -quality 80 -resize x230 -trim %s" % (pdf_path, "thumbs/" + f + ".jpg")
-  #print "EXEC: " + cmd
-  
-  # nvm, below using a roundabout alternative that is worse and requires temporary files, yuck!
-  # but i found that it succeeds more often. I can't remember wha thappened anymore but I remember
-  # that the version above, while more elegant, had some problem with it on some pdfs. I think.
-
-  # erase previous intermediate files thumb-*.png in the tmp directory
-  if os.path.isfile(os.path.join(Config.tmp_dir, 'thumb-0.png')):
-    for i in range(8):
-      f = os.path.join(Config.tmp_dir, 'thumb-%d.png' % (i,))
-      f2= os.path.join(Config.tmp_dir, 'thumbbuf-%d.png' % (i,))
-      if os.path.isfile(f):
-        cmd = 'mv %s %s' % (f, f2)
-        os.system(cmd)
-        # okay originally I was going to issue an rm call, but I am too terrified of
-        # running scripted rm queries, so what we will do is instead issue a "mv" call
-        # to rename the files. That's a bit safer, right? We have to do this because if
-        # some papers are shorter than 8 pages, then results from previous paper will
-        # "leek" over to this result, through the intermediate files.
-
-  # spawn async. convert can unfortunately enter an infinite loop, have to handle this.
-  # this command will generate 8 independent images thumb-0.png ... thumb-7.png of the thumbnails
-  pp = Popen(['convert', '%s[0-7]' % (pdf_path, ), '-thumbnail', 'x156', os.path.join(Config.tmp_dir, 'thumb.png')])
-  t0 = time.time()
-  while time.time() - t0 < 20: # give it 15 seconds deadline
-    ret = pp.poll()
-    if not (ret is None):
-      # process terminated
-      break
-    time.sleep(0.1)
-  ret = pp.poll()
-  if ret is None:
-    print("convert command did not terminate in 20 seconds, terminating.")
-    pp.terminate() # give up
-
-  if not os.path.isfile(os.path.join(Config.tmp_dir, 'thumb-0.png')):
-    # failed to render pdf, replace with missing image
-    missing_thumb_path = os.path.join('static', 'missing.jpg')
-    os.system('cp %s %s' % (missing_thumb_path, thumb_path))
-    print("could not render pdf, creating a missing image placeholder")
-  else:
-    cmd = "montage -mode concatenate -quality 80 -tile x1 %s %s" % (os.path.join(Config.tmp_dir, 'thumb-*.png'), thumb_path)
-    print(cmd)
-    os.system(cmd)
-
-  time.sleep(0.01) # silly way for allowing for ctrl+c termination
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import Config, Manifest
+
+OK, FAILED, TIMEOUT = 'ok', 'failed', 'timeout'
+NUM_PAGES = 8 # take first 8 pages of the pdf ([0-7]), since 9th page are references
+HEIGHT = 156
+DENSITY = 30 # dpi, a letter page is 330px high, about twice the thumbnail
+MISSING_THUMB_PATH = os.path.join('static', 'missing.jpg') # the placeholder older versions copied on failure
+
+
+def render_thumbnail(pdf_path, thumb_path, job_dir, timeout, num_pages=NUM_PAGES, height=HEIGHT, density=DENSITY):
+  """ renders the pages of the pdf side by side into thumb_path, returns the status """
+  out_path = os.path.join(job_dir, 'thumb.jpg')
+  cmd = ['convert', '-density', str(density), '%s[0-%d]' % (os.path.abspath(pdf_path), num_pages - 1),
+         '-thumbnail', 'x%d' % (height, ), '-background', 'white', '-alpha', 'remove', '+append',
+         '-quality', '80', out_path]
+  env = dict(os.environ, MAGICK_TEMPORARY_PATH=job_dir) # the ghostscript delegate's files too
+  try:
+    # in its own process group, so that a timeout also kills the ghostscript process convert started
+    proc = subprocess.Popen(cmd, cwd=job_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+  except OSError:
+    return FAILED
+  try:
+    returncode = proc.wait(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    returncode = None
+  finally:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL) # whatever is left of the group, before its temp dir is removed
+    except ProcessLookupError:
+      pass
+    proc.wait()
+  if returncode is None:
+    return TIMEOUT
+  if returncode != 0 or not os.path.isfile(out_path):
+    return FAILED
+  shutil.move(out_path, thumb_path)
+  return OK
+
+
+class ThumbnailRenderer(object):
+
+  def __init__(self, manifest, pdf_dir=Config.pdf_dir, thumbs_dir=Config.thumbs_dir, tmp_dir=Config.tmp_dir,
+               num_workers=None, timeout=20, retry_failed=False):
+    """
+    :param manifest: utils.Manifest of the outcomes, keyed by pdf basename
+    :param num_workers: convert processes at a time, the number of cores by default
+    :param timeout: seconds after which a convert process is killed
+    :param retry_failed: render again the pdfs that failed or timed out even if they didn't change
+    """
+    self.manifest = manifest
+    self.pdf_dir = pdf_dir
+    self.thumbs_dir = thumbs_dir
+    self.tmp_dir = tmp_dir
+    self.num_workers = num_workers or os.cpu_count()
+    self.timeout = timeout
+    self.retry_failed = retry_failed
+    self.stats = Counter() # ok, failed, timeout, unchanged
+
+  def process(self, f):
+    """ renders the thumbnail of data/pdf/f if it's new or changed, returns its status (or 'unchanged') """
+    pdf_path = os.path.join(self.pdf_dir, f)
+    thumb_path = os.path.join(self.thumbs_dir, f + '.jpg')
+    st = os.stat(pdf_path)
+    record = self.manifest.get(f)
+    if record is None and os.path.isfile(thumb_path):
+      # rendered before the manifest existed, failures were a copy of the placeholder
+      failed = os.path.isfile(MISSING_THUMB_PATH) and filecmp.cmp(thumb_path, MISSING_THUMB_PATH, shallow=False)
+      record = {'status': FAILED if failed else OK, 'size': st.st_size, 'mtime': st.st_mtime, 'seconds': None}
+      self.manifest.set(f, **record)
+    if record and (record['size'], record['mtime']) == (st.st_size, st.st_mtime) and \
+        (record['status'] == OK or not self.retry_failed):
+      return 'unchanged'
+
+    t0 = time.time()
+    with tempfile.TemporaryDirectory(prefix='thumb-', dir=self.tmp_dir) as job_dir:
+      status = render_thumbnail(pdf_path, thumb_path, job_dir, self.timeout)
+    seconds = time.time() - t0
+    self.manifest.set(f, status=status, size=st.st_size, mtime=st.st_mtime, seconds=round(seconds, 3))
+    if status != OK:
+      print('could not render %s: %s after %.1fs' % (pdf_path, status, seconds))
+    return status
+
+  def run(self, files=None):
+    """ renders the thumbnails of the new or changed pdfs of pdf_dir (or the given basenames), returns the stats """
+    for d in [self.thumbs_dir, self.tmp_dir]:
+      if not os.path.exists(d): os.makedirs(d)
+    if files is None:
+      files = [f for f in os.listdir(self.pdf_dir) if f.endswith('.pdf')] # filter to just pdfs, just in case
+    try:
+      with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+        for i, status in enumerate(executor.map(self.process, files)):
+          self.stats[status] += 1
+          if (i + 1) % 100 == 0:
+            print('%d/%d %s' % (i + 1, len(files), dict(self.stats)))
+    finally:
+      self.manifest.save()
+    return self.stats
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--workers', type=int, default=None, help='convert processes at a time, defaults to the cores')
+  parser.add_argument('--timeout', type=float, default=20, help='seconds after which convert is killed')
+  parser.add_argument('--retry-failed', action='store_true', help='render again the pdfs that failed or timed out')
+  args = parser.parse_args()
+
+  # make sure imagemagick is installed
+  if not shutil.which('convert'): # shutil.which needs Python 3.3+
+    print("ERROR: you don\'t have imagemagick installed. Install it first before calling this script")
+    sys.exit()
+
+  renderer = ThumbnailRenderer(Manifest(Config.thumbs_manifest_path), num_workers=args.workers, timeout=args.timeout,
+                               retry_failed=args.retry_failed)
+  stats = renderer.run()
+  print('done: %s' % (dict(stats), ))
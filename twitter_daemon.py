@@ -16,6 +16,7 @@ import datetime
 import tweepy
 import pymongo
 
+from hype import update_hype_windows, tweet_scores
 from logger import logger_config
 from utils import Config, catch_exceptions
 
@@ -90,10 +91,9 @@ def calc_papers_twitter_score(papers_to_update):
     papers_tweets = list(db_tweets.find({'pids': {'$in': papers_to_update}}))
     score_per_paper = defaultdict(int)
     links_per_paper = defaultdict(list)
-    for t in papers_tweets:
-        followers_score = max(math.log10(t['user_followers_count'] + 1), 1)
-        tot_score = (t['likes'] + 2 * t['retweets']) * (t.get('replies', 0) * 4 + 0.5) / followers_score
-
+    scores = tweet_scores([t['likes'] for t in papers_tweets], [t['retweets'] for t in papers_tweets],
+                          [t.get('replies', 0) for t in papers_tweets], [t['user_followers_count'] for t in papers_tweets])
+    for t, tot_score in zip(papers_tweets, scores.tolist()):
         for cur_p in t['pids']:
             score_per_paper[cur_p] += tot_score
             links_per_paper[cur_p].append({'tname': t['user_screen_name'], 'tid': t['_id'], 'rt': t['retweets'],
@@ -208,6 +208,7 @@ def process_tweets(tweets_raw_data):
     dnow_utc = datetime.datetime.now(datetime.timezone.utc)
     banned = get_banned()
     to_insert = []
+    to_update = []
     papers_to_update = []
     unique_tweet_ids = set()
 
@@ -236,6 +237,7 @@ def process_tweets(tweets_raw_data):
             to_insert.append(tweet)
         else:
             db_tweets.update(tweet_id_q, {'$set': tweet}, True)
+            to_update.append(tweet)
 
         unique_tweet_ids.add(r.id_str)
         logger.info(f'Found tweet for {arxiv_pids} with {tweet["likes"]} likes')
@@ -243,6 +245,7 @@ def process_tweets(tweets_raw_data):
     if to_insert:
         db_tweets.insert_many(to_insert)
     logger.info('processed %d/%d new tweets. Currently maintaining total %d' % (len(to_insert), len(tweets_raw_data), db_tweets.count()))
+    update_hype_windows(db_tweets, db_hype, to_insert + to_update)
     return papers_to_update
 
 
@@ -264,6 +267,7 @@ client = pymongo.MongoClient()
 mdb = client.arxiv
 db_tweets = mdb.tweets # the "tweets" collection in "arxiv" database
 db_papers = mdb.papers
+db_hype = mdb.hype_windows # top papers of every window, see hype.py
 
 # main loop
 if __name__ == '__main__':
@@ -0,0 +1,221 @@
+"""
+In-memory typeahead index behind /autocomplete, /autocomplete_2 and /wayr/autocomplete.
+
+Entries are author names and paper titles, from the arxiv collections and from the
+semantic scholar ones. Their words are ascii folded, lower cased and kept in a
+sorted byte string array next to the id of their entry, so the entries matching a
+word prefix are one np.searchsorted range. Every query word must be a prefix of a
+word of the entry, and the matches are ranked by paper count (authors) or recency
+(papers).
+
+The index is built from mongo at startup and then refreshed incrementally with the
+papers the ingest jobs (fetch_papers.py, fetch_citations_and_references.py) wrote
+since the last refresh. New words go to a small unsorted tail that is merged into
+the sorted arrays once it grows.
+"""
+import datetime
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# kinds of entries
+ARXIV_AUTHOR, ARXIV_PAPER, SEM_SCH_AUTHOR, SEM_SCH_PAPER = range(4)
+
+MAX_TAIL = 5000 # words in the tail before it's merged into the sorted arrays
+CACHE_SIZE = 5000 # memoized queries, cleared on every change
+word_re = re.compile(r'[a-z0-9]+')
+
+
+def normalize_words(s):
+    s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').decode('ascii').lower()
+    return word_re.findall(s)
+
+
+def _timestamp(d):
+    if isinstance(d, datetime.datetime):
+        return d.timestamp()
+    return float(d or 0)
+
+
+class TypeaheadIndex(object):
+
+    def __init__(self):
+        self.names = [] # display string of every entry
+        self.payloads = [] # extra fields returned with the entry
+        self.kinds = np.zeros(0, dtype=np.int8)
+        self.ranks = np.zeros(0, dtype=np.float64)
+        self.keys = {} # (kind, id) -> entry
+        self.words = np.zeros(0, dtype='S1') # sorted
+        self.word_entries = np.zeros(0, dtype=np.int32) # aligned with words
+        self.tail = [] # (word, entry) not merged yet
+        self._pending = [] # new entries not appended to the arrays yet
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.names)
+
+    # -------------------------------------------------------------------------
+    # updating
+
+    def upsert(self, kind, key, name, rank, payload=None):
+        """ adds an entry, or updates the rank/payload of an existing one. call commit() when done """
+        with self._lock:
+            e = self.keys.get((kind, key))
+            if e is not None:
+                if e < len(self.ranks):
+                    self.ranks[e] = rank
+                else:
+                    self._pending[e - len(self.ranks)] = (kind, rank)
+                self.payloads[e] = payload
+                if name == self.names[e]:
+                    return e
+                self.names[e] = name # index the new words too, the stale ones still match
+            else:
+                e = len(self.names)
+                self.keys[(kind, key)] = e
+                self.names.append(name)
+                self.payloads.append(payload)
+                self._pending.append((kind, rank))
+            self.tail.extend((w.encode('ascii'), e) for w in set(normalize_words(name)))
+            return e
+
+    def rank_of(self, kind, key):
+        e = self.keys.get((kind, key))
+        if e is None:
+            return None
+        if e < len(self.ranks):
+            return self.ranks[e]
+        return self._pending[e - len(self.ranks)][1]
+
+    def commit(self):
+        """ appends the pending entries and merges the tail once it's large """
+        with self._lock:
+            if self._pending:
+                self.kinds = np.concatenate([self.kinds, np.array([k for k, _ in self._pending], dtype=np.int8)])
+                self.ranks = np.concatenate([self.ranks, np.array([r for _, r in self._pending], dtype=np.float64)])
+                self._pending = []
+            if len(self.tail) > MAX_TAIL:
+                self._merge_tail()
+            self._cache.clear()
+
+    def _merge_tail(self):
+        words = np.concatenate([self.words, np.array([w for w, _ in self.tail], dtype='S')])
+        entries = np.concatenate([self.word_entries, np.array([e for _, e in self.tail], dtype=np.int32)])
+        order = np.argsort(words, kind='stable')
+        self.words, self.word_entries = words[order], entries[order]
+        self.tail = []
+
+    # -------------------------------------------------------------------------
+    # querying
+
+    def _prefix_entries(self, prefix):
+        p = prefix.encode('ascii')
+        lo = np.searchsorted(self.words, p, side='left')
+        hi = np.searchsorted(self.words, p + b'\xff', side='left')
+        entries = self.word_entries[lo:hi]
+        committed = len(self.kinds)
+        tail = [e for w, e in self.tail if e < committed and w.startswith(p)]
+        if tail:
+            entries = np.concatenate([entries, np.array(tail, dtype=np.int32)])
+        return entries
+
+    def query(self, q, kind, limit=10):
+        """ returns (name, payload) of the best entries of this kind matching all the word prefixes of q """
+        words = normalize_words(q)
+        if not words:
+            return []
+        cache_key = (' '.join(words), kind, limit)
+        with self._lock:
+            res = self._cache.get(cache_key)
+            if res is not None:
+                self._cache.move_to_end(cache_key)
+                return res
+
+            matches = None
+            hit = np.zeros(len(self.kinds), dtype=bool)
+            for w in sorted(set(words), key=len, reverse=True): # longest prefixes are the most selective
+                entries = self._prefix_entries(w)
+                hit[:] = False
+                hit[entries] = True
+                if matches is None:
+                    hit &= self.kinds == kind
+                    matches = np.flatnonzero(hit) # sorted and deduplicated, unlike entries
+                else:
+                    matches = matches[hit[matches]]
+                if len(matches) == 0:
+                    break
+
+            if len(matches) > limit:
+                matches = matches[np.argpartition(-self.ranks[matches], limit - 1)[:limit]]
+            matches = matches[np.argsort(-self.ranks[matches], kind='stable')]
+            res = [(self.names[e], self.payloads[e]) for e in matches]
+
+            self._cache[cache_key] = res
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return res
+
+
+# loading from mongo
+# -----------------------------------------------------------------------------
+
+def _add_papers(index, papers, paper_kind, author_kind, payload_func):
+    n = 0
+    for p in papers:
+        is_new = index.rank_of(paper_kind, p['_id']) is None
+        rank = _timestamp(p.get('time_published')) or float(p.get('year') or 0)
+        index.upsert(paper_kind, p['_id'], p.get('title') or '', rank, payload_func(p))
+        if is_new:
+            # authors are ranked by their number of papers
+            for a in p.get('authors', []):
+                count = index.rank_of(author_kind, a['name']) or 0
+                index.upsert(author_kind, a['name'], a['name'], count + 1)
+        n += 1
+    index.commit()
+    return n
+
+
+def refresh_index(index, mdb, since=None):
+    """ adds or updates the papers (and their authors) that changed in mongo since the given datetime """
+    fields = {'title': 1, 'authors.name': 1, 'time_published': 1, 'year': 1, 'paperId': 1}
+    arxiv_q = {'time_ingested': {'$gt': since}} if since else {} # time_updated is arxiv's date, not ours
+    n = _add_papers(index, mdb.papers.find(arxiv_q, fields), ARXIV_PAPER, ARXIV_AUTHOR,
+                    lambda p: {'id': p['_id'], 'authors': [{'name': a['name']} for a in p.get('authors', [])]})
+    sem_q = {'last_rec_update': {'$gt': since}} if since else {}
+    n += _add_papers(index, mdb.sem_sch_papers.find(sem_q, fields), SEM_SCH_PAPER, SEM_SCH_AUTHOR,
+                     lambda p: {'id': p['_id'], 'sem_id': p.get('paperId', '')})
+    return n
+
+
+typeahead_index = TypeaheadIndex()
+
+
+def start_refresher(mdb, interval=300):
+    """ builds the shared index, then keeps refreshing it in a daemon thread """
+    started = datetime.datetime.utcnow()
+    n = refresh_index(typeahead_index, mdb)
+    logger.info(f'Typeahead index built from {n} papers, {len(typeahead_index)} entries')
+
+    def run():
+        since = started - datetime.timedelta(minutes=1)
+        while True:
+            time.sleep(interval)
+            started_refresh = datetime.datetime.utcnow()
+            try:
+                n = refresh_index(typeahead_index, mdb, since)
+                logger.info(f'Typeahead index refreshed with {n} papers, {len(typeahead_index)} entries')
+                since = started_refresh - datetime.timedelta(minutes=1) # some slack for slow writers
+            except Exception:
+                logger.exception('Failed to refresh the typeahead index')
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -1,9 +1,19 @@
 from contextlib import contextmanager
 
+import datetime
+import email.utils
+import hashlib
+import json
+import math
 import os
 import re
 import pickle
 import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
 
 # global settings
 # -----------------------------------------------------------------------------
@@ -12,13 +22,21 @@ class Config(object):
     db_path = 'db.p'
     # intermediate processing folders
     pdf_dir = os.path.join('data', 'pdf')
+    pdf_manifest_path = os.path.join('data', 'pdf_manifest.json') # outcome of every download of download_pdfs.py
     txt_dir = os.path.join('data', 'txt')
+    corpus_dir = os.path.join('data', 'corpus') # the texts of data/txt packed by corpus_store.py
+    txt_manifest_path = os.path.join('data', 'txt_manifest.json') # outcome of every pdf of parse_pdf_to_text.py
     thumbs_dir = os.path.join('static', 'thumbs')
+    thumbs_manifest_path = os.path.join('data', 'thumbs_manifest.json') # outcome of every pdf of thumb_pdf.py
     # intermediate pickles
-    tfidf_path = 'tfidf.p'
-    meta_path = 'tfidf_meta.p'
-    sim_path = 'sim_dict.p'
-    user_sim_path = 'user_sim.p'
+    tfidf_dir = 'tfidf' # tfidf vectors, vocabulary, pids and neighbours of analyze.py, see artifacts.py
+    tfidf_state_path = 'tfidf_state.p' # vocabulary and counts for incremental analyze.py runs
+    ann_index_dir = 'ann_index' # approximate nearest neighbour index built by build_ann_index.py
+    search_index_path = 'search_index.npz' # bm25 index of search_index.py
+    fetch_checkpoint_path = 'fetch_checkpoint.json' # where fetch_papers.py resumes an interrupted run
+    hype_state_path = 'hype_state.p' # scored tweet rows of the last two weeks, see hype.py
+    user_sim_dir = 'user_sim' # recommendations of buildsvm.py, see artifacts.py
+    user_models_path = 'user_models.p' # per user svm coefficients and library fingerprints of buildsvm.py
     # sql database file
     db_serve_path = 'db2.p' # an enriched db.p with various preprocessing info
     database_path = 'as.db'
@@ -88,6 +106,142 @@ def safe_pickle_dump(obj, fname):
         pickle.dump(obj, f, -1)
 
 
+# rate limiting of the clients of external APIs
+# -----------------------------------------------------------------------------
+
+RETRY_AFTER = 60 # seconds, when a 429 or 503 has no usable Retry-After
+
+
+def retry_after_seconds(value, default=RETRY_AFTER):
+    """ the seconds of a Retry-After header, which is either a number of seconds or an http date (RFC 7231) """
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+        return max(0.0, seconds) if math.isfinite(seconds) else default
+    except ValueError:
+        pass
+    try:
+        t = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return default
+    if t is None:
+        return default
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (t - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class TokenBucket(object):
+    """ thread safe token bucket: acquire() blocks until a token is available, tokens refill at `rate` per second """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def pause(self, seconds):
+        """ no tokens are handed out for the next `seconds`, e.g. after the server said we're too fast """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+# manifests of the batch jobs
+# -----------------------------------------------------------------------------
+
+class Manifest(object):
+    """
+    the outcome of every item of a batch job (e.g. pdf basename -> {'status': 'ok', ...}) kept in a json file,
+    thread safe. It's saved atomically every `save_every` changes and by save(), so a killed job loses little
+    """
+
+    def __init__(self, path, save_every=100):
+        self.path = path
+        self.save_every = save_every
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock() # the latest snapshot is the last one written
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, **record):
+        with self._lock:
+            self.entries[key] = record
+            self._changes += 1
+            save = self._changes >= self.save_every
+        if save:
+            self.save()
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self.entries)
+                self._changes = 0
+            with open_atomic(self.path, 'w') as f:
+                f.write(data)
+
+
+# shared memory for process pools
+# -----------------------------------------------------------------------------
+
+def to_shared_memory(a, shms):
+    """
+    copies the array into a new shared memory block (appended to shms, the caller closes and unlinks them)
+    and returns a picklable spec that workers pass to attach_shared_memory
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    shared = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    shared[...] = a
+    shms.append(shm)
+    return {'name': shm.name, 'shape': a.shape, 'dtype': a.dtype.str}
+
+def attach_shared_memory(spec, shms):
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    shms.append(shm)
+    return np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+
+
+def fingerprint(items):
+    """ sha1 hex digest of the str of the items, e.g. of a vocabulary or of the pids of the rows of a matrix """
+    h = hashlib.sha1()
+    for x in items:
+        h.update(str(x).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
 # arxiv utils
 # -----------------------------------------------------------------------------
 
@@ -10,6 +10,9 @@ import praw
 from flask import Blueprint, render_template, jsonify, request, make_response
 
 from reddit_utils import create_reddit_api, edit_post
+from typeahead import typeahead_index, ARXIV_PAPER
+from utils import isvalidid
+from write_behind import write_behind
 
 voting_app = Blueprint('voting',__name__)
 BASE_PATH = '/wayr'
@@ -21,6 +24,7 @@ db_papers = mdb.papers
 db_votes = mdb.votes
 
 MAX_ITEMS = 20
+PAPER_FIELDS = {'title': 1, 'link': 1, 'time_published': 1} # what papers_json and the reddit post render
 
 tot_votes = 0
 last_reddit_update = None
@@ -52,7 +56,7 @@ def papers_json(paper_votes, papers_data):
 def current_votes():
     paper_votes = get_votes_summary()
     p_ids = list(paper_votes.keys())
-    papers_data = db_papers.find({'_id': {'$in': p_ids}})
+    papers_data = db_papers.find({'_id': {'$in': p_ids}}, PAPER_FIELDS)
     papers_data = sorted(papers_data, key=lambda x: paper_votes.get(x['_id'], 0), reverse=True)
     return jsonify(papers_json(paper_votes, papers_data))
 
@@ -84,9 +88,11 @@ def autocomplete():
     if len(q) <= 1:
         return jsonify({'data': []})
 
-    papers = db_papers.find({'$or': [{'_id': q}, {'$text': {'$search': q}}]}, {'score': {'$meta': "textScore"}})
-    papers = list(papers.sort([('score', {'$meta': 'textScore'})]).limit(MAX_ITEMS))
-    p_ids = [p['_id'] for p in papers]
+    p_ids = [p['id'] for _, p in typeahead_index.query(q, ARXIV_PAPER, MAX_ITEMS)]
+    if isvalidid(q):
+        p_ids = [q] + [p for p in p_ids if p != q][:MAX_ITEMS - 1]
+    papers = {p['_id']: p for p in db_papers.find({'_id': {'$in': p_ids}}, PAPER_FIELDS)}
+    papers = [papers[p] for p in p_ids if p in papers]
     paper_votes = get_votes_summary(p_ids)
     return jsonify(papers_json(paper_votes, papers))
 
@@ -97,10 +103,12 @@ def vote():
     cookie = request.cookies.get(VOTING_COOKIE, '')
     prev_votes = db_votes.find({'$and': [{'$or': [{'cookie': cookie}, {'ip': request.remote_addr}]}, {'pid': {'$in': ids}}]}, {'_id': 0, 'pid': 1})
     prev_votes = set([v['pid'] for v in prev_votes])
+    prev_votes.update(v['pid'] for v in write_behind.pending(db_votes) if v['cookie'] == cookie or v['ip'] == request.remote_addr)
     inserted_data = [{'pid': d, 'dt': datetime.datetime.utcnow(), 'ip': request.remote_addr, 'cookie': cookie} for d in ids if d not in prev_votes]
     if inserted_data:
-        db_votes.insert_many(inserted_data)
-        reddit_thread = threading.Thread(target=update_reddit_post)
+        for v in inserted_data:
+            write_behind.put(db_votes, v)
+        reddit_thread = threading.Thread(target=flush_and_update_reddit_post)
         reddit_thread.start()
 
     return jsonify({'message': 'Thanks for voting!'})
@@ -118,6 +126,12 @@ def get_reddit_post_id():
     return None
 
 
+def flush_and_update_reddit_post():
+    # the post sums the votes in mongo, the new ones must be written first
+    write_behind.flush()
+    update_reddit_post()
+
+
 def update_reddit_post():
     global last_reddit_update
 
@@ -147,7 +161,7 @@ You can vote or add a new paper and this post will be updated automatically. It'
     final_note = 'Code is [here](https://github.com/ranihorev/arxiv-network-graph). Feedback and feature requests are required :)'
     paper_votes = get_votes_summary()
     p_ids = list(paper_votes.keys())
-    papers_data = db_papers.find({'_id': {'$in': p_ids}})
+    papers_data = db_papers.find({'_id': {'$in': p_ids}}, PAPER_FIELDS)
     papers_data = sorted(papers_data, key=lambda x: paper_votes.get(x['_id'], 0), reverse=True)
     papers = papers_json(paper_votes, papers_data)['data']
 
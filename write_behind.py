@@ -0,0 +1,192 @@
+"""
+Write-behind queue for the inserts the request handlers don't need to wait for
+(request logs, comments, tags, votes).
+
+put() appends the document to an in-memory queue and returns, a daemon thread
+writes the queue with one insert_many per collection every `flush_interval`
+seconds, or as soon as `max_batch` documents are waiting. The queue holds at most
+`max_pending` documents: when it's full, droppable documents (the request log)
+are dropped, the others wait for the flusher (backpressure) and are inserted
+synchronously if there is still no room after `block_timeout`. Whatever is left
+is written at exit.
+
+Documents whose insert failed are put back in front of the queue and retried
+after an exponential backoff, up to `max_retries` attempts (insert_many sets their
+_id, so the ones an earlier attempt wrote come back as duplicates and are skipped).
+Droppable documents aren't retried.
+
+Documents are visible to readers only once flushed, handlers that must see their
+own writes (e.g. toggling a tag twice) look at pending() / discard() too. Those
+only wait for a write in progress when it holds a document they ask for.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000 # mongo error code
+
+
+class WriteBehind(object):
+
+    def __init__(self, max_batch=500, flush_interval=1.0, max_pending=20000, block_timeout=5.0, max_retries=5,
+                 retry_backoff=1.0):
+        """
+        :param max_batch: pending documents that trigger a flush before flush_interval elapsed
+        :param flush_interval: max seconds a document waits before it's written
+        :param max_pending: max documents held in memory
+        :param block_timeout: max seconds put() waits for room before inserting a non droppable document itself
+        :param max_retries: attempts at inserting a document before it's given up (and logged)
+        :param retry_backoff: seconds before the first retry of a failed insert, doubled at every attempt
+        """
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.stats = Counter() # enqueued, written, dropped, blocked, synchronous, retried, failed, flushes
+        self._queue = [] # (collection, document, droppable, failed attempts)
+        self._in_flight = [] # the entries of the batch being written
+        self._retry_at = 0 # the flusher waits until then after a failed insert
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock() # one batch written at a time
+        self._thread = None
+        self._closed = False
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, collection, doc, droppable=False):
+        """
+        queues doc for insertion into the mongo collection. returns False if it was dropped, which only happens to
+        droppable documents: the others are inserted before returning when the queue stays full
+        """
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            if len(self._queue) >= self.max_pending:
+                if droppable:
+                    self.stats['dropped'] += 1
+                    return False
+                self.stats['blocked'] += 1
+                self._cond.notify_all()
+                deadline = time.time() + self.block_timeout
+                while len(self._queue) >= self.max_pending and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+            full = len(self._queue) >= self.max_pending
+            if not full:
+                self._queue.append((collection, doc, droppable, 0))
+                self.stats['enqueued'] += 1
+                if len(self._queue) >= self.max_batch:
+                    self._cond.notify_all()
+        if full:
+            logger.warning(f'write-behind queue full, inserting a document into {collection.name} synchronously')
+            collection.insert_one(doc) # raises to the handler like a direct insert would
+            with self._cond:
+                self.stats['synchronous'] += 1
+        return True
+
+    def pending(self, collection):
+        """ the queued documents of a collection, not written yet """
+        with self._cond:
+            return [doc for c, doc, _, _ in self._in_flight + self._queue if c is collection]
+
+    def discard(self, collection, match):
+        """ removes the queued documents of a collection for which match(doc) is true, returns how many """
+        with self._cond:
+            # a matching document being written can't be taken back, wait until it's in mongo (or back in the queue)
+            while any(c is collection and match(doc) for c, doc, _, _ in self._in_flight):
+                self._cond.wait()
+            keep = [e for e in self._queue if not (e[0] is collection and match(e[1]))]
+            n = len(self._queue) - len(keep)
+            self._queue = keep
+            return n
+
+    def _insert(self, collection, entries):
+        """ inserts the documents of the entries, returns the entries that failed """
+        docs = [e[1] for e in entries]
+        try:
+            collection.insert_many(docs, ordered=False)
+            failed = []
+        except BulkWriteError as e:
+            errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != DUPLICATE_KEY]
+            failed = [entries[err['index']] for err in errors]
+            if errors:
+                logger.warning(f'write-behind insert of {len(failed)} documents into {collection.name} failed: '
+                               f'{errors[0].get("errmsg")}')
+        except Exception:
+            failed = entries
+            logger.exception(f'write-behind insert of {len(docs)} documents into {collection.name} failed')
+        self.stats['written'] += len(docs) - len(failed)
+        return failed
+
+    def flush(self):
+        """ writes everything queued so far, the failed documents are queued again for a retry """
+        with self._flush_lock:
+            with self._cond:
+                batch, self._queue = self._queue, []
+                self._in_flight = batch
+                self._cond.notify_all()
+            if not batch:
+                return
+            by_collection = {}
+            for e in batch:
+                by_collection.setdefault(id(e[0]), (e[0], []))[1].append(e)
+            retry = []
+            for c, entries in by_collection.values():
+                for _, doc, droppable, attempts in self._insert(c, entries):
+                    if droppable:
+                        self.stats['dropped'] += 1
+                    elif attempts + 1 >= self.max_retries:
+                        self.stats['failed'] += 1
+                        logger.error(f'write-behind gave up inserting into {c.name} after {attempts + 1} attempts: {doc}')
+                    else:
+                        retry.append((c, doc, droppable, attempts + 1))
+            with self._cond:
+                self._in_flight = []
+                if retry:
+                    self._queue[:0] = retry
+                    self._retry_at = time.time() + self.retry_backoff * 2 ** (max(e[3] for e in retry) - 1)
+                    self.stats['retried'] += len(retry)
+                self._cond.notify_all()
+            self.stats['flushes'] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.flush_interval
+                while not self._closed and (time.time() < self._retry_at or
+                                            (len(self._queue) < self.max_batch and time.time() < deadline)):
+                    self._cond.wait(max(deadline, self._retry_at) - time.time())
+                closed = self._closed
+            if closed:
+                return
+            self.flush()
+
+    def close(self):
+        """ stops the flusher and writes what's left """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        while True:
+            self.flush()
+            with self._cond:
+                if not self._queue:
+                    break
+                wait = self._retry_at - time.time()
+            if wait > 0:
+                time.sleep(wait) # the retries are bounded, this ends
+        logger.info(f'write-behind queue closed: {dict(self.stats)}')
+
+
+write_behind = WriteBehind()